@@ -0,0 +1,286 @@
+#!/usr/bin/env python3
+
+'''
+An end-to-end benchmark of the whole program, from pulling the logs from Cloudflare to pushing them to Elasticsearch.
+It starts a synthetic Logpull server, which generates realistic logs at the given volume and latency, and a fake Elasticsearch,
+which answers the bulk requests and can reject them with 429 or fail part of the logs in them, like a busy cluster does.
+The program is then run in one-time mode against both of them, and the throughput, the peak memory usage and the p99 latency
+of each stage (taken from the metrics written by the program) are reported.
+
+Any argument after -- is passed to the program as is, so different settings can be compared with the same workload.
+
+Usage: python3 benchmarks/bench_pipeline.py [--seconds 600] [--logs-per-second 200] [--reject-rate 0.05] [--error-rate 0.01] [-- --stream --push-workers 8]
+'''
+
+import argparse, gzip, http.server, json, os, random, re, resource, subprocess, sys, tempfile, threading, time, zlib
+from datetime import datetime, timedelta
+from urllib.parse import urlparse, parse_qs
+
+#the logs are generated the same way as the micro-benchmark of process_logs()
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from bench_process_logs import generate_logs
+
+PROGRAM = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "cf_elk_pusher.py")
+
+#the stages reported, with the histogram of the metrics each of them is measured by
+STAGES = [("fetch (per log range)", "cf_elk_fetch_seconds"), ("process (per log range)", "cf_elk_process_seconds"), ("write (per log range)", "cf_elk_compress_seconds"), ("push (per bulk request)", "cf_elk_bulk_seconds")]
+
+'''
+The counters of the stand-ins, shared by the threads of both servers
+'''
+class Stats:
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.logs_generated = 0
+        self.logpull_requests = 0
+        self.logpull_wire_bytes = 0
+        self.logpull_raw_bytes = 0
+        self.bulk_requests = 0
+        self.bulk_rejected = 0
+        self.bulk_wire_bytes = 0
+        self.bulk_raw_bytes = 0
+        self.docs_indexed = 0
+        self.docs_retryable = 0
+        self.docs_failed = 0
+
+'''
+The synthetic Logpull server. It answers the logs of a log range with (logs per second * seconds in the log range) lines,
+taken from a pool of generated logs, after waiting for the given latency.
+The logs are compressed with gzip if the request asks for it with Accept-Encoding, the same as Cloudflare does, unless compression is turned off to see the difference.
+A request without start and end time is answered as a successful credential check.
+'''
+class LogpullHandler(http.server.BaseHTTPRequestHandler):
+
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+        if not url.path.endswith("/logs/received"):
+            self.send_error(404)
+            return
+
+        if "start" not in query or "end" not in query:
+            body = b"ok"
+            compressed = False
+        else:
+            start = datetime.strptime(query["start"][0], "%Y-%m-%dT%H:%M:%SZ")
+            end = datetime.strptime(query["end"][0], "%Y-%m-%dT%H:%M:%SZ")
+            number_of_logs = int((end - start).total_seconds() * self.server.logs_per_second)
+            pool = self.server.pool
+            offset = random.randrange(len(pool))
+            body = b"".join(pool[(offset + i) % len(pool)] for i in range(number_of_logs))
+            raw_bytes = len(body)
+            accept_encoding = [encoding.split(";")[0].strip().lower() for encoding in self.headers.get("Accept-Encoding", "").split(",")]
+            compressed = self.server.compress is True and "gzip" in accept_encoding
+            if compressed is True:
+                body = gzip.compress(body, compresslevel=6)
+            with self.server.stats.lock:
+                self.server.stats.logs_generated += number_of_logs
+                self.server.stats.logpull_requests += 1
+                self.server.stats.logpull_wire_bytes += len(body)
+                self.server.stats.logpull_raw_bytes += raw_bytes
+            time.sleep(self.server.latency)
+
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        if compressed is True:
+            self.send_header("Content-Encoding", "gzip")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+'''
+The fake Elasticsearch. Every ingest pipeline exists and any username and password is accepted.
+A bulk request is rejected as a whole with 429 at the reject rate, and each log in it fails at the error rate,
+half of them with 429 (to be retried by the program) and half of them with a mapping error (to be written to the dead-letter file).
+A body compressed with gzip or deflate is decompressed first, according to its Content-Encoding, the same as Elasticsearch does.
+'''
+class BulkHandler(http.server.BaseHTTPRequestHandler):
+
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        self.reply(200, {"name": "bench", "version": {"number": "7.10.0"}})
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        if not urlparse(self.path).path.endswith("/_bulk"):
+            self.reply(404, {"error": {"root_cause": [{"type": "no_handler_found_exception", "reason": "no handler found for uri " + self.path}]}, "status": 404})
+            return
+
+        #47 lets zlib accept both the gzip and the zlib wrapper, the latter being what deflate means in HTTP
+        wire_bytes = len(body)
+        content_encoding = self.headers.get("Content-Encoding", "identity").lower()
+        if content_encoding in ("gzip", "deflate"):
+            try:
+                body = zlib.decompress(body, 47)
+            except zlib.error as e:
+                self.reply(400, {"error": {"root_cause": [{"type": "parse_exception", "reason": "failed to decompress the body: " + str(e)}]}, "status": 400})
+                return
+        elif content_encoding != "identity":
+            self.reply(415, {"error": {"root_cause": [{"type": "illegal_argument_exception", "reason": "unsupported Content-Encoding " + content_encoding}]}, "status": 415})
+            return
+
+        stats = self.server.stats
+        time.sleep(self.server.latency)
+        with stats.lock:
+            stats.bulk_requests += 1
+            stats.bulk_wire_bytes += wire_bytes
+            stats.bulk_raw_bytes += len(body)
+
+        if random.random() < self.server.reject_rate:
+            with stats.lock:
+                stats.bulk_rejected += 1
+            self.reply(429, {"error": {"root_cause": [{"type": "es_rejected_execution_exception", "reason": "rejected execution of bulk request"}], "type": "es_rejected_execution_exception", "reason": "rejected execution of bulk request"}, "status": 429})
+            return
+
+        #each action line is followed by the log, unless it's a delete
+        items = []
+        indexed = retryable = failed = 0
+        lines = body.split(b"\n")
+        i = 0
+        while i < len(lines):
+            if lines[i] == b"":
+                i += 1
+                continue
+            action = next(iter(json.loads(lines[i])))
+            i += 1 if action == "delete" else 2
+
+            if random.random() < self.server.error_rate:
+                if random.random() < 0.5:
+                    items.append({action: {"status": 429, "error": {"type": "es_rejected_execution_exception", "reason": "rejected execution of bulk shard request"}}})
+                    retryable += 1
+                else:
+                    items.append({action: {"status": 400, "error": {"type": "mapper_parsing_exception", "reason": "failed to parse field [EdgeResponseBytes] of type [long]"}}})
+                    failed += 1
+            else:
+                items.append({action: {"status": 201, "result": "created"}})
+                indexed += 1
+
+        with stats.lock:
+            stats.docs_indexed += indexed
+            stats.docs_retryable += retryable
+            stats.docs_failed += failed
+        self.reply(200, {"took": int(self.server.latency * 1000), "errors": retryable + failed > 0, "items": items})
+
+    def reply(self, status_code, response):
+        body = json.dumps(response).encode("utf-8")
+        self.send_response(status_code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+'''
+Start a server on a free port of localhost in the background, with the settings given as the attributes of the server
+'''
+def start_server(handler, **settings):
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    server.daemon_threads = True
+    for name, value in settings.items():
+        setattr(server, name, value)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+'''
+Read the buckets of the histograms from the metrics textfile written by the program, added up across the zones and other labels
+'''
+def read_histograms(metrics_path):
+    histograms = {}
+    with open(metrics_path, encoding="utf-8") as metrics_file:
+        for line in metrics_file:
+            match = re.match(r'^(\w+)_bucket\{(.*)\} (\S+)$', line.strip())
+            if match is None:
+                continue
+            bound = float(re.search(r'le="([^"]+)"', match.group(2)).group(1).replace("+Inf", "inf"))
+            buckets = histograms.setdefault(match.group(1), {})
+            buckets[bound] = buckets.get(bound, 0) + float(match.group(3))
+    return histograms
+
+'''
+Estimate a quantile from the cumulative buckets of a histogram, the same way as histogram_quantile() of Prometheus does
+'''
+def quantile(q, buckets):
+    bounds = sorted(buckets)
+    total = buckets[bounds[-1]]
+    if total == 0:
+        return None
+    rank = q * total
+    lower_bound = lower_count = 0.0
+    for bound in bounds:
+        if buckets[bound] >= rank:
+            if bound == float("inf"):
+                return lower_bound
+            return lower_bound + (bound - lower_bound) * (rank - lower_count) / max(buckets[bound] - lower_count, 1)
+        lower_bound, lower_count = bound, buckets[bound]
+    return lower_bound
+
+def main():
+    parser = argparse.ArgumentParser(description="End-to-end benchmark with a synthetic Logpull server and a fake Elasticsearch.")
+    parser.add_argument("--seconds", help="Number of seconds of logs to pull in one-time mode. Default is 600.", default=600, type=int)
+    parser.add_argument("--logs-per-second", help="Number of logs generated for each second of a log range. Default is 200.", default=200.0, type=float)
+    parser.add_argument("--fetch-latency", help="Latency in seconds of each request to the Logpull server. Default is 0.2.", default=0.2, type=float)
+    parser.add_argument("--bulk-latency", help="Latency in seconds of each bulk request to Elasticsearch. Default is 0.05.", default=0.05, type=float)
+    parser.add_argument("--reject-rate", help="Fraction of bulk requests rejected as a whole with 429. Default is 0.05.", default=0.05, type=float)
+    parser.add_argument("--error-rate", help="Fraction of logs failed in the bulk responses, half of them retryable. Default is 0.01.", default=0.01, type=float)
+    parser.add_argument("--no-logpull-compression", help="Answer the Logpull requests uncompressed even if the program asks for gzip, like a proxy which removes Accept-Encoding, to compare the bytes received.", action="store_true")
+    parser.add_argument("--pool", help="Number of distinct logs generated for the Logpull server to pick from. Default is 20000.", default=20000, type=int)
+    parser.add_argument("program_args", help="Arguments passed to the program, after --.", nargs=argparse.REMAINDER)
+    args = parser.parse_args()
+    program_args = args.program_args[1:] if args.program_args[:1] == ["--"] else args.program_args
+
+    stats = Stats()
+    pool = generate_logs(args.pool).splitlines(keepends=True)
+    logpull = start_server(LogpullHandler, stats=stats, pool=pool, logs_per_second=args.logs_per_second, latency=args.fetch_latency, compress=(args.no_logpull_compression is False))
+    elasticsearch = start_server(BulkHandler, stats=stats, latency=args.bulk_latency, reject_rate=args.reject_rate, error_rate=args.error_rate)
+
+    #pull the logs of a fixed time range in the past, so every run pulls the same log ranges
+    end_time = datetime(2020, 12, 31, 12, 0, 0)
+    start_time = end_time - timedelta(seconds=args.seconds)
+
+    with tempfile.TemporaryDirectory(prefix="cf_elk_bench_") as work_dir:
+        metrics_path = os.path.join(work_dir, "metrics.prom")
+        command = [sys.executable, PROGRAM, "-z", "bench", "-t", "bench", "-u", "bench", "-p", "bench",
+            "--cf-api-url", "http://127.0.0.1:" + str(logpull.server_port) + "/client/v4",
+            "--es-url", "http://127.0.0.1:" + str(elasticsearch.server_port),
+            "--one-time", "--start-time", start_time.isoformat() + "Z", "--end-time", end_time.isoformat() + "Z",
+            "--path", os.path.join(work_dir, "logs"), "--dead-letter", os.path.join(work_dir, "dead_letter.json"),
+            "--checkpoint", os.path.join(work_dir, "checkpoint.db"), "--metrics-textfile", metrics_path] + program_args
+
+        print("Pulling " + str(args.seconds) + " seconds of logs at " + str(args.logs_per_second) + " logs/s: " + " ".join(program_args))
+        start = time.perf_counter()
+        with open(os.path.join(work_dir, "output.log"), mode="w+", encoding="utf-8") as output:
+            result = subprocess.run(command, stdout=output, stderr=subprocess.STDOUT)
+            elapsed = time.perf_counter() - start
+            if result.returncode != 0 or not os.path.exists(metrics_path):
+                output.seek(0)
+                print(output.read()[-4000:])
+                print("The program exited with code " + str(result.returncode) + ".")
+                sys.exit(1)
+        histograms = read_histograms(metrics_path)
+
+    #ru_maxrss is in kilobytes on Linux. it's the peak of the largest process, i.e. the program or one of its transform workers
+    peak_rss = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024
+
+    print("Logs generated".ljust(45) + str(stats.logs_generated).rjust(12) + " in " + str(stats.logpull_requests) + " log ranges")
+    print("Logpull bytes received".ljust(45) + str(round(stats.logpull_wire_bytes / 1048576, 1)).rjust(12) + " MB (" + str(round(stats.logpull_raw_bytes / 1048576, 1)) + " MB uncompressed)")
+    print("Logs indexed".ljust(45) + str(stats.docs_indexed).rjust(12) + " (" + str(stats.docs_failed) + " failed permanently, " + str(stats.docs_retryable) + " retried)")
+    print("Bulk requests".ljust(45) + str(stats.bulk_requests).rjust(12) + " (" + str(stats.bulk_rejected) + " rejected with 429)")
+    print("Bulk bytes sent".ljust(45) + str(round(stats.bulk_wire_bytes / 1048576, 1)).rjust(12) + " MB (" + str(round(stats.bulk_raw_bytes / 1048576, 1)) + " MB uncompressed)")
+    print("Elapsed".ljust(45) + str(round(elapsed, 2)).rjust(12) + " s")
+    print("Throughput".ljust(45) + str(round(stats.docs_indexed / elapsed)).rjust(12) + " docs/s")
+    print("Peak RSS".ljust(45) + str(round(peak_rss, 1)).rjust(12) + " MB")
+    for name, metric in STAGES:
+        p99 = quantile(0.99, histograms[metric]) if metric in histograms else None
+        print(("p99 " + name).ljust(45) + (str(round(p99 * 1000, 1)).rjust(12) + " ms" if p99 is not None else "n/a".rjust(12)))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+
+'''
+A micro-benchmark for process_logs(), which builds the Elasticsearch bulk requests from the raw logs pulled from Cloudflare.
+It compares the current bytes-level implementation with the previous implementation, which decoded the raw logs to a string,
+inserted the metadata line by line, and encoded the result back to bytes before pushing it to Elasticsearch.
+
+Usage: python3 benchmarks/bench_process_logs.py [--lines 1000000] [--repeat 3]
+'''
+
+import argparse, json, os, random, sys, time
+
+#make the program importable from the benchmarks folder
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import cf_elk_pusher
+
+'''
+Generate raw logs that look like the logs pulled from Cloudflare, one JSON object per line
+'''
+def generate_logs(number_of_lines):
+    lines = []
+    for i in range(number_of_lines):
+        lines.append(json.dumps({
+            "CacheCacheStatus": random.choice(["hit", "miss", "dynamic", "expired"]),
+            "ClientCountry": random.choice(["us", "sg", "de", "jp", "br"]),
+            "ClientIP": "203.0.113." + str(random.randint(1, 254)),
+            "ClientRequestHost": "www.example.com",
+            "ClientRequestMethod": "GET",
+            "ClientRequestURI": "/static/" + str(random.getrandbits(32)) + ".js",
+            "ClientRequestUserAgent": "Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0 Safari/537.36",
+            "EdgeColoCode": random.choice(["SIN", "FRA", "SJC", "NRT"]),
+            "EdgeResponseBytes": random.randint(200, 200000),
+            "EdgeResponseStatus": random.choice([200, 200, 200, 304, 404, 503]),
+            "EdgeStartTimestamp": "2020-12-31T12:34:56Z",
+            "OriginResponseTime": random.randint(0, 900000000),
+            "RayID": "%016x" % random.getrandbits(64),
+        }, separators=(",", ":")))
+    return ("\n".join(lines) + "\n").encode("utf-8")
+
+'''
+The previous implementation of process_logs(), kept here as the baseline.
+The encode() at the end is what the Requests library did to the string before sending it to Elasticsearch.
+'''
+def legacy_process_logs(response):
+    response = response.decode("utf-8")
+    final_json = []
+    number_of_logs = 0
+
+    metadata = '{ "index": { "_index": "cloudflare" }}\n'
+
+    for line in response.split("\n"):
+        if (line == ""):
+            pass
+        else:
+            final_json.append(metadata)
+            final_json.append(line + "\n")
+            number_of_logs += 1
+
+    return ''.join(final_json).encode("utf-8"), number_of_logs
+
+'''
+Run the function for a few times and return the best time, to reduce the noise from other processes
+'''
+def measure(function, data, repeat):
+    best = None
+    for i in range(repeat):
+        start = time.perf_counter()
+        function(data)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+def main():
+    parser = argparse.ArgumentParser(description="Micro-benchmark for building Elasticsearch bulk requests from raw Cloudflare logs.")
+    parser.add_argument("--lines", help="Number of log lines in the generated log range. Default is 1000000.", default=1000000, type=int)
+    parser.add_argument("--repeat", help="Number of runs for each implementation, the best one is reported. Default is 3.", default=3, type=int)
+    args = parser.parse_args()
+
+    #the chunk limits are set high enough to build a single chunk, so the result can be compared with the previous implementation
+    cf_elk_pusher.bulk_max_docs = args.lines
+    cf_elk_pusher.bulk_max_bytes = 1 << 40
+    cf_elk_pusher.bulk_sizer = cf_elk_pusher.BulkSizer()
+
+    data = generate_logs(args.lines)
+    print("Generated " + str(args.lines) + " lines, " + str(round(len(data) / 1024 / 1024, 1)) + " MB of raw logs.")
+
+    #make sure both implementations build the same bulk request before comparing them
+    expected, expected_count = legacy_process_logs(data)
+    chunks, number_of_logs = cf_elk_pusher.process_logs(data)
+    if number_of_logs != expected_count or b"".join(chunk for chunk, count in chunks) != expected:
+        print("The bulk request built by process_logs() does not match the previous implementation.")
+        sys.exit(1)
+
+    results = [("legacy (str, decode/encode)", measure(legacy_process_logs, data, args.repeat)), ("process_logs (bytes)", measure(cf_elk_pusher.process_logs, data, args.repeat))]
+
+    #the same with the document ID taken from RayID, which needs the metadata to be built for each log
+    #it's about as fast as the previous implementation, not faster: finding the RayIDs with a regular expression takes as long as decoding the logs, and each log needs its own bytes object again
+    cf_elk_pusher.doc_id_mode = "rayid"
+    results.append(("process_logs (bytes, --doc-id rayid)", measure(cf_elk_pusher.process_logs, data, args.repeat)))
+
+    #and with the default chunk limits, to include the cost of splitting the log range into chunks
+    cf_elk_pusher.doc_id_mode = "none"
+    cf_elk_pusher.bulk_max_docs = 5000
+    cf_elk_pusher.bulk_max_bytes = 10 * 1024 * 1024
+    cf_elk_pusher.bulk_sizer = cf_elk_pusher.BulkSizer()
+    results.append(("process_logs (bytes, 5000 logs per chunk)", measure(cf_elk_pusher.process_logs, data, args.repeat)))
+
+    baseline = results[0][1]
+    for name, elapsed in results:
+        print(name.ljust(45) + str(round(elapsed * 1000, 1)).rjust(10) + " ms" + str(round(args.lines / elapsed / 1000000, 2)).rjust(10) + " M lines/s" + str(round(baseline / elapsed, 2)).rjust(8) + "x")
+
+if __name__ == "__main__":
+    main()
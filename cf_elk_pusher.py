@@ -2,19 +2,63 @@
 
 #import libraries needed in this program
 #'requests' library needs to be installed first
-import requests, time, threading, os, json, logging, sys, argparse, logging.handlers
-from datetime import datetime, date, timedelta
+import requests, asyncio, time, math, threading, queue, random, hashlib, gzip, os, json, logging, sys, argparse, sqlite3, signal, zlib, re, functools, multiprocessing.managers, importlib.util, http.server, atexit, email.utils, logging.handlers
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from datetime import datetime, date, timedelta, timezone
 from pathlib import Path
+from requests.adapters import HTTPAdapter
 from requests.packages.urllib3.exceptions import InsecureRequestWarning
+from requests.packages.urllib3.util.retry import Retry
+
+#zstandard library is optional, it's only needed if the user wants to compress the raw logs in zstd format
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+#geoip2 library is optional, it's only needed if the user wants to look up the location or ASN of the client IP before pushing the logs
+try:
+    import geoip2.database, geoip2.errors
+except ImportError:
+    geoip2 = None
+
+#aiohttp library is optional, it's only needed if the user wants to run the asyncio engine
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+#pyarrow library is optional, it's only needed if the user wants to store the raw logs as Parquet files, or to export them
+try:
+    import pyarrow, pyarrow.compute, pyarrow.csv, pyarrow.dataset, pyarrow.json, pyarrow.parquet
+except ImportError:
+    pyarrow = None
 
 #specify version number of the program
 ver_num = "1.32"
 
-#a flag to determine whether the user wants to exit the program, so can handle the program exit gracefully
-is_exit = False
+#once the program is asked to exit, the workers are given this many seconds to finish the log ranges in progress, before the logs not pushed yet are saved to the spool
+drain_timeout = 30.0
+
+#the number of worker threads to pull logs from Cloudflare and to push logs to Elasticsearch
+fetch_workers = 4
+push_workers = 4
+
+#the engine that runs the workers. "threads" runs each worker in its own thread, "asyncio" runs them as tasks of an event loop with async HTTP clients
+engine = "threads"
+async_engine = None
+
+#the maximum number of pending items in the queues between the scheduler, the fetch workers and the push workers
+#once a queue is full, the stage before it will wait, so the memory usage and the number of open connections stay bounded
+queue_size = 8
+
+#the queues between the scheduler and the fetch workers, and between the fetch workers and the push workers
+fetch_queue = None
+push_queue = None
 
-#determine how many logpush process are running
-num_of_running_thread = 0
+#how often the scheduler prints the queue depth and lag, in seconds
+status_interval = 60.0
 
 #define the timestamp format that we supply to Cloudflare API
 timestamp_format = "rfc3339"
@@ -32,6 +76,138 @@ interval = 60.0
 #specify the number of attempts to retry in the event of error
 retry_attempt = 5
 
+#the name of the Elasticsearch index, and the bulk action to be used for each log
+index_name = "cloudflare"
+op_type = "index"
+
+#how the document ID of each log is generated. by default, Elasticsearch generates a new ID for each log, so pushing the same log again will create a duplicate
+#"rayid" uses the RayID field of the log, and "hash" uses a hash of the fields listed in doc_id_fields (or the whole log if no fields are listed)
+doc_id_mode = "none"
+doc_id_fields = []
+
+#the metadata line for each log, when the document ID is generated by Elasticsearch, and the beginning of the metadata line when the document ID is given
+bulk_metadata = b'{ "index": { "_index": "cloudflare" }}\n'
+bulk_action_prefix = b'{ "index": { "_index": "cloudflare", "_id": "'
+
+#the logs that Elasticsearch refuses to index permanently will be written to this file, instead of being retried
+dead_letter_path = "/var/log/cf_elk_push/dead_letter.json"
+dead_letter_lock = threading.Lock()
+
+#streaming mode settings. when streaming mode is enabled, logs will be read from Cloudflare line by line and pushed to Elasticsearch in bounded chunks
+stream_mode = False
+
+#the logs of a log range will be split into chunks, and the chunks are pushed to Elasticsearch concurrently by the push workers
+#a chunk will be pushed as soon as it reaches either the maximum size in bytes or the maximum number of logs
+bulk_max_bytes = 10 * 1024 * 1024
+bulk_max_docs = 5000
+
+#the body of each bulk request can be compressed with gzip or deflate before it's sent, as the logs compress very well and the network is often the limit to a remote cluster
+#the chunks are kept uncompressed until they are pushed, so the logs to be retried can still be picked out of them. level 1 is the fastest
+bulk_compression = "none"
+bulk_compression_level = 1
+
+#adaptive chunk sizing settings. when enabled, the maximum number of logs in each chunk will be adjusted based on how Elasticsearch responds
+#it grows slowly while Elasticsearch responds within the target latency, and shrinks quickly when Elasticsearch is slow or rejects the requests
+adaptive_bulk = False
+bulk_min_docs = 100
+bulk_target_latency = 2.0
+bulk_sizer = None
+
+#the maximum number of connections kept alive in each connection pool. if not specified, it follows the number of workers
+pool_size = None
+
+#the zones to pull logs from. by default there's only one zone given by the user, or multiple zones can be given in a config file
+#all the zones share the same workers and HTTP sessions
+zones = []
+zones_config = None
+
+#the state of each log range is saved in the checkpoint file, so the log ranges missed while the program was not running, or the ones that failed, can be pulled again once the program starts
+#only the log ranges within the maximum age will be pulled again, and the catch-up rate limits how many of them are handed to the fetch workers per minute
+checkpoint = None
+checkpoint_path = "/var/log/cf_elk_push/checkpoint.db"
+backfill_max_age = 72.0
+backfill_interval = 3600.0
+catchup_limiter = None
+
+#the chunks that cannot be pushed to Elasticsearch after all the retries are saved to the spool on local storage, and pushed again in the background once Elasticsearch recovers
+#the spool is made of segment files of a bounded size, up to the maximum size in total. the chunks are pushed again in order, no faster than the replay rate in bulk requests per minute
+spool = None
+spool_path = None
+spool_segment_size = 64 * 1024 * 1024
+spool_max_size = 10 * 1024 * 1024 * 1024
+spool_replay_rate = 120.0
+spool_retry_delay = 30.0
+spool_max_attempts = 20
+
+#for one-time operation, the time range given by the user is split into log ranges of this size in seconds, which are pulled concurrently by the fetch workers
+#the progress is kept to report how many log ranges have been done and how fast the logs are pulled
+shard_size = 300.0
+backfill_progress = None
+
+#in replay mode, the raw logs saved on local storage within the time range given by the user are pushed to Elasticsearch again, without pulling them from Cloudflare
+#the logfiles are read and decompressed by a pool of processes, in blocks of this size in bytes
+replay_mode = False
+replay_workers = 0
+replay_block_size = 8 * 1024 * 1024
+
+#adaptive window sizing settings. when enabled, the size of each log range is adjusted based on the number of logs per second seen in the recent log ranges of the zone
+#the log ranges are split during traffic spikes to stay within the target number of logs and bytes, and merged during quiet periods, between the minimum and maximum size in seconds
+adaptive_window = False
+window_target_logs = 50000
+window_target_bytes = 50 * 1024 * 1024
+window_min = 10.0
+window_max = 900.0
+
+#the maximum number of requests per minute to Cloudflare API for each zone, unless specified for the zone in the config file. None means no limit
+requests_per_minute = None
+
+#the maximum number of requests per minute to Cloudflare API shared by all the zones, which follows the global rate limit of Cloudflare API (1200 requests per 5 minutes) by default. 0 means no limit
+#every request to Cloudflare API goes through the scheduler, which keeps both limits and pauses a zone when Cloudflare tells us to slow down
+cf_requests_per_minute = 240.0
+cf_scheduler = None
+
+#the ingest pipeline given by the user, instead of the daily or weekly Cloudflare pipeline. an empty string means no pipeline will be used
+pipeline_name = None
+
+#the settings of the transform stage, which changes the logs before they are pushed to Elasticsearch, so less work needs to be done by the ingest pipeline
+#None means the logs are pushed as they are. the transform stage runs in a pool of processes, unless the number of transform workers is 0
+transform_settings = None
+transform_workers = 0
+transform_pool = None
+log_transformer = None
+
+#the settings of the rollup stage. when enabled, the logs are summarized per rollup window into the number of requests, the bytes and the percentiles of the origin response time,
+#grouped by the rollup fields, and the rollups are pushed to their own index. only this fraction of the raw logs is pushed alongside them, 0 means none
+rollup_mode = False
+rollup_index = "cloudflare-rollup"
+rollup_window = 60.0
+rollup_fields = ["EdgeResponseStatus", "ClientCountry", "EdgeColoCode", "CacheCacheStatus", "ClientRequestHost"]
+rollup_raw_rate = 0.0
+rollup_action_prefix = b'{ "index": { "_index": "cloudflare-rollup", "_id": "'
+
+#the HTTP sessions shared by all the workers, one for Cloudflare API and one for Elasticsearch
+#they keep the connections alive and reuse them, so we don't need to do TCP and TLS handshake on every request
+cf_session = es_session = None
+
+#the responses from Cloudflare API are asked to be compressed with Accept-Encoding, and a warning is given once for each zone if they are not
+cf_accept_encoding = "gzip, deflate"
+
+#the URLs that are used on every request, they will be built once the parameters are initialized
+es_base_url = es_pipeline = ""
+
+#the base URLs of Cloudflare API and Elasticsearch. they can be pointed somewhere else, e.g. to a proxy or to the stand-ins of the benchmark
+cf_api_url = "https://api.cloudflare.com/client/v4"
+es_url = None
+
+#the Elasticsearch nodes that the bulk requests are spread across. they are the URLs given by the user, or discovered from the cluster with _nodes/http
+#each bulk request is sent to the next node in turn (round-robin), or to the node with the fewest bulk requests in progress (least-outstanding)
+#the nodes are checked every health check interval in seconds, and a node that is down is not used until it recovers
+es_urls = []
+es_nodes = None
+es_discover = False
+es_balance = "round-robin"
+es_health_interval = 10.0
+
 #disable unverified HTTPS request warning in when using Requests library
 requests.packages.urllib3.disable_warnings(InsecureRequestWarning)
 
@@ -41,6 +217,25 @@ requests.packages.urllib3.disable_warnings(InsecureRequestWarning)
 #logpush operation will be repeated unless user specifies to do one-time operation
 no_store = store_only = daily_pipeline = one_time = no_organize = no_gzip = False
 
+#the format and level of compression of the raw logs stored on local storage. the raw logs are compressed while they are being written, in a separate thread
+compression = "gzip"
+compression_level = None
+
+#the format of the raw logs stored on local storage. "json" stores the raw logs of each log range as they are, "parquet" stores them as a Parquet file with a column for each field,
+#in a folder for each hour of the logs (date=YYYY-MM-DD/hour=HH). the Parquet files of each hour are merged into one every compaction interval in seconds, 0 means never
+archive_format = "json"
+compact_interval = 3600.0
+
+#the time ranges of the Parquet files in each hour folder, so the folder is not listed for every log range to find out whether a merged logfile covers it
+#each folder is listed once when it's first needed, and its time ranges are replaced by the ones of the merged logfiles once it has been compacted
+archive_ranges = {}
+archive_ranges_lock = threading.Lock()
+
+#in export mode, the logs stored as Parquet files within the time range given by the user are written to the export file, with only the columns and the logs asked for
+export_path = None
+export_columns = []
+export_filters = []
+
 '''
 Specify the fields for the logs
 
@@ -48,6 +243,14 @@ The following fields are available: BotScore,BotScoreSrc,CacheCacheStatus,CacheR
 '''
 fields = "BotScore,BotScoreSrc,CacheCacheStatus,CacheResponseBytes,CacheResponseStatus,CacheTieredFill,ClientASN,ClientCountry,ClientDeviceType,ClientIP,ClientIPClass,ClientRequestBytes,ClientRequestHost,ClientRequestMethod,ClientRequestPath,ClientRequestProtocol,ClientRequestReferer,ClientRequestURI,ClientRequestUserAgent,ClientSSLCipher,ClientSSLProtocol,ClientSrcPort,ClientXRequestedWith,EdgeColoCode,EdgeColoID,EdgeEndTimestamp,EdgePathingOp,EdgePathingSrc,EdgePathingStatus,EdgeRateLimitAction,EdgeRateLimitID,EdgeRequestHost,EdgeResponseBytes,EdgeResponseCompressionRatio,EdgeResponseContentType,EdgeResponseStatus,EdgeServerIP,EdgeStartTimestamp,FirewallMatchesActions,FirewallMatchesRuleIDs,FirewallMatchesSources,OriginIP,OriginResponseBytes,OriginResponseHTTPExpires,OriginResponseHTTPLastModified,OriginResponseStatus,OriginResponseTime,OriginSSLProtocol,ParentRayID,RayID,RequestHeaders,SecurityLevel,WAFAction,WAFFlags,WAFMatchedVar,WAFProfile,WAFRuleID,WAFRuleMessage,WorkerCPUTime,WorkerStatus,WorkerSubrequest,WorkerSubrequestCount,ZoneID"
 
+#the type of each field in the Parquet files, the fields not listed here are strings. the "object" fields hold a JSON object, which is kept as JSON text
+archive_field_types = {
+    "BotScore": "int", "CacheResponseBytes": "int", "CacheResponseStatus": "int", "CacheTieredFill": "bool", "ClientASN": "int", "ClientRequestBytes": "int", "ClientSrcPort": "int",
+    "EdgeColoID": "int", "EdgeEndTimestamp": "timestamp", "EdgeRateLimitID": "int", "EdgeResponseBytes": "int", "EdgeResponseCompressionRatio": "float", "EdgeResponseStatus": "int",
+    "EdgeStartTimestamp": "timestamp", "FirewallMatchesActions": "list", "FirewallMatchesRuleIDs": "list", "FirewallMatchesSources": "list", "OriginResponseBytes": "int",
+    "OriginResponseStatus": "int", "OriginResponseTime": "int", "RequestHeaders": "object", "WorkerCPUTime": "int", "WorkerSubrequest": "bool", "WorkerSubrequestCount": "int", "ZoneID": "int",
+}
+
 #create three logging object for logging purposes
 logger = logging.getLogger("general_logger") #for general logging
 succ_logger = logging.getLogger("succ_logger") #to log successful attempts
@@ -58,30 +261,222 @@ logger.setLevel(logging.INFO)
 succ_logger.setLevel(logging.INFO)
 fail_logger.setLevel(logging.INFO)
 
-#create handlers to write logs to local storage, and automatically rotate them
-Path("/var/log/cf_elk_push/").mkdir(parents=True, exist_ok=True)
-handler_file = logging.handlers.TimedRotatingFileHandler("/var/log/cf_elk_push/push.log", when='H', interval=1, backupCount=120, utc=False, encoding="utf-8") #rotate hourly, store up to 120 hours
-succ_handler_file = logging.handlers.TimedRotatingFileHandler("/var/log/cf_elk_push/succ.log", when='D', interval=1, backupCount=30, utc=False, encoding="utf-8") #rotate daily, store up to 30 days
-fail_handler_file = logging.handlers.TimedRotatingFileHandler("/var/log/cf_elk_push/fail.log", when='D', interval=1, backupCount=30, utc=False, encoding="utf-8") #rotate daily, store up to 30 days
+#the handlers of the loggers, they will be created once the program starts
+handler_file = succ_handler_file = fail_handler_file = handler_console = None
+
+#the format of the logs, either text or json. the logs can also be written by a background thread, and the logs printed on terminal can be turned off
+log_format = "text"
+async_logging = False
+no_console = False
+
+'''
+This class formats the logs as text, with the log level and the time the log is created, followed by the message.
+The message is only built from its arguments here, so a log which is not going to be written costs nothing more than the call.
+'''
+class TextFormatter(logging.Formatter):
+    
+    def __init__(self):
+        super().__init__("[%(levelname)s] %(asctime)s --- %(message)s")
+    
+    def formatTime(self, record, datefmt=None):
+        return str(datetime.fromtimestamp(record.created))
+
+'''
+This class formats each log as a JSON object on a single line, so the logs can be shipped and searched without parsing the message.
+'''
+class JsonFormatter(logging.Formatter):
+    
+    def format(self, record):
+        log = {"time": datetime.fromtimestamp(record.created).isoformat(), "level": record.levelname, "logger": record.name, "thread": record.threadName, "message": record.getMessage()}
+        #the traceback may have been turned into text already by AsyncLogHandler
+        if record.exc_info:
+            log["exception"] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            log["exception"] = record.exc_text
+        return json.dumps(log, ensure_ascii=False)
+
+'''
+This class puts the logs into a queue, to be written by a background thread instead of the worker which logs it.
+Unlike QueueHandler, the message is built by the background thread if the arguments of the log are plain values (strings, numbers and the like), which cannot be changed after they are logged.
+Otherwise, e.g. a list or an exception, the message is built before the record is queued. The traceback is also turned into text first, so the record holds no references to the frames.
+'''
+class AsyncLogHandler(logging.handlers.QueueHandler):
+    
+    immutable_types = (str, int, float, bool, bytes, type(None))
+    traceback_formatter = logging.Formatter()
+    
+    def prepare(self, record):
+        if record.args and not all(isinstance(arg, self.immutable_types) for arg in (record.args.values() if isinstance(record.args, dict) else record.args)):
+            record.msg = record.getMessage()
+            record.args = None
+        if record.exc_info:
+            if not record.exc_text:
+                record.exc_text = self.traceback_formatter.formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+'''
+This class is a metric to be exported in Prometheus text format, either a counter, a gauge or a histogram.
+Each metric keeps a value (or the buckets of a histogram) for each combination of labels, e.g. for each zone.
+A gauge may also be given a function, which is called to get the current value every time the metrics are exported.
+'''
+class Metric:
+    
+    #the default buckets of a histogram, in seconds
+    default_buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0)
+    
+    def __init__(self, name, kind, description, buckets=None, function=None):
+        self.name = name
+        self.kind = kind
+        self.description = description
+        self.buckets = (buckets or self.default_buckets) if kind == "histogram" else None
+        self.function = function
+        self.values = {}
+        self.lock = threading.Lock()
+        metrics.append(self)
+    
+    def inc(self, value=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + value
+    
+    def set(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            self.values[key] = value
+    
+    #add a value to the histogram. the counts of the buckets are kept as is, and added up when they are exported
+    def observe(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            counts = self.values.get(key)
+            if counts is None:
+                counts = self.values[key] = [0] * (len(self.buckets) + 1) + [0.0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+                    break
+            else:
+                counts[len(self.buckets)] += 1
+            counts[-1] += value
+    
+    @staticmethod
+    def format_labels(key, extra=()):
+        labels = list(key) + list(extra)
+        if len(labels) == 0:
+            return ""
+        return "{" + ",".join(name + '="' + str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") + '"' for name, value in labels) + "}"
+    
+    def render(self):
+        lines = ["# HELP " + self.name + " " + self.description, "# TYPE " + self.name + " " + self.kind]
+        with self.lock:
+            values = dict(self.values)
+        if self.function is not None:
+            values = self.function()
+        
+        for key, value in sorted(values.items()):
+            if self.kind == "histogram":
+                cumulative = 0
+                for i, bound in enumerate(self.buckets):
+                    cumulative += value[i]
+                    lines.append(self.name + "_bucket" + self.format_labels(key, [("le", repr(bound))]) + " " + str(cumulative))
+                cumulative += value[len(self.buckets)]
+                lines.append(self.name + "_bucket" + self.format_labels(key, [("le", "+Inf")]) + " " + str(cumulative))
+                lines.append(self.name + "_sum" + self.format_labels(key) + " " + repr(float(value[-1])))
+                lines.append(self.name + "_count" + self.format_labels(key) + " " + str(cumulative))
+            else:
+                lines.append(self.name + self.format_labels(key) + " " + repr(float(value)))
+        return lines
+
+#all the metrics, in the order they are exported
+metrics = []
+
+#the metrics of each stage of the program. most of them are labelled by the zone
+metric_fetch_seconds = Metric("cf_elk_fetch_seconds", "histogram", "Time taken by each request to Cloudflare API, until the response (or the headers of the response in streaming mode) is received.")
+metric_fetch_bytes = Metric("cf_elk_fetch_bytes_total", "counter", "Bytes of raw logs pulled from Cloudflare.")
+metric_fetch_wire_bytes = Metric("cf_elk_fetch_wire_bytes_total", "counter", "Bytes of responses received from Cloudflare over the network, before they are decompressed.")
+metric_fetch_logs = Metric("cf_elk_fetch_logs_total", "counter", "Number of logs pulled from Cloudflare.")
+metric_process_seconds = Metric("cf_elk_process_seconds", "histogram", "Time taken to build the bulk requests from the raw logs of a log range.")
+metric_compress_seconds = Metric("cf_elk_compress_seconds", "histogram", "Time taken to write and compress the raw logs of a log range to local storage.")
+metric_bulk_seconds = Metric("cf_elk_bulk_seconds", "histogram", "Time taken by each bulk request to Elasticsearch.")
+metric_bulk_bytes = Metric("cf_elk_bulk_bytes_total", "counter", "Bytes of bulk requests sent to Elasticsearch, before (stage=raw) and after (stage=wire) they are compressed.")
+metric_bulk_docs = Metric("cf_elk_bulk_docs_total", "counter", "Number of logs indexed by Elasticsearch.")
+metric_bulk_rejected_docs = Metric("cf_elk_bulk_rejected_docs_total", "counter", "Number of logs rejected by Elasticsearch, either to be retried or written to the dead-letter file.")
+metric_retries = Metric("cf_elk_retries_total", "counter", "Number of retries of requests to Cloudflare API (stage=fetch) and bulk requests to Elasticsearch (stage=bulk).")
+metric_fetch_throttled = Metric("cf_elk_fetch_throttled_total", "counter", "Number of requests to Cloudflare API rejected with HTTP 429.")
+metric_log_ranges = Metric("cf_elk_log_ranges_total", "counter", "Number of log ranges finished, by result.")
+metric_ingest_lag = Metric("cf_elk_ingest_lag_seconds", "gauge", "How far the end of the latest log range pushed to Elasticsearch is behind the current time.")
+metric_schedule_lag = Metric("cf_elk_schedule_lag_seconds", "gauge", "How long the latest log range handed to the fetch workers has been waiting since it was due.")
+metric_spool_chunks = Metric("cf_elk_spool_chunks_total", "counter", "Number of chunks saved to the spool (result=saved), pushed from the spool (result=replayed) and given up after the maximum attempts (result=dead_lettered).")
+metric_spool_bytes = Metric("cf_elk_spool_bytes", "gauge", "Size in bytes of the segment files in the spool.", function=lambda: {(): spool.size if spool is not None else 0})
+metric_spool_replayer_up = Metric("cf_elk_spool_replayer_up", "gauge", "Whether the thread pushing the logs in the spool is running.", function=lambda: {(): int(spool.thread.is_alive())} if spool is not None else {})
+metric_in_flight = Metric("cf_elk_log_ranges_in_flight", "gauge", "Number of log ranges being pulled or pushed.", function=lambda: {(): lifecycle.in_flight})
+metric_es_node_up = Metric("cf_elk_es_node_up", "gauge", "Whether the Elasticsearch node is used for bulk requests.", function=lambda: {(("node", node["url"]),): int(node["healthy"]) for node in (es_nodes.nodes if es_nodes is not None else [])})
+metric_queue_depth = Metric("cf_elk_queue_depth", "gauge", "Number of items waiting in the queues between the stages.", function=lambda: {(("queue", "fetch"),): fetch_queue.qsize() if fetch_queue is not None else 0, (("queue", "push"),): push_queue.qsize() if push_queue is not None else 0})
+
+#the port to export the metrics at /metrics, and the file to write the metrics to regularly (e.g. for the textfile collector of node_exporter). None means disabled
+metrics_port = None
+metrics_textfile = None
+metrics_textfile_interval = 15.0
+
+'''
+This method creates the handlers for the loggers, to write the logs to local storage and to print them on terminal.
+It is invoked at the beginning of the program, so the program can also be imported (e.g. by the benchmarks) without creating any logfile.
+'''
+def initialize_logger():
+    
+    global handler_file, succ_handler_file, fail_handler_file, handler_console
+    
+    #create handlers to write logs to local storage, and automatically rotate them
+    Path("/var/log/cf_elk_push/").mkdir(parents=True, exist_ok=True)
+    handler_file = logging.handlers.TimedRotatingFileHandler("/var/log/cf_elk_push/push.log", when='H', interval=1, backupCount=120, utc=False, encoding="utf-8") #rotate hourly, store up to 120 hours
+    succ_handler_file = logging.handlers.TimedRotatingFileHandler("/var/log/cf_elk_push/succ.log", when='D', interval=1, backupCount=30, utc=False, encoding="utf-8") #rotate daily, store up to 30 days
+    fail_handler_file = logging.handlers.TimedRotatingFileHandler("/var/log/cf_elk_push/fail.log", when='D', interval=1, backupCount=30, utc=False, encoding="utf-8") #rotate daily, store up to 30 days
+
+    #create a handler to print logs on terminal
+    handler_console = logging.StreamHandler()
 
-#create a handler to print logs on terminal
-handler_console = logging.StreamHandler()
+    #define the format of the logs for any logging event occurs
+    formatter = TextFormatter() #print log level and time with message
+    succfail_formatter = logging.Formatter("%(message)s") #print message only
 
-#define the format of the logs for any logging event occurs
-formatter = logging.Formatter("[%(levelname)s] %(message)s") #print log level with message
-succfail_formatter = logging.Formatter("%(message)s") #print message only
+    #set the log format for all the handlers
+    handler_file.setFormatter(formatter)
+    handler_console.setFormatter(formatter)
+    succ_handler_file.setFormatter(succfail_formatter)
+    fail_handler_file.setFormatter(succfail_formatter)
 
-#set the log format for all the handlers
-handler_file.setFormatter(formatter)
-handler_console.setFormatter(formatter)
-succ_handler_file.setFormatter(succfail_formatter)
-fail_handler_file.setFormatter(succfail_formatter)
+    #finally, add all handlers to their respective loggers
+    logger.addHandler(handler_file)
+    logger.addHandler(handler_console)
+    succ_logger.addHandler(succ_handler_file)
+    fail_logger.addHandler(fail_handler_file)
 
-#finally, add all handlers to their respective loggers
-logger.addHandler(handler_file)
-logger.addHandler(handler_console)
-succ_logger.addHandler(succ_handler_file)
-fail_logger.addHandler(fail_handler_file)
+'''
+This method will be invoked after initialize_arg().
+It applies the settings of the logs given by the user: the format of the logs, whether they are printed on terminal, and whether they are written by a background thread.
+'''
+def initialize_log_output():
+    
+    if log_format == "json":
+        for handler in (handler_file, handler_console, succ_handler_file, fail_handler_file):
+            handler.setFormatter(JsonFormatter())
+    
+    if no_console is True:
+        logger.removeHandler(handler_console)
+    
+    #each logger gets its own queue and background thread, which writes the logs to the handlers of the logger
+    #the background threads are stopped when the program exits, after the logs left in the queues are written
+    if async_logging is True:
+        for logger_object in (logger, succ_logger, fail_logger):
+            handlers = list(logger_object.handlers)
+            log_queue = queue.SimpleQueue()
+            listener = logging.handlers.QueueListener(log_queue, *handlers, respect_handler_level=True)
+            for handler in handlers:
+                logger_object.removeHandler(handler)
+            logger_object.addHandler(AsyncLogHandler(log_queue))
+            listener.start()
+            atexit.register(listener.stop)
 
 '''
 This is the starting point of the program. It will initialize the parameters supplied by the user and save it in a variable.
@@ -90,7 +485,7 @@ If required parameters are not given by the user, an error message will be displ
 '''
 def initialize_arg():
     
-    global path, zone_id, access_token, username, password, sample_rate, interval, no_store, logger, daily_pipeline, port, logfile_name_prefix, start_time_static, end_time_static, one_time, http_proto, store_only, no_organize, no_gzip
+    global path, zone_id, access_token, username, password, sample_rate, interval, no_store, logger, daily_pipeline, port, logfile_name_prefix, start_time_static, end_time_static, one_time, http_proto, store_only, no_organize, no_gzip, stream_mode, bulk_max_bytes, bulk_max_docs, adaptive_bulk, bulk_min_docs, bulk_target_latency, bulk_sizer, fetch_workers, push_workers, queue_size, status_interval, pool_size, engine, drain_timeout, dead_letter_path, zones_config, checkpoint_path, backfill_max_age, backfill_interval, catchup_limiter, shard_size, requests_per_minute, cf_requests_per_minute, adaptive_window, window_target_logs, window_target_bytes, window_min, window_max, pipeline_name, transform_settings, transform_workers, spool_path, spool_segment_size, spool_max_size, spool_replay_rate, spool_max_attempts, metrics_port, metrics_textfile, cf_api_url, es_url, es_urls, es_discover, es_balance, es_health_interval, bulk_compression, bulk_compression_level, replay_mode, replay_workers, rollup_mode, rollup_index, rollup_window, rollup_fields, rollup_raw_rate, rollup_action_prefix, archive_format, compact_interval, export_path, export_columns, export_filters, log_format, async_logging, no_console, compression, compression_level, op_type, doc_id_mode, doc_id_fields, bulk_metadata, bulk_action_prefix
     
     welcome_msg = "A utility to pull logs from Cloudflare, process it and push them to Elasticsearch."
 
@@ -99,6 +494,7 @@ def initialize_arg():
     
     #specify which arguments are available to use in this program. The usage of the arguments will be printed when the user tells the program to display help message.
     parser.add_argument("-z", "--zone", help="Specify the Cloudflare Zone ID, if CF_ZONE_ID environment variable not set. This will override CF_ZONE_ID variable.")
+    parser.add_argument("--zones-config", help="Specify a JSON file with a list of zones to pull logs from, each with its own Zone ID, and optionally its own name, access token, sample rate, fields, ingest pipeline and rate limit. All the zones share the same workers and connections.")
     parser.add_argument("-t", "--token", help="Specify your Cloudflare Access Token, if CF_TOKEN environment variable not set. This will override CF_TOKEN variable.")
     parser.add_argument("-u", "--username", help="Specify the username to push logs to Elasticsearch, if ELASTIC_USERNAME environment variable not set. This will override ELASTIC_USERNAME variable.")
     parser.add_argument("-p", "--password", help="Specify the password to push logs to Elasticsearch, if ELASTIC_PASSWORD environment variable not set. This will override ELASTIC_PASSWORD variable.")
@@ -106,16 +502,87 @@ def initialize_arg():
     parser.add_argument("-r", "--rate", help="Specify the log sampling rate from 0.01 to 1. Default is 1.", default="1")
     parser.add_argument("-i", "--interval", help="Specify the interval between each logpull in seconds. Default is 60 seconds.", default=60.0, type=float)
     parser.add_argument("--https", help="Enables the use of HTTPS for connection to Elasticsearch.", action="store_true")
+    parser.add_argument("--es-url", help="Specify the URL of Elasticsearch, if it's not listening on localhost. This will override --port and --https. Multiple URLs can be given separated by commas, then the bulk requests are spread across them. Example: https://es1.example.com:9200,https://es2.example.com:9200")
+    parser.add_argument("--es-discover", help="Discover the ingest nodes of the Elasticsearch cluster with the nodes info API, and spread the bulk requests across them. The list of nodes is refreshed on every health check.", action="store_true")
+    parser.add_argument("--es-balance", help="Specify how a node is picked for each bulk request when there are multiple Elasticsearch nodes. round-robin picks the nodes in turn, least-outstanding picks the node with the fewest bulk requests in progress. Default is round-robin.", choices=["round-robin", "least-outstanding"], default="round-robin")
+    parser.add_argument("--es-health-interval", help="Specify how often in seconds the Elasticsearch nodes are checked when there are multiple of them. A node that is down is not used until it passes the check again. Default is 10 seconds.", default=10.0, type=float)
+    parser.add_argument("--cf-api-url", help="Specify the base URL of Cloudflare API. Default is https://api.cloudflare.com/client/v4", default="https://api.cloudflare.com/client/v4")
     parser.add_argument("--path", help="Specify the path to store logs. By default, it will save to /var/log/cf_logs/", default="/var/log/cf_logs/")
     parser.add_argument("--prefix", help="Specify the prefix name of the logfile being stored on local storage. By default, the file name will begins with cf_logs.", default="cf_logs")
     parser.add_argument("--daily-pipeline", help="Daily ingest pipeline will be used instead of the default Weekly ingest pipeline, if specified.", action="store_true")
+    parser.add_argument("--pipeline", help="Specify the ingest pipeline to be used, instead of the Cloudflare daily or weekly ingest pipeline. Useful with a lighter pipeline when the transform stage does part of the work.")
+    parser.add_argument("--no-pipeline", help="Push the logs to Elasticsearch without any ingest pipeline. Useful when the transform stage does all the work.", action="store_true")
+    parser.add_argument("--drop-fields", help="Specify a comma-separated list of fields to be removed from each log before pushing to Elasticsearch.")
+    parser.add_argument("--rename-fields", help="Specify a comma-separated list of fields to be renamed before pushing to Elasticsearch, each as old:new. Example: ClientIP:client_ip,EdgeColoCode:colo")
+    parser.add_argument("--normalize-timestamps", help="Convert every timestamp field of each log to ISO 8601 format in UTC with milliseconds, and add @timestamp from EdgeStartTimestamp, before pushing to Elasticsearch.", action="store_true")
+    parser.add_argument("--geoip-db", help="Specify a MaxMind GeoIP2/GeoLite2 City or Country database, to add the location of ClientIP to each log as the geoip field. Requires the geoip2 library to be installed.")
+    parser.add_argument("--asn-db", help="Specify a MaxMind GeoIP2/GeoLite2 ASN database, to add the ASN and organization of ClientIP to the geoip field of each log. Requires the geoip2 library to be installed.")
+    parser.add_argument("--geoip-cache-size", help="Specify the number of IP addresses to keep in the cache of GeoIP and ASN lookups, in each transform worker. Default is 65536.", default=65536, type=int)
+    parser.add_argument("--transform-plugin", help="Specify a Python file with a transform(log) function, which takes each log as a dict and returns the changed log, or None to remove the log. It runs after the other transforms, before fields are renamed.")
+    parser.add_argument("--transform-workers", help="Specify the number of processes to run the transform stage. 0 runs it in the fetch workers. Default is the number of CPU cores.", type=int)
+    parser.add_argument("--rollup", help="Summarize the logs per rollup window into the number of requests, the bytes and the percentiles of the origin response time, grouped by the rollup fields, and push the rollups to their own index instead of the raw logs. A sample of the raw logs can still be pushed with --rollup-raw-rate.", action="store_true")
+    parser.add_argument("--rollup-index", help="Specify the Elasticsearch index for the rollups. Default is cloudflare-rollup.", default="cloudflare-rollup")
+    parser.add_argument("--rollup-window", help="Specify the size in seconds of each rollup window. Default is 60 seconds.", default=60.0, type=float)
+    parser.add_argument("--rollup-fields", help="Specify a comma-separated list of fields to group the rollups by. Default is EdgeResponseStatus,ClientCountry,EdgeColoCode,CacheCacheStatus,ClientRequestHost.", default="EdgeResponseStatus,ClientCountry,EdgeColoCode,CacheCacheStatus,ClientRequestHost")
+    parser.add_argument("--rollup-raw-rate", help="Specify the fraction of the raw logs, from 0 to 1, still pushed to Elasticsearch alongside the rollups. Default is 0, only the rollups are pushed.", default=0.0, type=float)
     parser.add_argument("--no-store", help="Instruct the program not to store a copy of raw logs on local storage.", action="store_true")
     parser.add_argument("--store-only", help="Instruct the program to only store raw logs on local storage. Logs will not push to Elasticsearch.", action="store_true")
     parser.add_argument("--no-organize", help="Instruct the program to store raw logs as is, without organizing them into date and time folder.", action="store_true")
     parser.add_argument("--no-gzip", help="Do not compress the raw logs.", action="store_true")
+    parser.add_argument("--compression", help="Specify the format to compress the raw logs. zstd requires the zstandard library to be installed. Default is gzip.", choices=["gzip", "zstd"], default="gzip")
+    parser.add_argument("--compression-level", help="Specify the level to compress the raw logs, from 1 (fastest) to 9 for gzip, or 1 to 22 for zstd. Default is 6 for gzip and 3 for zstd.", type=int)
+    parser.add_argument("--archive-format", help="Specify the format of the raw logs stored on local storage. parquet stores each log range as a Parquet file with a column for each field, in a folder for each hour of the logs, which can be read with --export. parquet requires the pyarrow library to be installed. Default is json.", choices=["json", "parquet"], default="json")
+    parser.add_argument("--compact-interval", help="Specify how often in seconds the Parquet files of each hour are merged into one, so there are fewer small files to be read. 0 means never. Default is 3600 seconds.", default=3600.0, type=float)
+    parser.add_argument("--export", help="Export the logs stored as Parquet files under --path within the start time and end time to this file, as JSON with one log per line, or as CSV or Parquet if the file name ends with .csv or .parquet. Nothing is pulled from Cloudflare or pushed to Elasticsearch.")
+    parser.add_argument("--export-columns", help="Specify a comma-separated list of fields to be exported. By default, all the fields are exported.")
+    parser.add_argument("--export-where", help="Only export the logs with a field equal to a value, specified as field=value. It can be specified more than once, then all of them must match. Example: EdgeResponseStatus=502", action="append")
     parser.add_argument("--one-time", help="Only pull logs from Cloudflare for one time, without scheduling capability. You must specify the start time and end time of the logs to be pulled from Cloudflare.", action="store_true")
     parser.add_argument("--start-time", help="Specify the start time of the logs to be pulled from Cloudflare. The start time is inclusive. You must follow the ISO 8601 date format, in UTC timezone. Example: 2020-12-31T12:34:56Z")
     parser.add_argument("--end-time", help="Specify the end time of the logs to be pulled from Cloudflare. The end time is exclusive. You must follow the ISO 8601 date format, in UTC timezone. Example: 2020-12-31T12:35:00Z")
+    parser.add_argument("--replay", help="Push the raw logs saved on local storage under --path to Elasticsearch again, instead of pulling them from Cloudflare, e.g. after the index mapping is changed. You must specify the start time and end time of the logs to be pushed. Zone ID and Cloudflare Access Token are not required.", action="store_true")
+    parser.add_argument("--replay-workers", help="Specify the number of processes to read and decompress the logfiles in replay mode. Default is the number of CPU cores.", type=int)
+    parser.add_argument("--shard-size", help="Specify the size in seconds of each log range, when the time range of one-time operation is split to be pulled concurrently. Cloudflare allows up to 3600 seconds. Default is 300 seconds.", default=300.0, type=float)
+    parser.add_argument("--adaptive-window", help="Adjust the size of each log range automatically, based on the number of logs per second seen in the recent log ranges. Log ranges are split during traffic spikes and merged during quiet periods, instead of using the interval.", action="store_true")
+    parser.add_argument("--window-target-logs", help="Specify the target number of logs in each log range when adaptive window sizing is enabled. Default is 50000.", default=50000, type=int)
+    parser.add_argument("--window-target-bytes", help="Specify the target size in bytes of the raw logs in each log range when adaptive window sizing is enabled. Default is 52428800 (50 MB).", default=50 * 1024 * 1024, type=int)
+    parser.add_argument("--window-min", help="Specify the minimum size in seconds of each log range when adaptive window sizing is enabled. Default is 10 seconds.", default=10.0, type=float)
+    parser.add_argument("--window-max", help="Specify the maximum size in seconds of each log range when adaptive window sizing is enabled. Cloudflare allows up to 3600 seconds. Default is 900 seconds.", default=900.0, type=float)
+    parser.add_argument("--requests-per-minute", help="Specify the maximum number of requests per minute to Cloudflare API for each zone. By default, there's no limit.", type=float)
+    parser.add_argument("--cf-requests-per-minute", help="Specify the maximum number of requests per minute to Cloudflare API shared by all the zones, including retries. 0 means no limit. Default is 240, the global rate limit of Cloudflare API.", default=240.0, type=float)
+    parser.add_argument("--stream", help="Enable streaming mode. Logs will be read from Cloudflare line by line and pushed to Elasticsearch in bounded chunks, instead of buffering the whole log range in memory.", action="store_true")
+    parser.add_argument("--bulk-max-bytes", help="Specify the maximum size in bytes of each Elasticsearch bulk request. Default is 10485760 (10 MB).", default=10 * 1024 * 1024, type=int)
+    parser.add_argument("--bulk-compression", help="Compress the body of each Elasticsearch bulk request before it's sent, which cuts the bytes sent over the network at the cost of some CPU. Default is none.", choices=["none", "gzip", "deflate"], default="none")
+    parser.add_argument("--bulk-compression-level", help="Specify the level to compress the bulk requests, from 1 (fastest) to 9. Default is 1.", default=1, type=int)
+    parser.add_argument("--bulk-max-docs", help="Specify the maximum number of logs in each Elasticsearch bulk request. Default is 5000.", default=5000, type=int)
+    parser.add_argument("--adaptive-bulk", help="Adjust the number of logs in each Elasticsearch bulk request automatically, between --bulk-min-docs and --bulk-max-docs, based on the latency and rejections from Elasticsearch.", action="store_true")
+    parser.add_argument("--bulk-min-docs", help="Specify the minimum number of logs in each Elasticsearch bulk request when adaptive chunk sizing is enabled. Default is 100.", default=100, type=int)
+    parser.add_argument("--bulk-target-latency", help="Specify the target latency in seconds of each Elasticsearch bulk request when adaptive chunk sizing is enabled. Default is 2 seconds.", default=2.0, type=float)
+    parser.add_argument("--doc-id", help="Specify how the document ID of each log is generated. rayid uses the RayID field of the log, hash uses a hash of the fields specified with --doc-id-fields (or the whole log). With none, Elasticsearch generates the ID and pushing the same logs again will create duplicates. Default is none.", choices=["none", "rayid", "hash"], default="none")
+    parser.add_argument("--doc-id-fields", help="Specify a comma-separated list of fields to be hashed as the document ID when --doc-id is hash. By default, the whole log is hashed.")
+    parser.add_argument("--op-type", help="Specify the bulk action for each log. With create, logs that already exist in Elasticsearch will be left untouched instead of being overwritten. Default is index.", choices=["index", "create"], default="index")
+    parser.add_argument("--dead-letter", help="Specify the file to save the logs that Elasticsearch refuses to index permanently, such as mapping errors. By default, it will save to /var/log/cf_elk_push/dead_letter.json", default="/var/log/cf_elk_push/dead_letter.json")
+    parser.add_argument("--fetch-workers", help="Specify the number of worker threads to pull logs from Cloudflare. Default is 4.", default=4, type=int)
+    parser.add_argument("--push-workers", help="Specify the number of worker threads to push logs to Elasticsearch. This is the number of bulk requests sent to Elasticsearch concurrently. Default is 4.", default=4, type=int)
+    parser.add_argument("--engine", help="Specify how the log ranges are pulled and pushed. threads runs the fetch and push workers as threads, asyncio runs them as tasks of an event loop, so a lot more log ranges and bulk requests can be in flight at the same time. asyncio requires the aiohttp library. Default is threads.", choices=["threads", "asyncio"], default="threads")
+    parser.add_argument("--queue-size", help="Specify the maximum number of pending log ranges waiting to be pulled, and pending logs waiting to be pushed. Default is 8.", default=8, type=int)
+    parser.add_argument("--pool-size", help="Specify the maximum number of connections kept alive to Cloudflare API and to Elasticsearch. By default, it follows the number of workers.", type=int)
+    parser.add_argument("--checkpoint", help="Specify the file to save the state of each log range, so the log ranges missed while the program was not running, or the ones that failed, will be pulled again automatically. By default, it will save to /var/log/cf_elk_push/checkpoint.db", default="/var/log/cf_elk_push/checkpoint.db")
+    parser.add_argument("--no-checkpoint", help="Do not save the state of each log range, and do not pull the missed or failed log ranges again.", action="store_true")
+    parser.add_argument("--backfill-max-age", help="Specify how far back in hours the missed or failed log ranges will be pulled again. Default is 72 hours.", default=72.0, type=float)
+    parser.add_argument("--backfill-interval", help="Specify how often in seconds to look for failed log ranges to be pulled again while the program is running. Default is 3600 seconds.", default=3600.0, type=float)
+    parser.add_argument("--catchup-rate", help="Specify the maximum number of missed or failed log ranges to be pulled again per minute, so catching up does not take up all the workers or the Cloudflare API rate limit. 0 means no limit. Default is 30.", default=30.0, type=float)
+    parser.add_argument("--spool", help="Specify a folder to save the logs that cannot be pushed to Elasticsearch after all the retries, e.g. during an outage of Elasticsearch. They will be pushed again in the background, in order, once Elasticsearch recovers. By default, the logs are only recorded in fail.log.")
+    parser.add_argument("--spool-segment-size", help="Specify the maximum size in bytes of each segment file of the spool. Default is 67108864 (64 MB).", default=64 * 1024 * 1024, type=int)
+    parser.add_argument("--spool-max-size", help="Specify the maximum size in bytes of the spool. Once it's full, the logs that cannot be pushed are only recorded in fail.log. Default is 10737418240 (10 GB).", default=10 * 1024 * 1024 * 1024, type=int)
+    parser.add_argument("--spool-max-attempts", help="Specify how many times a chunk in the spool is pushed again before it's given up and written to the dead-letter file, so one chunk that can never be pushed does not hold up the others forever. 0 means no limit. Default is 20.", default=20, type=int)
+    parser.add_argument("--spool-replay-rate", help="Specify the maximum number of bulk requests per minute to push the logs in the spool again, so Elasticsearch is not overwhelmed once it recovers. 0 means no limit. Default is 120.", default=120.0, type=float)
+    parser.add_argument("--metrics-port", help="Export the metrics of each stage in Prometheus text format at http://<host>:<port>/metrics.", type=int)
+    parser.add_argument("--metrics-textfile", help="Write the metrics of each stage in Prometheus text format to this file every 15 seconds, e.g. for the textfile collector of node_exporter.")
+    parser.add_argument("--drain-timeout", help="Specify how many seconds the log ranges in progress are given to finish once the program is asked to exit with Ctrl+C or SIGTERM. After that, the logs not pushed yet are saved to the spool (if enabled), and the log ranges not finished are recorded as failed. Default is 30 seconds.", default=30.0, type=float)
+    parser.add_argument("--status-interval", help="Specify how often the queue depth and lag are logged, in seconds. Default is 60 seconds.", default=60.0, type=float)
+    parser.add_argument("--log-format", help="Specify the format of the logs of the program. json writes each log as a JSON object on a single line. Default is text.", choices=["text", "json"], default="text")
+    parser.add_argument("--async-logging", help="Write the logs of the program in a background thread, so the workers do not wait for the logs to be written.", action="store_true")
+    parser.add_argument("--no-console", help="Do not print the logs of the program on terminal, e.g. when running as a daemon where the logfiles are enough.", action="store_true")
     parser.add_argument("--debug", help="Enable debugging functionality.", action="store_true")
     parser.add_argument("-v", "--version", help="Show program version.", action="version", version="Version " + ver_num)
     
@@ -127,41 +594,54 @@ def initialize_arg():
     if args.debug is True:
         logger.setLevel(logging.DEBUG)
     
+    log_format = args.log_format
+    async_logging = args.async_logging
+    no_console = args.no_console
+    
     #take the "path" parameter given by the user and assign it to a variable
     path = args.path
     
     #check whether Zone ID is given by the user via the parameter. If not, check the environment variable.
     #the Zone ID given via the parameter will override the Zone ID inside environment variable.
     #if no Zone ID is given, an error message will be given to the user and the program will exit
+    #the Zone ID is not required if the zones are given in a config file, or if the logs are not pulled from Cloudflare in replay mode
     if args.zone:
         zone_id = args.zone
     elif os.getenv("CF_ZONE_ID"):
         zone_id = os.getenv("CF_ZONE_ID")
+    elif args.zones_config or args.replay or args.export:
+        pass
     else:
-        logger.critical(str(datetime.now()) + " --- Please specify your Cloudflare Zone ID.")
+        logger.critical("Please specify your Cloudflare Zone ID.")
         sys.exit(2)
         
     #check whether Cloudflare Access Token is given by the user via the parameter. If not, check the environment variable.
     #the Cloudflare Access Token given via the parameter will override the Cloudflare Access Token inside environment variable.
     #if no Cloudflare Access Token is given, an error message will be given to the user and the program will exit
+    #the Cloudflare Access Token is not required if the zones are given in a config file, as each zone may have its own token, or in replay mode
     if args.token:
         access_token = args.token
     elif os.getenv("CF_TOKEN"):
         access_token = os.getenv("CF_TOKEN")
+    elif args.zones_config or args.replay or args.export:
+        pass
     else:
-        logger.critical(str(datetime.now()) + " --- Please specify your Cloudflare Access Token.")
+        logger.critical("Please specify your Cloudflare Access Token.")
         sys.exit(2)
     
+    zones_config = args.zones_config
+    
     no_store = args.no_store
     store_only = args.store_only
     
     #both values cannot be True. If you specify store_only flag, means you want the program to store logs in local storage. There's no point to specify no_store flag again.
     if no_store == True and store_only == True:
-        logger.critical(str(datetime.now()) + " --- Both no-store and store-only flag must not be used at the same time. The program will exit.")
+        logger.critical("Both no-store and store-only flag must not be used at the same time. The program will exit.")
         sys.exit(2)
     
     #check whether the user wants to store the logs on local storage only. If yes, the below code will be ignored, as there's no need to check for Elasticsearch username and password.
-    if store_only == False:
+    #the same for export mode, which only reads the logs from local storage
+    if store_only == False and args.export is None:
         #check whether Elasticsearch username is given by the user via the parameter. If not, check the environment variable.
         #the Elasticsearch username given via the parameter will override the Elasticsearch username inside environment variable.
         #if no Elasticsearch username is given, an error message will be given to the user and the program will exit
@@ -170,7 +650,7 @@ def initialize_arg():
         elif os.getenv("ELASTIC_USERNAME"):
             username = os.getenv("ELASTIC_USERNAME")
         else:
-            logger.critical(str(datetime.now()) + " --- Please specify your Elasticsearch username.")
+            logger.critical("Please specify your Elasticsearch username.")
             sys.exit(2)
             
         #check whether Elasticsearch password is given by the user via the parameter. If not, check the environment variable.
@@ -181,21 +661,21 @@ def initialize_arg():
         elif os.getenv("ELASTIC_PASSWORD"):
             password = os.getenv("ELASTIC_PASSWORD")
         else:
-            logger.critical(str(datetime.now()) + " --- Please specify your Elasticsearch password.")
+            logger.critical("Please specify your Elasticsearch password.")
             sys.exit(2)
     
     #check whether the port number is a valid port number, if not return an error message and exit
     if int(args.port) <= 65535 and int(args.port) >= 1:
         port = args.port
     else:
-        logger.critical(str(datetime.now()) + " --- Invalid port number specified. Please specify a value between 1 and 65535.")
+        logger.critical("Invalid port number specified. Please specify a value between 1 and 65535.")
         sys.exit(2)
     
     #check whether the sample rate is valid, if not return an error message and exit
     try:
         #the value should not more than two decimal places
         if len(args.rate.split(".", 1)[1]) > 2:
-            logger.critical(str(datetime.now()) + " --- Invalid sample rate specified. Please specify a value between 0.01 and 1, and only two decimal places allowed.")
+            logger.critical("Invalid sample rate specified. Please specify a value between 0.01 and 1, and only two decimal places allowed.")
             sys.exit(2)
     except IndexError:
         #sometimes the user may specify 1 as the value, so we need to handle the exception for value with no decimal places
@@ -203,11 +683,24 @@ def initialize_arg():
     if float(args.rate) <= 1.0 and float(args.rate) >= 0.01:
         sample_rate = args.rate
     else:
-        logger.critical(str(datetime.now()) + " --- Invalid sample rate specified. Please specify a value between 0.01 and 1, and only two decimal places allowed.")
+        logger.critical("Invalid sample rate specified. Please specify a value between 0.01 and 1, and only two decimal places allowed.")
         sys.exit(2)
     
     one_time = args.one_time
-    if one_time is True:
+    replay_mode = args.replay
+    export_path = args.export
+    
+    #export mode only reads the logs from local storage, so it cannot be used with the other modes
+    if export_path is not None and (one_time is True or replay_mode is True):
+        logger.critical("Export must not be used with one-time operation or replay mode. The program will exit.")
+        sys.exit(2)
+    
+    #replay mode pushes the logs saved on local storage, so it cannot be used to pull logs from Cloudflare at the same time, nor to store them only
+    if replay_mode is True and (one_time is True or store_only is True):
+        logger.critical("Replay mode must not be used with one-time operation or store-only flag. The program will exit.")
+        sys.exit(2)
+    
+    if one_time is True or replay_mode is True or export_path is not None:
         if args.start_time and args.end_time:
             try:
                 start_time_static = datetime.strptime(args.start_time, "%Y-%m-%dT%H:%M:%SZ")
@@ -215,445 +708,3418 @@ def initialize_arg():
                 diff_start_end = end_time_static - start_time_static
                 diff_to_now = datetime.utcnow() - end_time_static
                 if diff_start_end.total_seconds() < 1:
-                    logger.critical(str(datetime.now()) + " --- Start time must be earlier than the end time by at least 1 second. ")
+                    logger.critical("Start time must be earlier than the end time by at least 1 second. ")
                     sys.exit(2)
-                if diff_to_now.total_seconds() < 70:
-                    logger.critical(str(datetime.now()) + " --- Please specify an end time that is 70 seconds or more earlier than the current time.")
+                #the logs saved on local storage can be replayed or exported up to the current time
+                if diff_to_now.total_seconds() < 70 and one_time is True:
+                    logger.critical("Please specify an end time that is 70 seconds or more earlier than the current time.")
                     sys.exit(2)
             except ValueError:
-                logger.critical(str(datetime.now()) + " --- Invalid date format specified. Make sure it is in ISO 8601 date format, in UTC timezone. Please refer to the example: 2020-12-31T12:34:56Z")
+                logger.critical("Invalid date format specified. Make sure it is in ISO 8601 date format, in UTC timezone. Please refer to the example: 2020-12-31T12:34:56Z")
                 sys.exit(2)
         else:
-            logger.critical(str(datetime.now()) + " --- No start time or end time specified for one-time operation. ")
+            logger.critical("No start time or end time specified for %s. ", ("replay mode" if replay_mode is True else ("export" if export_path is not None else "one-time operation")))
             sys.exit(2)
     
+    replay_workers = args.replay_workers if args.replay_workers is not None else (os.cpu_count() or 1)
+    if replay_workers < 1:
+        logger.critical("Invalid number of replay workers specified. It must be at least 1.")
+        sys.exit(2)
+    
     #take the protocol, interval, logfile name prefix and pipeline setting parameter given by the user and assign it to a variable
     http_proto = "https" if args.https else "http"
+    
+    #the URLs given by the user must include the protocol. the protocol of Elasticsearch URL overrides --https
+    es_urls = [url.strip().rstrip("/") for url in args.es_url.split(",") if url.strip() != ""] if args.es_url is not None else []
+    for url in es_urls + [args.cf_api_url]:
+        if not url.startswith(("http://", "https://")):
+            logger.critical("Invalid URL %s specified. The URL must begin with http:// or https://", url)
+            sys.exit(2)
+    es_url = es_urls[0] if len(es_urls) > 0 else None
+    cf_api_url = args.cf_api_url.rstrip("/")
+    if es_url is not None:
+        http_proto = es_url.split(":", 1)[0]
+    
+    if args.es_health_interval <= 0:
+        logger.critical("Invalid health check interval specified. It must be more than 0.")
+        sys.exit(2)
+    es_discover = args.es_discover
+    es_balance = args.es_balance
+    es_health_interval = args.es_health_interval
     interval = args.interval
     daily_pipeline = args.daily_pipeline
     logfile_name_prefix = args.prefix
     no_organize = args.no_organize
     no_gzip = args.no_gzip
+    dead_letter_path = args.dead_letter
     
+    #check whether the archive format is valid, if not return an error message and exit
+    if (args.archive_format == "parquet" or export_path is not None) and pyarrow is None:
+        logger.critical("pyarrow library is not installed. Install it with 'pip install pyarrow' to store the raw logs as Parquet files, or to export them.")
+        sys.exit(2)
+    if args.compact_interval < 0:
+        logger.critical("Invalid compaction interval specified. It must not be negative.")
+        sys.exit(2)
+    archive_format = args.archive_format
+    compact_interval = args.compact_interval
+    export_columns = [field for field in args.export_columns.split(",") if field] if args.export_columns else []
+    export_filters = [tuple(condition.split("=", 1)) for condition in (args.export_where or [])]
+    if any(len(condition) != 2 for condition in export_filters):
+        logger.critical("Invalid export condition specified. Each of them must be specified as field=value.")
+        sys.exit(2)
     
-'''
-This method will be invoked after initialize_arg().
-This method is to verify whether the Cloudflare Zone ID, Cloudflare Access Token, Elasticsearch username and password given by the user is valid.
-If it is not valid, an error message will be given to the user and the program will exit
-'''
-def verify_credential():
+    #check whether the compression setting is valid, if not return an error message and exit. Parquet files are compressed by pyarrow itself
+    if args.compression == "zstd" and zstandard is None and no_gzip is False and archive_format == "json":
+        logger.critical("zstandard library is not installed. Install it with 'pip install zstandard' or use gzip compression instead.")
+        sys.exit(2)
+    compression = "none" if no_gzip is True else args.compression
+    if args.compression_level is None:
+        compression_level = 3 if compression == "zstd" else 6
+    elif (compression == "gzip" and 1 <= args.compression_level <= 9) or (compression == "zstd" and 1 <= args.compression_level <= 22) or compression == "none":
+        compression_level = args.compression_level
+    else:
+        logger.critical("Invalid compression level specified. Please specify a value between 1 and 9 for gzip, or between 1 and 22 for zstd.")
+        sys.exit(2)
     
-    global logger, username, password, daily_pipeline, store_only
+    doc_id_mode = args.doc_id
+    doc_id_fields = args.doc_id_fields.split(",") if args.doc_id_fields else []
+    op_type = args.op_type
+    bulk_metadata = ('{ "' + op_type + '": { "_index": "' + index_name + '" }}\n').encode("utf-8")
+    bulk_action_prefix = ('{ "' + op_type + '": { "_index": "' + index_name + '", "_id": "').encode("utf-8")
+    
+    #check whether the bulk chunk limits are valid, if not return an error message and exit
+    if args.bulk_max_bytes < 1 or args.bulk_max_docs < 1:
+        logger.critical("Invalid bulk chunk limit specified. Both maximum bytes and maximum number of logs must be at least 1.")
+        sys.exit(2)
+    stream_mode = args.stream
+    bulk_max_bytes = args.bulk_max_bytes
+    bulk_max_docs = args.bulk_max_docs
     
-    #specify the Cloudflare API URL to check the Zone ID and Access Token
-    url = "https://api.cloudflare.com/client/v4/zones/" + zone_id + "/logs/received"
-    headers = {"Authorization": "Bearer " + access_token, "Content-Type": "application/json"}
+    #check whether the compression level of the bulk requests is valid, if not return an error message and exit
+    if not 1 <= args.bulk_compression_level <= 9:
+        logger.critical("Invalid bulk compression level specified. Please specify a value between 1 and 9.")
+        sys.exit(2)
+    bulk_compression = args.bulk_compression
+    bulk_compression_level = args.bulk_compression_level
     
-    #make a HTTP request to the Cloudflare API
-    r = requests.get(url, headers=headers)
-    r.encoding = "utf-8"
+    #the minimum number of logs must not be more than the maximum number of logs in each chunk
+    if args.adaptive_bulk is True and (args.bulk_min_docs < 1 or args.bulk_min_docs > args.bulk_max_docs or args.bulk_target_latency <= 0):
+        logger.critical("Invalid adaptive chunk sizing setting specified. The minimum number of logs must be between 1 and the maximum number of logs, and the target latency must be more than 0.")
+        sys.exit(2)
+    adaptive_bulk = args.adaptive_bulk
+    bulk_min_docs = args.bulk_min_docs
+    bulk_target_latency = args.bulk_target_latency
+    bulk_sizer = BulkSizer()
     
-    #if there's an error, Cloudflare API will return a JSON object to indicate the error
-    #and if it's not, a plain text will be returned instead
-    #the try except block is to catch any errors raised by json.loads(), in case Cloudflare is not returning JSON object
-    try:
-        response = json.loads(r.text)
-        if response["success"] is False:
-            logger.critical(str(datetime.now()) + " --- Failed to authenticate with Cloudflare API. Please check your Zone ID and Cloudflare Access Token.")
+    #check whether the number of workers and the queue size are valid, if not return an error message and exit
+    if args.fetch_workers < 1 or args.push_workers < 1 or args.queue_size < 1:
+        logger.critical("Invalid number of workers or queue size specified. All of them must be at least 1.")
+        sys.exit(2)
+    fetch_workers = args.fetch_workers
+    push_workers = args.push_workers
+    queue_size = args.queue_size
+    status_interval = args.status_interval
+    
+    if args.drain_timeout < 0:
+        logger.critical("Invalid drain timeout specified. It must not be negative.")
+        sys.exit(2)
+    drain_timeout = args.drain_timeout
+    
+    if args.pool_size is not None and args.pool_size < 1:
+        logger.critical("Invalid pool size specified. It must be at least 1.")
+        sys.exit(2)
+    pool_size = args.pool_size
+    
+    #check whether the library needed by the asyncio engine is installed, if not return an error message and exit
+    if args.engine == "asyncio" and aiohttp is None:
+        logger.critical("aiohttp library is not installed. Install it with 'pip install aiohttp' or use the threads engine instead.")
+        sys.exit(2)
+    engine = args.engine
+    
+    #check whether the backfill settings are valid, if not return an error message and exit
+    if args.backfill_max_age <= 0 or args.backfill_interval <= 0 or args.catchup_rate < 0:
+        logger.critical("Invalid backfill setting specified. The maximum age and the interval must be more than 0, and the catch-up rate must not be negative.")
+        sys.exit(2)
+    checkpoint_path = None if args.no_checkpoint is True else args.checkpoint
+    backfill_max_age = args.backfill_max_age
+    backfill_interval = args.backfill_interval
+    catchup_limiter = RateLimiter(args.catchup_rate)
+    
+    #check whether the spool settings are valid, if not return an error message and exit
+    if args.spool_segment_size < 1 or args.spool_max_size < args.spool_segment_size or args.spool_replay_rate < 0 or args.spool_max_attempts < 0:
+        logger.critical("Invalid spool setting specified. The segment size must be at least 1 and not more than the maximum size, and the replay rate and the maximum attempts must not be negative.")
+        sys.exit(2)
+    spool_path = args.spool
+    spool_segment_size = args.spool_segment_size
+    spool_max_size = args.spool_max_size
+    spool_replay_rate = args.spool_replay_rate
+    spool_max_attempts = args.spool_max_attempts
+    
+    #check whether the shard size and the rate limit are valid, if not return an error message and exit
+    if args.shard_size < 1 or args.shard_size > 3600:
+        logger.critical("Invalid shard size specified. Please specify a value between 1 and 3600 seconds.")
+        sys.exit(2)
+    if (args.requests_per_minute is not None and args.requests_per_minute <= 0) or args.cf_requests_per_minute < 0:
+        logger.critical("Invalid rate limit specified. The maximum number of requests per minute must be more than 0 for each zone, and must not be negative for all the zones.")
+        sys.exit(2)
+    shard_size = args.shard_size
+    requests_per_minute = args.requests_per_minute
+    cf_requests_per_minute = args.cf_requests_per_minute
+    
+    #check whether the adaptive window sizing setting is valid, if not return an error message and exit
+    if args.adaptive_window is True and (args.window_target_logs < 1 or args.window_target_bytes < 1 or args.window_min < 1 or args.window_min > args.window_max or args.window_max > 3600):
+        logger.critical("Invalid adaptive window sizing setting specified. The targets must be at least 1, and the minimum and maximum size must be between 1 and 3600 seconds, with the minimum not more than the maximum.")
+        sys.exit(2)
+    adaptive_window = args.adaptive_window
+    window_target_logs = args.window_target_logs
+    window_target_bytes = args.window_target_bytes
+    window_min = args.window_min
+    window_max = args.window_max
+    
+    #check whether the pipeline setting is valid, if not return an error message and exit
+    if args.no_pipeline is True and args.pipeline:
+        logger.critical("Both pipeline and no-pipeline flag must not be used at the same time. The program will exit.")
+        sys.exit(2)
+    pipeline_name = "" if args.no_pipeline is True else args.pipeline
+    
+    if args.metrics_port is not None and not 1 <= args.metrics_port <= 65535:
+        logger.critical("Invalid metrics port number specified. Please specify a value between 1 and 65535.")
+        sys.exit(2)
+    metrics_port = args.metrics_port
+    metrics_textfile = args.metrics_textfile
+    
+    #check whether the transform settings are valid, if not return an error message and exit
+    if (args.geoip_db or args.asn_db) and geoip2 is None:
+        logger.critical("geoip2 library is not installed. Install it with 'pip install geoip2' to look up the location or ASN of the client IP.")
+        sys.exit(2)
+    for database in (args.geoip_db, args.asn_db, args.transform_plugin):
+        if database and not os.path.isfile(database):
+            logger.critical("%s does not exist. The program will exit.", database)
             sys.exit(2)
-    except json.JSONDecodeError:
-        #a non-JSON object returned by Cloudflare indicates that authentication successful
-        pass
+    try:
+        rename_fields = dict(field.split(":", 1) for field in args.rename_fields.split(",")) if args.rename_fields else {}
+    except ValueError:
+        logger.critical("Invalid fields to be renamed specified. Each of them must be specified as old:new, separated by commas.")
+        sys.exit(2)
+    if args.geoip_cache_size < 0 or (args.transform_workers is not None and args.transform_workers < 0):
+        logger.critical("Invalid transform setting specified. The cache size and the number of transform workers must not be negative.")
+        sys.exit(2)
+    transform_settings = {
+        "drop_fields": args.drop_fields.split(",") if args.drop_fields else [],
+        "rename_fields": rename_fields,
+        "normalize_timestamps": args.normalize_timestamps,
+        "geoip_db": args.geoip_db,
+        "asn_db": args.asn_db,
+        "geoip_cache_size": args.geoip_cache_size,
+        "plugin": args.transform_plugin,
+    }
+    if not (transform_settings["drop_fields"] or rename_fields or args.normalize_timestamps or args.geoip_db or args.asn_db or args.transform_plugin):
+        transform_settings = None
+    transform_workers = args.transform_workers if args.transform_workers is not None else (os.cpu_count() or 1)
+    
+    #check whether the rollup settings are valid, if not return an error message and exit. there's nothing to summarize if the logs are not pushed to Elasticsearch
+    if args.rollup is True and store_only is True:
+        logger.critical("Both rollup and store-only flag must not be used at the same time. The program will exit.")
+        sys.exit(2)
+    if args.rollup_window <= 0 or not 0 <= args.rollup_raw_rate <= 1:
+        logger.critical("Invalid rollup setting specified. The rollup window must be more than 0, and the raw rate must be between 0 and 1.")
+        sys.exit(2)
+    rollup_mode = args.rollup
+    rollup_index = args.rollup_index
+    rollup_window = args.rollup_window
+    rollup_fields = [field for field in args.rollup_fields.split(",") if field]
+    rollup_raw_rate = args.rollup_raw_rate
+    rollup_action_prefix = ('{ "index": { "_index": "' + rollup_index + '", "_id": "').encode("utf-8")
     
-    #check whether the user wants to store the logs on local storage only. If yes, the below code will be ignored, as there's no need to check for Elasticsearch connectivity.
-    if store_only == False:
-        #specify the Elasticsearch API URL to check the username and password. it also checks whether the ingest pipeline exists in the Elasticsearch
-        url = http_proto + "://localhost:" + port + "/_ingest/pipeline/" + pipeline_name_prefix + ("daily" if daily_pipeline is True else "weekly")
-        auth_elastic = (username, password)
-
-        #make a HTTP request to the Elasticsearch API
-        try:
-            r = requests.get(url, auth=auth_elastic, verify=False)
-        except requests.exceptions.ConnectionError as e:
-            if "RemoteDisconnected" in str(e):
-                #If Elasticsearch cluster disconnect the connection, display an error to the user and the program will exit. It may caused by HTTP connection to HTTPS-enabled Elasticsearch cluster
-                logger.critical(str(datetime.now()) + " --- Connection closed by remote Elasticsearch server." + ("" if http_proto == "https" else " It may due to performing HTTP request to HTTPS-enabled Elasticsearch server. Try using --https option and try again."))
-                sys.exit(2)
-            else:
-                #in the event that the Elasticsearch server is unable to connect, an error message will display to the user and the program will exit
-                logger.critical(str(datetime.now()) + " --- Connection refused by Elasticsearch server. Please check whether the port number is correct, and the server is up and running.")
-                sys.exit(2)
-            
-        r.encoding = 'utf-8'
-
-        #check the HTTP response code returned by Elasticsearch. if it is 200, means no issue. else, display an error message to the user and exit the program
-        if r.status_code == 200:
-            pass
-        else:
-            logger.debug(str(datetime.now()) + " --- Output from Elasticsearch API:\n" + r.text) #the raw response will be logged only if the user enables debugging
-            if r.status_code == 401:
-                #error 401 means unauthorized
-                logger.critical(str(datetime.now()) + " --- Failed to authenticate with Elasticsearch API. Please check your Elasticsearch username and password.")
-                sys.exit(2)
-            elif r.status_code == 404:
-                #error 404 means the ingest pipeline not exists
-                logger.critical(str(datetime.now()) + " --- Cloudflare " + ("daily" if daily_pipeline is True else "weekly") + " ingest pipeline is not installed in Elasticsearch. Install first before proceed.")
-                sys.exit(1)
-            else:
-                #other kinds of error may occur and this block of code will handle other errors and display to the user accordingly.
-                try:
-                    response = json.loads(r.text)
-                    if "error" in response:
-                        err_type = response["error"]["root_cause"][0]["type"]
-                        err_msg = response["error"]["root_cause"][0]["reason"]
-                        logger.critical(str(datetime.now()) + " --- An error occured with error code " + str(r.status_code) + ". Root cause: " + err_type + " | " + err_msg)
-                        sys.exit(1)
-                    else:
-                        logger.critical(str(datetime.now()) + " --- Unknown error occured with error code " + str(r.status_code) + ". Error dump: " + r.text)
-                        sys.exit(1)
-                except json.JSONDecodeError:
-                    logger.critical(str(datetime.now()) + " --- Unknown error occured with error code " + str(r.status_code) + ". Error dump: " + r.text)
-                    sys.exit(1)
     
-
 '''
-This method is to initialize the folder with the date and time of the logs being stored on local storage as the name of the folder
-If the folder does not exists, it will automatically create a new one
+This class keeps the settings of a zone to pull logs from, and the URLs and headers built from them, so they are only built once.
 '''
-def initialize_folder(path_with_date):
-    data_folder = Path(path_with_date)
-    data_folder.mkdir(parents=True, exist_ok=True)
-    return data_folder
+class Zone:
+    
+    def __init__(self, name, zone_id, access_token, zone_sample_rate, zone_fields, pipeline, requests_per_minute):
+        self.name = name
+        self.zone_id = zone_id
+        self.access_token = access_token
+        self.sample_rate = zone_sample_rate
+        self.fields = zone_fields
+        self.pipeline = pipeline
+        self.rate_limiter = RateLimiter(requests_per_minute)
+        self.window_sizer = WindowSizer()
+        
+        #whether the warning has been given that the responses of this zone are not compressed
+        self.uncompressed_warned = False
+        
+        #specify the URL for the Cloudflare API endpoint, and the parameters which are the same for every log range, such as timestamp format, sample rate and the fields to be included in the logs
+        self.logs_url = cf_api_url + "/zones/" + self.zone_id + "/logs/received"
+        self.logs_query = "&timestamps=" + timestamp_format + "&sample=" + str(self.sample_rate) + "&fields=" + self.fields
+        self.headers = {"Authorization": "Bearer " + self.access_token}
+        
+        #specify the path of the Elasticsearch endpoint, with the ingest pipeline of this zone if there's one. the node to send to is picked on every bulk request
+        self.bulk_path = "/_bulk" + ("?pipeline=" + self.pipeline if self.pipeline else "")
+        
+        #the columns of the Parquet files, if the raw logs are stored as Parquet files
+        self.archive_schema = archive_schema(self.fields) if archive_format == "parquet" else None
 
 '''
-This method is to prepare the path of where the logfile will be stored and what will be the name of the logfile.
-If the logfile already exists, we assume that the logs has been pulled from Cloudflare previously
+This class limits how often the logs of a zone can be requested from Cloudflare, using a token bucket.
+A token is added every (60 / requests per minute) seconds, up to a small burst. Without a limit, the requests are never held back.
 '''
-def prepare_path(log_start_time_rfc3389, log_end_time_rfc3389, data_folder):
-    logfile_name = logfile_name_prefix + "_" + log_start_time_rfc3389 + "~" + log_end_time_rfc3389 + ".json"
-    logfile_path = data_folder / logfile_name
+class RateLimiter:
     
-    if os.path.exists(str(logfile_path) + ".gz") or os.path.exists(str(logfile_path) + ".json"):
-        return False
-    else:
-        return logfile_path
+    def __init__(self, requests_per_minute):
+        self.rate = requests_per_minute / 60.0 if requests_per_minute else None
+        self.capacity = max(1.0, requests_per_minute / 60.0 * 5) if requests_per_minute else None
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
     
-'''
-A method to check whether the user initiates program exit.
-This method will be triggered every time the logpush thread finishes its job (which is, finish the logpush to Elasticsearch process)
-This method will minus 1 from the total number of running threads, and check whether the user triggers the program exit process.
-If program exit initiated by user, is_exit will become True, and this method will make sure that number of running threads must be zero in order to exit the program gracefully.
-'''
-def check_if_exited():
-    global is_exit, num_of_running_thread
+    def refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
     
-    num_of_running_thread -= 1
-
-    if is_exit is True and num_of_running_thread <= 0:
-        logger.info(str(datetime.now()) + " --- Program exited gracefully.")
-        return True
+    #take a token if the next request is allowed now, and return 0
+    #otherwise, return the number of seconds until the next request is allowed
+    def try_acquire(self):
+        if self.rate is None:
+            return 0.0
+        with self.lock:
+            self.refill()
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return 0.0
+            return (1 - self.tokens) / self.rate
     
-    return False
+    #put back the token taken, if the request is not made after all
+    def give_back(self):
+        if self.rate is None:
+            return
+        with self.lock:
+            self.tokens = min(self.capacity, self.tokens + 1)
 
 '''
-A method that is responsible for just compressing logs that is written to the local storage, in gzip format
+This class schedules every request to Cloudflare API, including the retries. A request takes a token from the rate limit of its zone,
+and one from the rate limit shared by all the zones, so the log ranges pulled concurrently and the backfills never go beyond the limits together.
+When Cloudflare tells us to slow down with HTTP 429, the whole zone is paused for as long as Retry-After says, instead of each log range retrying on its own.
 '''
-def compress_logs(logfile_path):
-    exit_code = os.system("gzip -f " + str(logfile_path))
-    logger.debug(str(datetime.now()) + " --- Gzip executed with exit code: " + str(exit_code))
+class CloudflareScheduler:
     
-    return True if exit_code == 0 else False
-
-'''
-This method is responsible to write logs to local storage after the logs have been pulled from Cloudflare API.
-After successfully save the logs, it will also trigger compress_logs() method to compress the newly written logs.
-'''
-def write_logs(log_start_time_rfc3389,  log_end_time_rfc3389, logfile_path, data):
+    def __init__(self, requests_per_minute):
+        self.limiter = RateLimiter(requests_per_minute)
+        self.paused_until = {}
+        self.lock = threading.Lock()
     
-    #open the file as write mode
-    try:
-        logfile = open(logfile_path, mode="w", encoding="utf-8")
-        logfile.write(data)
-        logfile.close()
-    except:
-        return False
+    #take the tokens for a request of the zone if it's allowed now, and return 0
+    #otherwise, return the number of seconds until the next request of the zone may be allowed
+    def try_acquire(self, zone):
+        with self.lock:
+            paused = self.paused_until.get(zone.name, 0) - time.monotonic()
+        if paused > 0:
+            return paused
+        
+        wait = zone.rate_limiter.try_acquire()
+        if wait > 0:
+            return wait
+        wait = self.limiter.try_acquire()
+        if wait > 0:
+            zone.rate_limiter.give_back()
+        return wait
     
-    return True
+    #wait until a request of the zone is allowed
+    def acquire(self, zone):
+        wait = self.try_acquire(zone)
+        while wait > 0:
+            time.sleep(wait)
+            wait = self.try_acquire(zone)
+    
+    #stop all the requests of the zone for the number of seconds
+    def pause(self, zone, seconds):
+        with self.lock:
+            self.paused_until[zone.name] = max(self.paused_until.get(zone.name, 0), time.monotonic() + seconds)
 
 '''
-This method is to insert a specific line of metadata before each lines of logs, which is required by the Elasticsearch bulk tasks.
-It will count the number of lines of logs, and return the final processing result with the number of logs back to the caller
+This class is the queue of log ranges waiting to be pulled, shared by all the zones.
+Each zone has its own bounded queue, and the fetch workers take the log ranges from the zones in turn,
+so a zone with a large backlog will not hold up the other zones. A zone is skipped while its rate limit is reached.
 '''
-def process_logs(response):
-    final_json = []
-    number_of_logs = 0
+class FairQueue:
     
-    #this metadata is required by Elasticsearch bulk tasks
-    metadata='{ "index": { "_index": "cloudflare" }}\n'
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.queues = {}
+        self.order = []
+        self.next_index = 0
+        self.closed = False
+        self.condition = threading.Condition()
     
-    #feed each lines of logs from the raw logs, split them by newline character
-    for line in response.split("\n"):
-        if (line == ""):
-            #skip empty lines
-            pass
-        else:
-            #first insert the metadata to the array list, then insert the log
-            final_json.append(metadata)
-            final_json.append(line + "\n")
-            number_of_logs += 1
-
-    #the join() method will combine all the strings inside the array into one string. this is very optimized for large numbers of string concatenation
-    return ''.join(final_json), number_of_logs
+    #hand a log range to the fetch workers. if the queue of the zone is full, it returns False without waiting
+    def put(self, log_range):
+        with self.condition:
+            zone_queue = self.queues.get(log_range.zone.name)
+            if zone_queue is None:
+                zone_queue = self.queues[log_range.zone.name] = deque()
+                self.order.append(log_range.zone.name)
+            if len(zone_queue) >= self.maxsize:
+                return False
+            zone_queue.append(log_range)
+            self.condition.notify()
+            return True
+    
+    #wait until the queue of the zone has room, or until the timeout
+    def wait_for_room(self, zone, timeout):
+        with self.condition:
+            self.condition.wait_for(lambda: len(self.queues.get(zone.name, ())) < self.maxsize, timeout)
+    
+    #take the next log range, from the zones in turn. it returns None once the queue is closed and all the log ranges have been taken
+    def get(self):
+        with self.condition:
+            while True:
+                wait = None
+                for k in range(len(self.order)):
+                    index = (self.next_index + k) % len(self.order)
+                    zone_queue = self.queues[self.order[index]]
+                    if len(zone_queue) == 0:
+                        continue
+                    zone_wait = cf_scheduler.try_acquire(zone_queue[0].zone)
+                    if zone_wait > 0:
+                        wait = zone_wait if wait is None else min(wait, zone_wait)
+                        continue
+                    self.next_index = index + 1
+                    self.condition.notify_all()
+                    return zone_queue.popleft()
+                
+                if wait is None and self.closed is True:
+                    return None
+                self.condition.wait(wait)
+    
+    #tell the fetch workers to stop once all the log ranges have been taken
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+    
+    def qsize(self):
+        with self.condition:
+            return sum(len(zone_queue) for zone_queue in self.queues.values())
+    
+    #take out all the log ranges that have not been taken by the fetch workers
+    def clear(self):
+        with self.condition:
+            log_ranges = [log_range for zone_queue in self.queues.values() for log_range in zone_queue]
+            for zone_queue in self.queues.values():
+                zone_queue.clear()
+            self.condition.notify_all()
+            return log_ranges
 
 '''
-This method will take the processed logs and push them to Elasticsearch, using Bulk API.
+This method will be invoked after the HTTP sessions are created.
+It prepares the zones to pull logs from, either the zone given by the user, or the zones listed in the config file.
+The config file is a JSON object with a list of zones, for example:
+{"zones": [{"zone_id": "...", "name": "example.com", "token": "...", "sample_rate": "0.1", "fields": "RayID,...", "pipeline": "cloudflare-pipeline-weekly", "requests_per_minute": 30}]}
+Only zone_id is required, the other settings follow the parameters given by the user if they are not specified.
 '''
-def push_logs(final_json, log_start_time_rfc3389, log_end_time_rfc3389, number_of_logs):
+def initialize_zones():
     
-    global retry_attempt
+    global zones, cf_scheduler
     
-    #specify the URL of the Elasticsearch endpoint, and specify the ingest pipeline to be used
-    url = http_proto + "://localhost:" + port + "/_bulk?pipeline=" + pipeline_name_prefix + ("daily" if daily_pipeline is True else "weekly")
-    headers = {"Content-Type": "application/json"}
-    auth_elastic = (username, password)
+    cf_scheduler = CloudflareScheduler(cf_requests_per_minute)
     
-    #5 retries will be given for the logpush process, in case something happens
-    for i in range(retry_attempt+1):
-        #make a POST request to the Elasticsearch endpoint to push all the logs that is previously processed.
-        try:
-            r = requests.post(url, auth=auth_elastic, headers=headers, data=final_json, verify=False)
-        except Exception as e:
-            logger.error(str(datetime.now()) + " --- Log range " + log_start_time_rfc3389 + " to " + log_end_time_rfc3389 + ": Unexpected error occured while pushing logs to Elasticsearch. Error dump: \n" + str(e) + ". \n" + (("Retrying " + str(i+1) + " of " + str(retry_attempt) + "...") if i < (retry_attempt) else ""))
-            time.sleep(3)
-            continue
-
-        r.encoding = 'utf-8'
-
-        #check whether the HTTP response code returned by Elasticsearch endpoint is 200, if yes means the logs have been pushed to Elasticsearch successfully.
+    if zones_config is None:
+        zones = [Zone(zone_id, zone_id, access_token, sample_rate, fields, es_pipeline, requests_per_minute)]
+    else:
         try:
-            result_json = json.loads(r.text)
-        except json.JSONDecodeError:
-            #Elasticsearch should return a JSON object no matter the request is successful or not. But if not, something weird happened.
-            logger.error(str(datetime.now()) + " --- Log range " + log_start_time_rfc3389 + " to " + log_end_time_rfc3389 + ": Unexpected error occured with error code " + str(r.status_code) + ". Error dump: " + r.text + ". \n" + (("Retrying " + str(i+1) + " of " + str(retry_attempt) + "...") if i < (retry_attempt) else ""))
-            time.sleep(3)
-            continue
-
-        logger.debug(str(datetime.now()) + " --- Output from Elasticsearch API:\n" + r.text) #the raw response will be logged only if the user enables debugging
-        if r.status_code == 200:
-            #NOTE: Elasticsearch will return status code 200 even if there's an error occured. We have to catch the error in JSON object
-            if "errors" in result_json:
-                if result_json["errors"] == False:     
-                    logger.info(str(datetime.now()) + " --- Log range " + log_start_time_rfc3389 + " to " + log_end_time_rfc3389 + ": Successfully pushed " + str(number_of_logs) + " logs to Elasticsearch.")
-                    succ_logger.info("Log range " + log_start_time_rfc3389 + " to " + log_end_time_rfc3389)
-                    return True
-                else:
-                    try:
-                        err_type = result_json["items"][0]["index"]["error"]["type"]
-                        err_msg = result_json["items"][0]["index"]["error"]["reason"]
-                        err_code = result_json["items"][0]["index"]["status"]
-                        caused_by = ""
-                        if "caused_by" in result_json["items"][0]["index"]["error"]:
-                            caused_by = "Caused by: " + result_json["items"][0]["index"]["error"]["caused_by"]["type"] + " | " + result_json["items"][0]["index"]["error"]["caused_by"]["reason"] + ". "
-                        logger.error(str(datetime.now()) + " --- Log range " + log_start_time_rfc3389 + " to " + log_end_time_rfc3389 + ": Failed to push logs with error code " + str(err_code) + ". Root cause: " + err_type + " | " + err_msg + ". " + caused_by + ". \n" + (("Retrying " + str(i+1) + " of " + str(retry_attempt) + "...") if i < (retry_attempt) else ""))
-                        time.sleep(3)
-                        continue
-                    except:
-                        logger.error(str(datetime.now()) + " --- Log range " + log_start_time_rfc3389 + " to " + log_end_time_rfc3389 + ": Unknown error occured while pushing logs to Elasticsearch. Error dump: " + result_json + ". \n" + (("Retrying " + str(i+1) + " of " + str(retry_attempt) + "...") if i < (retry_attempt) else ""))
-                        time.sleep(3)
-                        continue
-            else:
-                logger.error(str(datetime.now()) + " --- Log range " + log_start_time_rfc3389 + " to " + log_end_time_rfc3389 + ": Unexpected error occured with error code " + str(r.status_code) + ". Error dump: " + r.text + ". \n" + (("Retrying " + str(i+1) + " of " + str(retry_attempt) + "...") if i < (retry_attempt) else ""))
-                time.sleep(3)
-                continue
-        else:
-            #if the HTTP response code is not 200, means something happened, and an error message will be returned to the user
-            if "error" in result_json:
-                err_type = result_json["error"]["root_cause"][0]["type"]
-                err_msg = result_json["error"]["root_cause"][0]["reason"]
-                logger.error(str(datetime.now()) + " --- Log range " + log_start_time_rfc3389 + " to " + log_end_time_rfc3389 + ": Failed to push logs with error code " + str(r.status_code) + ". Root cause: " + err_type + " | " + err_msg + ". \n" + (("Retrying " + str(i+1) + " of " + str(retry_attempt) + "...") if i < (retry_attempt) else ""))
-            elif "errors" in result_json:
-                err_type = result_json["items"][0]["index"]["error"]["type"]
-                err_msg = result_json["items"][0]["index"]["error"]["reason"]
-                logger.error(str(datetime.now()) + " --- Log range " + log_start_time_rfc3389 + " to " + log_end_time_rfc3389 + ": Failed to push logs with error code " + str(r.status_code) + ". Root cause: " + err_type + " | " + err_msg + ". \n" + (("Retrying " + str(i+1) + " of " + str(retry_attempt) + "...") if i < (retry_attempt) else ""))
-            else:
-                logger.error(str(datetime.now()) + " --- Log range " + log_start_time_rfc3389 + " to " + log_end_time_rfc3389 + ": Unexpected error occured with error code " + str(r.status_code) + ". Error dump: " + r.text + ". \n" + (("Retrying " + str(i+1) + " of " + str(retry_attempt) + "...") if i < (retry_attempt) else ""))
-            time.sleep(3)
-            continue
-    
-    fail_logger.error("Log range " + log_start_time_rfc3389 + " to " + log_end_time_rfc3389 + " (Push log error)")
-    return False
+            with open(zones_config, mode="r", encoding="utf-8") as config_file:
+                config = json.load(config_file)
+            zones = []
+            for zone in config["zones"]:
+                token = zone.get("token", access_token)
+                if not token and replay_mode is False:
+                    logger.critical("Please specify the Cloudflare Access Token for zone %s.", zone.get("name", zone["zone_id"]))
+                    sys.exit(2)
+                zones.append(Zone(zone.get("name", zone["zone_id"]), zone["zone_id"], token, zone.get("sample_rate", sample_rate), zone.get("fields", fields), zone.get("pipeline", es_pipeline), zone.get("requests_per_minute", requests_per_minute)))
+        except (OSError, json.JSONDecodeError, KeyError, TypeError, AttributeError) as e:
+            logger.critical("Failed to load the zones from %s. Error dump: %s", zones_config, e)
+            sys.exit(2)
         
+        if len(zones) == 0:
+            logger.critical("No zones specified in %s.", zones_config)
+            sys.exit(2)
+        if len(set(zone.name for zone in zones)) != len(zones):
+            logger.critical("The name of each zone in %s must be unique.", zones_config)
+            sys.exit(2)
     
+    #the RayID field must be pulled from Cloudflare in order to use it as the document ID
+    for zone in zones:
+        if doc_id_mode == "rayid" and "RayID" not in zone.fields.split(","):
+            logger.critical("RayID field is not included in the logs of zone %s, it cannot be used as the document ID.", zone.name)
+            sys.exit(2)
+
 '''
-This method will handle the overall log processing tasks and it will run as a separate thread.
-Based on the interval setting configured by the user, this method will only handle logs for a specific time slot.
+This method opens the checkpoint file, unless the user disables it. The checkpoint is not used for one-time operation and replay mode.
 '''
-def logs(current_time, log_start_time_utc, log_end_time_utc):
+def initialize_checkpoint():
     
-    global path, num_of_running_thread, no_store, logger, retry_attempt, store_only, no_organize, no_gzip
+    global checkpoint
     
-    #add one to the variable to indicate number of running threads. useful to determine whether to exit the program gracefully
-    num_of_running_thread += 1
+    if checkpoint_path is None or one_time is True or replay_mode is True:
+        return
     
-    #a variable to check whether the request to Cloudflare API is successful.
-    request_success = False
+    try:
+        Path(checkpoint_path).parent.mkdir(parents=True, exist_ok=True)
+        checkpoint = Checkpoint(checkpoint_path)
+    except (OSError, sqlite3.Error) as e:
+        logger.critical("Failed to open the checkpoint file %s. Error dump: %s", checkpoint_path, e)
+        sys.exit(2)
+
+'''
+This method will be invoked after initialize_es_nodes().
+This method opens the spool, if the user wants the logs that cannot be pushed to be saved. There's no need for the spool if the logs are not pushed to Elasticsearch.
+The logs left in the spool by previous runs are pushed straight away, so the Elasticsearch nodes have to be ready by then.
+'''
+def initialize_spool():
     
-    #if the user instructs the program to do logpush for only one time, the logs will not be stored in folder that follows the naming convention: date and time
-    if one_time is True or no_organize is True:
-        pass
-    else:
-        #get the current date and hour, these will be used to initialize the folder to store the logs
-        today_date = str(current_time.date())
-        current_hour = str(current_time.hour) + "00"
+    global spool
     
-    #get the log start time and log end time in RFC3389 format, so Cloudflare API will understand it and pull the appropriate logs for us
-    log_start_time_rfc3389 = log_start_time_utc.isoformat() + 'Z'
-    log_end_time_rfc3389 = log_end_time_utc.isoformat() + 'Z'
+    if spool_path is None or store_only is True:
+        return
     
-    #check whether the user wants to store a copy of raw logs on the local storage. if yes, begin the folder initialization process
-    if no_store is False:
-        
-        #initialize the folder with the path specified below
-        #if the user instructs the program to do logpush for only one time, it will be stored in another folder instead of the naming convention of the folder: date and time
-        if one_time is True or no_organize is True:
-            path_with_date = path
+    try:
+        spool = Spool(spool_path)
+    except (OSError, ValueError) as e:
+        logger.critical("Failed to open the spool %s. Error dump: %s", spool_path, e)
+        sys.exit(2)
+    
+    if spool.pending() is True:
+        logger.info("Found %s bytes of logs in the spool from previous runs. They will be pushed to Elasticsearch in the background.", spool.size - spool.read_offset)
+
+'''
+This class answers the requests to the metrics endpoint.
+'''
+class MetricsHandler(http.server.BaseHTTPRequestHandler):
+    
+    def do_GET(self):
+        if self.path.split("?", 1)[0] not in ("/metrics", "/"):
+            self.send_error(404)
+            return
+        body = render_metrics()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+    
+    #the requests are not logged, as they are made every few seconds by Prometheus
+    def log_message(self, format, *args):
+        pass
+
+'''
+This method returns all the metrics in Prometheus text format, in bytes.
+'''
+def render_metrics():
+    lines = []
+    for metric in metrics:
+        lines.extend(metric.render())
+    return ("\n".join(lines) + "\n").encode("utf-8")
+
+'''
+This method writes the metrics to the textfile. The metrics are written to a temporary file first, so the textfile is never read half-written.
+'''
+def write_metrics_textfile():
+    try:
+        with open(metrics_textfile + ".tmp", mode="wb") as textfile:
+            textfile.write(render_metrics())
+        os.replace(metrics_textfile + ".tmp", metrics_textfile)
+    except OSError as e:
+        logger.error("Failed to write the metrics to %s. Error dump: %s", metrics_textfile, e)
+
+def metrics_textfile_writer():
+    while True:
+        write_metrics_textfile()
+        time.sleep(metrics_textfile_interval)
+
+'''
+This method starts the metrics endpoint and the textfile writer in the background, if the user wants to export the metrics.
+'''
+def initialize_metrics():
+    if metrics_port is not None:
+        try:
+            server = http.server.ThreadingHTTPServer(("", metrics_port), MetricsHandler)
+        except OSError as e:
+            logger.critical("Failed to export the metrics at port %s. Error dump: %s", metrics_port, e)
+            sys.exit(2)
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever, name="metrics-server", daemon=True).start()
+        logger.info("Metrics are exported at http://0.0.0.0:%s/metrics.", metrics_port)
+    
+    if metrics_textfile is not None:
+        threading.Thread(target=metrics_textfile_writer, name="metrics-textfile", daemon=True).start()
+
+'''
+This method will be invoked after initialize_arg().
+It creates the HTTP sessions shared by all the workers and builds the URLs that are used on every request.
+The headers and the credentials are attached to the sessions, so they don't need to be supplied again on every request.
+Failed connections will be retried by the session itself before the request is given up.
+'''
+def initialize_sessions():
+    
+    global cf_session, es_session, es_base_url, es_pipeline
+    
+    #retry the connection for a few times if it cannot be established. the response itself will not be retried here, as it is handled by the caller
+    #Retry-After is also handled by the caller, otherwise a response with it would be raised as an error here
+    retries = Retry(total=3, connect=3, read=0, status=0, redirect=0, backoff_factor=0.5, respect_retry_after_header=False)
+    
+    cf_session = requests.Session()
+    cf_adapter = HTTPAdapter(pool_connections=1, pool_maxsize=(pool_size if pool_size is not None else fetch_workers), max_retries=retries)
+    cf_session.mount("https://", cf_adapter)
+    cf_session.mount("http://", cf_adapter)
+    cf_session.headers.update({"Content-Type": "application/json", "Accept-Encoding": cf_accept_encoding})
+    
+    es_session = requests.Session()
+    es_adapter = HTTPAdapter(pool_connections=max(16, len(es_urls)), pool_maxsize=(pool_size if pool_size is not None else push_workers), max_retries=retries)
+    es_session.mount("https://", es_adapter)
+    es_session.mount("http://", es_adapter)
+    es_session.headers.update({"Content-Type": "application/json"})
+    es_session.auth = (username, password)
+    es_session.verify = False
+    
+    #specify the URL of the Elasticsearch endpoint, and specify the default ingest pipeline to be used
+    es_base_url = es_url if es_url is not None else http_proto + "://localhost:" + port
+    es_pipeline = pipeline_name if pipeline_name is not None else pipeline_name_prefix + ("daily" if daily_pipeline is True else "weekly")
+    
+'''
+This method will be invoked after initialize_arg().
+This method is to verify whether the Cloudflare Zone ID, Cloudflare Access Token, Elasticsearch username and password given by the user is valid.
+If it is not valid, an error message will be given to the user and the program will exit
+'''
+def verify_credential():
+    
+    global logger, username, password, daily_pipeline, store_only
+    
+    #the logs are not pulled from Cloudflare in replay mode, so there's no need to check the Zone ID and Access Token
+    for zone in (zones if replay_mode is False else []):
+        #make a HTTP request to the Cloudflare API to check the Zone ID and Access Token
+        cf_scheduler.acquire(zone)
+        r = cf_session.get(zone.logs_url, headers=zone.headers)
+        r.encoding = "utf-8"
+        
+        #if there's an error, Cloudflare API will return a JSON object to indicate the error
+        #and if it's not, a plain text will be returned instead
+        #the try except block is to catch any errors raised by json.loads(), in case Cloudflare is not returning JSON object
+        try:
+            response = json.loads(r.text)
+            if response["success"] is False:
+                logger.critical("Failed to authenticate with Cloudflare API. Please check your Zone ID and Cloudflare Access Token%s.", (" of zone " + zone.name if zones_config is not None else ""))
+                sys.exit(2)
+        except json.JSONDecodeError:
+            #a non-JSON object returned by Cloudflare indicates that authentication successful
+            pass
+    
+    #check whether the user wants to store the logs on local storage only. If yes, the below code will be ignored, as there's no need to check for Elasticsearch connectivity.
+    if store_only == False:
+        #check every ingest pipeline used by the zones, each of them only once
+        #if no pipeline is used, only the username and password are checked
+        for pipeline in sorted(set(zone.pipeline for zone in zones)):
+            #specify the Elasticsearch API URL to check the username and password. it also checks whether the ingest pipeline exists in the Elasticsearch
+            url = es_base_url + ("/_ingest/pipeline/" + pipeline if pipeline else "/")
+
+            #make a HTTP request to the Elasticsearch API
+            try:
+                r = es_session.get(url)
+            except requests.exceptions.ConnectionError as e:
+                if "RemoteDisconnected" in str(e):
+                    #If Elasticsearch cluster disconnect the connection, display an error to the user and the program will exit. It may caused by HTTP connection to HTTPS-enabled Elasticsearch cluster
+                    logger.critical("Connection closed by remote Elasticsearch server.%s", ("" if http_proto == "https" else " It may due to performing HTTP request to HTTPS-enabled Elasticsearch server. Try using --https option and try again."))
+                    sys.exit(2)
+                else:
+                    #in the event that the Elasticsearch server is unable to connect, an error message will display to the user and the program will exit
+                    logger.critical("Connection refused by Elasticsearch server. Please check whether the %s is correct, and the server is up and running.", ("URL" if es_url is not None else "port number"))
+                    sys.exit(2)
+            
+            r.encoding = 'utf-8'
+
+            #check the HTTP response code returned by Elasticsearch. if it is 200, means no issue. else, display an error message to the user and exit the program
+            if r.status_code == 200:
+                pass
+            else:
+                logger.debug("Output from Elasticsearch API:\n%s", r.text) #the raw response will be logged only if the user enables debugging
+                if r.status_code == 401:
+                    #error 401 means unauthorized
+                    logger.critical("Failed to authenticate with Elasticsearch API. Please check your Elasticsearch username and password.")
+                    sys.exit(2)
+                elif r.status_code == 404:
+                    #error 404 means the ingest pipeline not exists
+                    logger.critical("%s ingest pipeline is not installed in Elasticsearch. Install first before proceed.", ("Cloudflare " + ("daily" if daily_pipeline is True else "weekly") if pipeline == pipeline_name_prefix + ("daily" if daily_pipeline is True else "weekly") else pipeline))
+                    sys.exit(1)
+                else:
+                    #other kinds of error may occur and this block of code will handle other errors and display to the user accordingly.
+                    try:
+                        response = json.loads(r.text)
+                        if "error" in response:
+                            err_type = response["error"]["root_cause"][0]["type"]
+                            err_msg = response["error"]["root_cause"][0]["reason"]
+                            logger.critical("An error occured with error code %s. Root cause: %s | %s", r.status_code, err_type, err_msg)
+                            sys.exit(1)
+                        else:
+                            logger.critical("Unknown error occured with error code %s. Error dump: %s", r.status_code, r.text)
+                            sys.exit(1)
+                    except json.JSONDecodeError:
+                        logger.critical("Unknown error occured with error code %s. Error dump: %s", r.status_code, r.text)
+                        sys.exit(1)
+    
+
+'''
+This class keeps the Elasticsearch nodes that the bulk requests are spread across, and picks a node for each bulk request,
+either in turn (round-robin), or the one with the fewest bulk requests in progress (least-outstanding).
+A node is taken out once it fails the health check, or once a few bulk requests in a row fail because it cannot be reached or it returns a server error,
+and it's put back once it passes the health check again. If all the nodes are taken out, all of them are used as before, so the bulk requests are still retried.
+With discovery, the list of nodes is refreshed from the cluster on every health check.
+'''
+class NodePool:
+    
+    #the number of bulk requests in a row that fail before the node is taken out
+    max_failures = 3
+    
+    def __init__(self, urls):
+        self.lock = threading.Lock()
+        self.nodes = [self.new_node(url) for url in urls]
+        self.next_index = 0
+    
+    @staticmethod
+    def new_node(url):
+        return {"url": url, "healthy": True, "outstanding": 0, "failures": 0}
+    
+    #pick a node for a bulk request. release() has to be called once the request is done
+    def acquire(self):
+        with self.lock:
+            nodes = [node for node in self.nodes if node["healthy"] is True] or self.nodes
+            start = self.next_index % len(nodes)
+            self.next_index += 1
+            if es_balance == "least-outstanding":
+                node = min(nodes[start:] + nodes[:start], key=lambda node: node["outstanding"])
+            else:
+                node = nodes[start]
+            node["outstanding"] += 1
+            return node
+    
+    #failed is True if the node cannot be reached or it returns a server error
+    def release(self, node, failed):
+        with self.lock:
+            node["outstanding"] -= 1
+            node["failures"] = node["failures"] + 1 if failed is True else 0
+            taken_out = node["healthy"] is True and node["failures"] >= self.max_failures and len(self.nodes) > 1
+            if taken_out is True:
+                node["healthy"] = False
+        if taken_out is True:
+            logger.warning("Elasticsearch node %s failed %s bulk requests in a row. It will not be used until it passes the health check.", node["url"], node["failures"])
+    
+    #get the list of ingest nodes from the cluster, from any of the nodes known so far. it returns True if the list has been refreshed
+    def discover(self):
+        with self.lock:
+            urls = [node["url"] for node in self.nodes]
+        
+        for url in urls:
+            try:
+                r = es_session.get(url + "/_nodes/http", timeout=10)
+                addresses = []
+                for node_info in r.json()["nodes"].values():
+                    #the nodes without the ingest role are left out, as they cannot run the ingest pipelines. older versions don't list the roles
+                    if "ingest" in node_info.get("roles", ["ingest"]):
+                        addresses.append(node_info["http"]["publish_address"])
+                break
+            except (requests.exceptions.RequestException, ValueError, KeyError, TypeError, AttributeError) as e:
+                logger.error("Failed to discover the Elasticsearch nodes from %s. Error dump: %s", url, e)
+        else:
+            return False
+        
+        if len(addresses) == 0:
+            logger.error("No ingest nodes found in the Elasticsearch cluster. The nodes known so far will be used.")
+            return False
+        
+        #the address may be given as hostname/ip:port, and the IP address is used
+        discovered = sorted(set(http_proto + "://" + address.rsplit("/", 1)[-1] for address in addresses))
+        with self.lock:
+            known = {node["url"]: node for node in self.nodes}
+            self.nodes = [known.get(url) or self.new_node(url) for url in discovered]
+        if set(discovered) != set(known):
+            logger.info("Discovered %s Elasticsearch nodes: %s", len(discovered), ", ".join(discovered))
+        return True
+    
+    #this method runs in a separate thread. it checks every node regularly, and puts back the nodes that have recovered
+    def health_check(self):
+        while True:
+            time.sleep(es_health_interval)
+            if es_discover is True:
+                self.discover()
+            
+            with self.lock:
+                nodes = list(self.nodes)
+            for node in nodes:
+                try:
+                    healthy = es_session.get(node["url"] + "/", timeout=5).status_code == 200
+                except requests.exceptions.RequestException:
+                    healthy = False
+                
+                with self.lock:
+                    changed = node["healthy"] is not healthy
+                    node["healthy"] = healthy
+                    if healthy is True:
+                        node["failures"] = 0
+                if changed is True and healthy is True:
+                    logger.info("Elasticsearch node %s has recovered. It will be used again.", node["url"])
+                elif changed is True:
+                    logger.warning("Elasticsearch node %s failed the health check. It will not be used until it recovers.", node["url"])
+
+'''
+This method will be invoked after verify_credential(), and before initialize_spool(), as the spool starts pushing the logs left by previous runs once it's opened.
+It prepares the Elasticsearch nodes that the bulk requests are spread across, which are the URLs given by the user, or the nodes discovered from the cluster.
+If there are more than one node, they are checked regularly in a separate thread.
+'''
+def initialize_es_nodes():
+    
+    global es_nodes
+    
+    es_nodes = NodePool(es_urls if len(es_urls) > 0 else [es_base_url])
+    if store_only is True:
+        return
+    
+    if es_discover is True:
+        es_nodes.discover()
+    
+    if len(es_nodes.nodes) > 1:
+        logger.info("Bulk requests will be spread across %s Elasticsearch nodes (%s).", len(es_nodes.nodes), es_balance)
+    if len(es_nodes.nodes) > 1 or es_discover is True:
+        threading.Thread(target=es_nodes.health_check, name="es-health-check", daemon=True).start()
+
+'''
+This method is to initialize the folder with the date and time of the logs being stored on local storage as the name of the folder
+If the folder does not exists, it will automatically create a new one
+'''
+def initialize_folder(path_with_date):
+    data_folder = Path(path_with_date)
+    data_folder.mkdir(parents=True, exist_ok=True)
+    return data_folder
+
+'''
+This method is to prepare the path of where the logfile will be stored and what will be the name of the logfile.
+If the logfile already exists, either compressed or not, we assume that the logs has been pulled from Cloudflare previously
+unless the log range is pulled again because the checkpoint shows it was missed or failed, then the logfile will be replaced.
+The Parquet files may have been merged with the others in the same hour folder, so the log range is also treated as pulled if a merged logfile covers it.
+'''
+def prepare_path(log_start_time_rfc3389, log_end_time_rfc3389, data_folder, overwrite=False):
+    logfile_name = logfile_name_prefix + "_" + log_start_time_rfc3389 + "~" + log_end_time_rfc3389 + ".json"
+    logfile_path = data_folder / logfile_name
+    
+    if overwrite is False and (os.path.exists(str(logfile_path) + ".gz") or os.path.exists(str(logfile_path) + ".zst") or os.path.exists(str(logfile_path)) or os.path.exists(str(logfile_path.with_suffix(".parquet")))):
+        return False
+    
+    #a merged logfile has no gaps, as only the logfiles next to each other are merged
+    if overwrite is False and archive_format == "parquet":
+        log_start_time, log_end_time = parse_rfc3339(log_start_time_rfc3389), parse_rfc3339(log_end_time_rfc3389)
+        if any(start <= log_start_time and end >= log_end_time for start, end in partition_ranges(data_folder)):
+            return False
+    
+    return logfile_path
+    
+'''
+A method to get the time ranges of the Parquet files in an hour folder, which are listed from the folder only the first time.
+'''
+def partition_ranges(partition):
+    with archive_ranges_lock:
+        ranges = archive_ranges.get(str(partition))
+    if ranges is not None:
+        return ranges
+    
+    ranges = []
+    for logfile_path in partition.glob(logfile_name_prefix + "_*~*.parquet"):
+        parsed = parse_logfile_name(logfile_path.name)
+        if parsed is not None:
+            ranges.append((parse_rfc3339(parsed[0]), parse_rfc3339(parsed[1])))
+    with archive_ranges_lock:
+        #compaction may have saved the time ranges of the folder in the meantime, which are newer
+        return archive_ranges.setdefault(str(partition), ranges)
+
+'''
+This class handles the program exit, and keeps count of the log ranges in progress.
+Once the program receives SIGINT (Ctrl+C) or SIGTERM (e.g. from systemd), the scheduler stops handing out log ranges, and the workers are given until the drain deadline
+to finish the log ranges in progress. After the deadline, the workers stop retrying, the logs not pushed yet are saved to the spool (if enabled), and the log ranges
+that cannot be finished are recorded as failed, so they will be pulled again after the program restarts. Receiving the signal again brings the deadline forward to now.
+'''
+class Lifecycle:
+    
+    #the workers are given a few more seconds after the deadline to save the logs to the spool, then the program exits without waiting for them
+    grace = 5.0
+    
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.in_flight = 0
+        self.signal_name = None
+        self.deadline = None
+        self.forced = False
+    
+    #the signal handlers can only be installed by the main thread
+    def install(self):
+        signal.signal(signal.SIGINT, self.handle_signal)
+        signal.signal(signal.SIGTERM, self.handle_signal)
+    
+    #only the flags are set here, as the signal may arrive while the main thread is holding a lock. the main thread checks them regularly
+    def handle_signal(self, signum, frame):
+        if self.deadline is None:
+            self.signal_name = signal.Signals(signum).name
+            self.deadline = time.time() + drain_timeout
+        else:
+            self.forced = True
+            self.deadline = time.time()
+    
+    def stopping(self):
+        return self.deadline is not None
+    
+    def expired(self):
+        return self.deadline is not None and time.time() >= self.deadline
+    
+    #to be called once a log range is being pulled, and once it has been done
+    def begin(self):
+        with self.lock:
+            self.in_flight += 1
+    
+    def end(self):
+        with self.lock:
+            self.in_flight -= 1
+    
+    #sleep for the given seconds, but wake up once the program is asked to exit. it returns True if the program is exiting
+    def wait(self, seconds):
+        until = time.time() + seconds
+        while self.deadline is None and time.time() < until:
+            time.sleep(max(0.0, min(until - time.time(), 0.5)))
+        return self.deadline is not None
+    
+    #the same for the workers between retries, but they only wake up once the drain deadline has passed
+    def backoff(self, seconds):
+        until = time.time() + seconds
+        while self.expired() is False and time.time() < until:
+            time.sleep(max(0.0, min(until - time.time(), 0.5)))
+        return self.expired()
+    
+    #wait for the threads to finish, until the end of the grace period after the deadline. it returns the threads that are still running
+    def join(self, threads):
+        for thread in threads:
+            while thread.is_alive() and not (self.expired() and time.time() >= self.deadline + self.grace):
+                thread.join(0.5)
+                if self.forced is True:
+                    logger.warning("Received %s again. Stopping the log ranges in progress now...", self.signal_name)
+                    self.forced = None
+        return [thread for thread in threads if thread.is_alive()]
+
+lifecycle = Lifecycle()
+
+'''
+This class keeps the progress of one-time operation, which is split into many log ranges.
+It counts the log ranges that have been done and the logs that have been pulled, so the progress and the throughput can be reported to the user.
+'''
+class BackfillProgress:
+    
+    def __init__(self, total):
+        self.total = total
+        self.done = self.failed = self.skipped = 0
+        self.number_of_logs = 0
+        self.start = time.monotonic()
+        self.condition = threading.Condition()
+    
+    #to be called once a log range has been done, either successfully or not
+    def record(self, log_range):
+        with self.condition:
+            if log_range.skipped is True:
+                self.skipped += 1
+            elif log_range.error is None:
+                self.done += 1
+            else:
+                self.failed += 1
+            self.number_of_logs += log_range.number_of_logs
+            self.condition.notify_all()
+    
+    def finished(self):
+        return self.done + self.failed + self.skipped >= self.total
+    
+    #wait until all the log ranges have been done, or until the timeout. it returns True if all of them have been done
+    def wait(self, timeout):
+        with self.condition:
+            return self.condition.wait_for(self.finished, timeout)
+    
+    def report(self):
+        with self.condition:
+            elapsed = max(time.monotonic() - self.start, 0.001)
+            finished = self.done + self.failed + self.skipped
+            eta = (elapsed / finished * (self.total - finished)) if finished > 0 else None
+            return (str(finished) + " of " + str(self.total) + " log ranges done (" + str(self.failed) + " failed, " + str(self.skipped) + " skipped), " + str(self.number_of_logs) + " logs in " + str(int(elapsed)) + " seconds, "
+                + str(int(self.number_of_logs / elapsed)) + " logs/s" + ((", about " + str(int(eta)) + " seconds remaining.") if eta is not None and finished < self.total else "."))
+
+'''
+This class saves the state of each log range in a SQLite database, so the program knows which log ranges have been pulled and pushed successfully after it restarts.
+Only the log ranges handed to the fetch workers by the scheduler are saved. The log ranges that are still in progress are kept in memory,
+so they will not be mistaken as missed log ranges.
+'''
+class Checkpoint:
+    
+    def __init__(self, checkpoint_path):
+        self.lock = threading.Lock()
+        self.pending = set()
+        
+        #the connection is shared by all the workers, and it is protected by the lock
+        self.connection = sqlite3.connect(checkpoint_path, check_same_thread=False, isolation_level=None)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS log_ranges (zone TEXT NOT NULL, start_time TEXT NOT NULL, end_time TEXT NOT NULL, status TEXT NOT NULL, attempts INTEGER NOT NULL, updated TEXT NOT NULL, PRIMARY KEY (zone, start_time, end_time))")
+    
+    #to be called by the scheduler once the log range has been handed to the fetch workers
+    def add_pending(self, log_range):
+        with self.lock:
+            self.pending.add((log_range.zone.name, log_range.log_start_time_utc, log_range.log_end_time_utc))
+    
+    #to be called by the scheduler if the log range cannot be handed to the fetch workers
+    def remove_pending(self, log_range):
+        with self.lock:
+            self.pending.discard((log_range.zone.name, log_range.log_start_time_utc, log_range.log_end_time_utc))
+    
+    #save the result of the log range, either "done" or "failed"
+    def record(self, log_range, status):
+        with self.lock:
+            self.pending.discard((log_range.zone.name, log_range.log_start_time_utc, log_range.log_end_time_utc))
+            self.connection.execute("INSERT INTO log_ranges VALUES (?, ?, ?, ?, 1, ?) ON CONFLICT (zone, start_time, end_time) DO UPDATE SET status = excluded.status, attempts = attempts + 1, updated = excluded.updated", (log_range.zone.name, log_range.log_start_time_utc.isoformat(), log_range.log_end_time_utc.isoformat(), status, datetime.utcnow().isoformat()))
+    
+    def is_done(self, log_range):
+        with self.lock:
+            row = self.connection.execute("SELECT 1 FROM log_ranges WHERE zone = ? AND start_time = ? AND end_time = ? AND status = 'done'", (log_range.zone.name, log_range.log_start_time_utc.isoformat(), log_range.log_end_time_utc.isoformat())).fetchone()
+        return row is not None
+    
+    #find the time slots of the zone between since and until, that have not been pulled and pushed successfully and are not in progress
+    #the time slots before the first log range saved in the checkpoint are not counted, as the program was not pulling logs of the zone back then
+    #a log range which failed is pulled again as it is, so its result is saved to the same row. the rest is split the same way as the scheduler does, by the window size of the zone
+    def find_gaps(self, zone, since, until):
+        with self.lock:
+            rows = self.connection.execute("SELECT start_time, end_time, status FROM log_ranges WHERE zone = ? AND end_time > ? AND start_time < ? ORDER BY start_time", (zone.name, since.isoformat(), until.isoformat())).fetchall()
+            covered = [(datetime.fromisoformat(start), datetime.fromisoformat(end)) for start, end, status in rows if status == "done"]
+            covered += [(start, end) for name, start, end in self.pending if name == zone.name and end > since and start < until]
+        
+        if len(rows) == 0:
+            return []
+        failed = set((datetime.fromisoformat(start), datetime.fromisoformat(end)) for start, end, status in rows if status != "done")
+        cuts = sorted(set(point for log_range in failed for point in log_range))
+        
+        #walk through the time slots that have been covered, from the first log range saved in the checkpoint, and take note of the time slots in between
+        spans = []
+        cursor = max(since, datetime.fromisoformat(rows[0][0]))
+        for start, end in sorted(covered):
+            if cursor < min(start, until):
+                spans.append((cursor, min(start, until)))
+            cursor = max(cursor, end)
+        if cursor < until:
+            spans.append((cursor, until))
+        
+        gaps = []
+        for span_start, span_end in spans:
+            points = [span_start] + [point for point in cuts if span_start < point < span_end] + [span_end]
+            for piece_start, piece_end in zip(points, points[1:]):
+                if (piece_start, piece_end) in failed:
+                    gaps.append((piece_start, piece_end))
+                    continue
+                cursor = piece_start
+                while cursor < piece_end:
+                    window = zone.window_sizer.current()
+                    if adaptive_window is True:
+                        window = min(window, (cursor.replace(minute=0, second=0, microsecond=0) + timedelta(hours=1) - cursor).total_seconds())
+                    gaps.append((cursor, min(cursor + timedelta(seconds=window), piece_end)))
+                    cursor = gaps[-1][1]
+        
+        return gaps
+
+'''
+This class is a durable queue of the chunks that cannot be pushed to Elasticsearch, saved on local storage.
+The chunks are appended to segment files, each of them up to the segment size. A background thread pushes the chunks again in the order they are saved,
+no faster than the replay rate, and deletes a segment once all the chunks in it have been pushed. The position of the next chunk is saved after every chunk,
+so the chunks are not pushed twice if the program restarts.
+While there are chunks in the spool, the new chunks are appended to the spool instead of being pushed directly, so they are pushed in order and the workers
+don't spend their retries on Elasticsearch while it's down. Pulling logs from Cloudflare can carry on at full speed in the meantime.
+
+Each chunk is saved as a line of JSON with the zone, the log range and the size of the chunk, followed by the chunk itself.
+'''
+class Spool:
+    
+    def __init__(self, path):
+        self.path = Path(path)
+        self.path.mkdir(parents=True, exist_ok=True)
+        self.condition = threading.Condition()
+        self.limiter = RateLimiter(spool_replay_rate)
+        
+        #the segments left by previous runs are kept, and a new segment is always started for writing, in case the last one is incomplete
+        for sequence in self.segments():
+            if os.path.getsize(self.segment_path(sequence)) == 0:
+                os.remove(self.segment_path(sequence))
+        segments = self.segments()
+        self.size = sum(os.path.getsize(self.segment_path(sequence)) for sequence in segments)
+        self.write_sequence = (segments[-1] + 1) if len(segments) > 0 else 1
+        self.write_size = 0
+        self.output = open(self.segment_path(self.write_sequence), mode="ab")
+        
+        #start from the position saved previously, or from the beginning of the oldest segment
+        self.read_sequence, self.read_offset = segments[0] if len(segments) > 0 else self.write_sequence, 0
+        try:
+            with open(self.path / "position", encoding="utf-8") as position_file:
+                position = json.load(position_file)
+            if position["segment"] in segments:
+                self.read_sequence, self.read_offset = position["segment"], position["offset"]
+        except FileNotFoundError:
+            pass
+        
+        self.thread = threading.Thread(target=self.replay, name="spool-replayer", daemon=True)
+        self.thread.start()
+    
+    def segments(self):
+        return sorted(int(name[:-len(".spool")]) for name in os.listdir(self.path) if name.endswith(".spool") and name[:-len(".spool")].isdigit())
+    
+    def segment_path(self, sequence):
+        return self.path / ("%012d.spool" % sequence)
+    
+    #whether there are chunks in the spool waiting to be pushed. if the replayer has stopped, nothing is waiting for it anymore, so the new chunks are pushed straight away
+    def pending(self):
+        with self.condition:
+            return self.thread.is_alive() and (self.read_sequence, self.read_offset) != (self.write_sequence, self.write_size)
+    
+    #save the chunk of the log range to the spool. it returns False if the spool is full or it cannot be written, then the chunk is failed as before
+    def append(self, log_range, final_json, number_of_logs):
+        if isinstance(final_json, str):
+            final_json = final_json.encode("utf-8")
+        header = json.dumps({"zone": log_range.zone.name, "start": log_range.log_start_time_rfc3389, "end": log_range.log_end_time_rfc3389, "logs": number_of_logs, "bytes": len(final_json)}).encode("utf-8") + b"\n"
+        
+        with self.condition:
+            if self.size + len(header) + len(final_json) > spool_max_size:
+                logger.error("%s: The spool is full. %s logs cannot be saved to the spool.", log_range.description, number_of_logs)
+                return False
+            
+            try:
+                #start a new segment once the current one is full
+                if self.write_size > 0 and self.write_size + len(header) + len(final_json) > spool_segment_size:
+                    self.output.close()
+                    self.write_sequence += 1
+                    self.write_size = 0
+                    self.output = open(self.segment_path(self.write_sequence), mode="ab")
+                
+                self.output.write(header)
+                self.output.write(final_json)
+                self.output.flush()
+                os.fsync(self.output.fileno())
+            except OSError as e:
+                logger.error("%s: Failed to save %s logs to the spool. Error dump: %s", log_range.description, number_of_logs, e)
+                return False
+            
+            self.write_size += len(header) + len(final_json)
+            self.size += len(header) + len(final_json)
+            self.condition.notify_all()
+        
+        metric_spool_chunks.inc(result="saved", zone=log_range.zone.name)
+        logger.warning("%s: %s logs saved to the spool. They will be pushed to Elasticsearch once it recovers.", log_range.description, number_of_logs)
+        return True
+    
+    #save the position of the next chunk to be pushed. it's written to a temporary file first, so the position is never half-written
+    def save_position(self):
+        with open(self.path / "position.tmp", mode="w", encoding="utf-8") as position_file:
+            json.dump({"segment": self.read_sequence, "offset": self.read_offset}, position_file)
+        os.replace(self.path / "position.tmp", self.path / "position")
+    
+    #wait for the next chunk in the spool, and return it with the header. a segment which has been read to the end is deleted, unless it's still being written
+    def next_chunk(self):
+        while True:
+            with self.condition:
+                while (self.read_sequence, self.read_offset) == (self.write_sequence, self.write_size):
+                    self.condition.wait()
+                writing = self.read_sequence == self.write_sequence
+            
+            segment_path = self.segment_path(self.read_sequence)
+            try:
+                with open(segment_path, mode="rb") as segment:
+                    segment.seek(self.read_offset)
+                    line = segment.readline()
+                    header = json.loads(line) if line.endswith(b"\n") else None
+                    if header is not None and not all(key in header for key in ("zone", "start", "end", "logs", "bytes")):
+                        raise ValueError("Invalid chunk header " + line.decode("utf-8", "replace").strip())
+                    final_json = segment.read(header["bytes"]) if header is not None else None
+                if header is not None and len(final_json) == header["bytes"]:
+                    return header, final_json, len(line) + len(final_json)
+            except FileNotFoundError:
+                pass
+            except (OSError, ValueError, KeyError, TypeError) as e:
+                logger.error("Failed to read the spool segment %s, the rest of it is skipped. Error dump: %s", segment_path, e)
+            
+            if writing is True:
+                #the segment being written cannot end with an incomplete chunk, as it's only read up to what has been written
+                time.sleep(1)
+                continue
+            
+            #the segment has been read to the end, or the rest of it is incomplete because the program stopped while writing it
+            with self.condition:
+                try:
+                    self.size -= os.path.getsize(segment_path)
+                    os.remove(segment_path)
+                except OSError:
+                    pass
+                later = [sequence for sequence in self.segments() if sequence > self.read_sequence]
+                self.read_sequence, self.read_offset = (later[0] if len(later) > 0 else self.write_sequence), 0
+                self.save_position()
+    
+    #this method runs in the thread, it pushes the chunks in the spool one by one. an unexpected error must not stop the thread, otherwise the chunks in the spool are never pushed
+    #the chunk is only passed once it has been pushed, so the same chunk is pushed again after the error
+    def replay(self):
+        while True:
+            try:
+                self.replay_chunk()
+            except Exception as e:
+                logger.error("Unexpected error occured while pushing the logs in the spool to Elasticsearch. Retrying in %s seconds... Error dump: %s: %s", spool_retry_delay, type(e).__name__, e)
+                time.sleep(spool_retry_delay)
+    
+    #push the next chunk in the spool, and wait for Elasticsearch to recover if it still cannot be pushed
+    #after the maximum attempts, the logs left in the chunk are written to the dead-letter file, so the chunks after it are not held up forever
+    def replay_chunk(self):
+        header, final_json, length = self.next_chunk()
+        chunk = {"final_json": final_json, "logs": header["logs"]}
+        
+        #the logs of a zone not configured anymore are pushed with the default ingest pipeline
+        zone = next((zone for zone in zones if zone.name == header["zone"]), None)
+        if zone is None:
+            zone = Zone(header["zone"], header["zone"], "", 1, "", es_pipeline, None)
+        log_range = LogRange(zone, None, datetime.strptime(header["start"], "%Y-%m-%dT%H:%M:%SZ"), datetime.strptime(header["end"], "%Y-%m-%dT%H:%M:%SZ"), scheduled=False)
+        
+        #only the logs that are still not pushed will be pushed on the next attempt
+        def keep_remaining(final_json, number_of_logs):
+            chunk["final_json"], chunk["logs"] = final_json, number_of_logs
+            return False
+        
+        attempts = 0
+        result = "replayed"
+        while True:
+            wait = self.limiter.try_acquire()
+            if wait > 0:
+                time.sleep(wait)
+                continue
+            
+            logger.info("%s: Pushing %s logs in the spool to Elasticsearch...", log_range.description, chunk["logs"])
+            if push_logs(chunk["final_json"], log_range, chunk["logs"], on_failure=keep_remaining) is True:
+                break
+            
+            attempts += 1
+            if spool_max_attempts > 0 and attempts >= spool_max_attempts:
+                dead_letters = chunk_dead_letters(chunk["final_json"], None, {"type": "spool_max_attempts", "reason": "Failed to push the logs in the spool after " + str(attempts) + " attempts"})
+                logger.error("%s: Failed to push the logs in the spool to Elasticsearch after %s attempts. %s logs are given up. %s", log_range.description, attempts, chunk["logs"], ("They are saved to " + dead_letter_path + "." if write_dead_letters(log_range, dead_letters) else ""))
+                result = "dead_lettered"
+                break
+            logger.error("%s: Failed to push the logs in the spool to Elasticsearch. Retrying in %s seconds...", log_range.description, spool_retry_delay)
+            time.sleep(spool_retry_delay)
+        
+        metric_spool_chunks.inc(result=result, zone=header["zone"])
+        with self.condition:
+            self.read_offset += length
+            try:
+                self.save_position()
+            except OSError as e:
+                logger.error("Failed to save the position of the spool. Error dump: %s", e)
+    
+    #to be called once the workers have stopped. the chunks left in the spool will be pushed the next time the program starts
+    def close(self):
+        with self.condition:
+            self.output.close()
+            pending = (self.read_sequence, self.read_offset) != (self.write_sequence, self.write_size)
+            if self.write_size == 0 or pending is False:
+                os.remove(self.segment_path(self.write_sequence))
+        if pending is True:
+            logger.info("There are logs left in the spool, which takes up %s bytes on local storage. They will be pushed to Elasticsearch the next time the program starts.", self.size)
+
+'''
+A log range is the time slot of logs handled by the workers.
+The fetch worker pulls the logs of the log range from Cloudflare and hands them to the push workers in one or more chunks.
+The result of the log range will be recorded in succ.log or fail.log only after the logs have been pulled and all of its chunks have been pushed.
+'''
+class LogRange:
+    
+    def __init__(self, zone, current_time, log_start_time_utc, log_end_time_utc, scheduled=True, backfill=False):
+        self.zone = zone
+        self.current_time = current_time
+        self.scheduled = scheduled
+        self.backfill = backfill
+        self.log_start_time_utc = log_start_time_utc
+        self.log_end_time_utc = log_end_time_utc
+        
+        #get the log start time and log end time in RFC3389 format, so Cloudflare API will understand it and pull the appropriate logs for us
+        self.log_start_time_rfc3389 = log_start_time_utc.isoformat() + 'Z'
+        self.log_end_time_rfc3389 = log_end_time_utc.isoformat() + 'Z'
+        
+        #the log range will be described this way in the program logs, succ.log and fail.log. the zone is included only if there are multiple zones
+        self.description = "Log range " + self.log_start_time_rfc3389 + " to " + self.log_end_time_rfc3389 + (" of zone " + zone.name if zones_config is not None else "")
+        
+        self.number_of_logs = 0
+        self.number_of_bytes = 0
+        self.wire_bytes = 0
+        self.pending_chunks = 0
+        self.fetch_done = False
+        self.skipped = False
+        self.error = None
+        self.lock = threading.Lock()
+        
+        #the logs are counted into the rollups while they are being handed to the push workers
+        self.rollup = Rollup(self) if rollup_mode is True else None
+    
+    #to be called by the fetch worker before a chunk is handed to the push workers
+    def add_chunk(self):
+        with self.lock:
+            self.pending_chunks += 1
+    
+    #to be called by the push worker after a chunk has been pushed, either successfully or not
+    def chunk_done(self, success):
+        with self.lock:
+            self.pending_chunks -= 1
+            if success is False and self.error is None:
+                self.error = "Push log error"
+            done = self.fetch_done and self.pending_chunks == 0
+        if done:
+            self.finish()
+    
+    #to be called by the fetch worker once it has nothing more to hand to the push workers
+    #error is the reason to be recorded in fail.log, and skipped means there's nothing to record at all
+    def finish_fetch(self, error=None, skipped=False):
+        with self.lock:
+            #the log range may be cancelled after it has been pulled, then it's already finished, or will be once the chunks are pushed
+            if self.fetch_done is True:
+                return
+            self.fetch_done = True
+            self.skipped = skipped
+            if error is not None and self.error is None:
+                self.error = error
+            done = self.pending_chunks == 0
+        if done:
+            self.finish()
+    
+    def finish(self):
+        if self.skipped is False:
+            if self.error is None:
+                succ_logger.info(self.description)
+            else:
+                fail_logger.error(self.description + " (" + self.error + ")")
+        
+        #save the result of the log range handed to the fetch workers by the scheduler, so it can be pulled again after the program restarts if it failed
+        #a log range skipped because it has been pulled previously is counted as done
+        if checkpoint is not None and self.scheduled is True:
+            try:
+                checkpoint.record(self, "done" if self.error is None else "failed")
+            except sqlite3.Error as e:
+                logger.error("%s: Failed to save the checkpoint. Error dump: %s", self.description, e)
+        if backfill_progress is not None and self.scheduled is False:
+            backfill_progress.record(self)
+        
+        metric_log_ranges.inc(zone=self.zone.name, result="skipped" if self.skipped is True else ("done" if self.error is None else "failed"))
+        metric_fetch_bytes.inc(self.number_of_bytes, zone=self.zone.name)
+        metric_fetch_wire_bytes.inc(self.wire_bytes, zone=self.zone.name)
+        metric_fetch_logs.inc(self.number_of_logs, zone=self.zone.name)
+        if self.scheduled is True and self.backfill is False and self.error is None:
+            metric_ingest_lag.set((datetime.utcnow() - self.log_end_time_utc).total_seconds(), zone=self.zone.name)
+        
+        #the log ranges that are due are used to learn the traffic of the zone, for the size of the next log ranges
+        if self.scheduled is True and self.backfill is False and self.skipped is False and self.error is None:
+            self.zone.window_sizer.record(self)
+        lifecycle.end()
+
+'''
+This class is responsible to write the raw logs to local storage, and compress them while they are being written.
+The logs are handed to a separate thread in blocks, so the compression does not hold up pulling logs from Cloudflare and pushing them to Elasticsearch.
+The logs are written to a temporary file first, which is renamed to the logfile only after all of them have been written successfully,
+so an incomplete logfile will never be mistaken as a log range that has been pulled previously.
+'''
+class ArchiveWriter:
+    
+    #the logs are handed to the thread once they reach this size
+    block_size = 1024 * 1024
+    
+    def __init__(self, logfile_path):
+        self.logfile_name = os.path.basename(str(logfile_path))
+        self.path = self.archive_path(logfile_path)
+        self.temp_path = self.path + ".part"
+        self.buffer = []
+        self.buffer_size = 0
+        self.error = None
+        
+        #the queue is bounded, so the logs will not pile up in memory if the disk is slower than the network
+        self.blocks = queue.Queue(maxsize=16)
+        self.thread = threading.Thread(target=self.run, name="archive-writer", daemon=True)
+        self.thread.start()
+    
+    def archive_path(self, logfile_path):
+        return str(logfile_path) + {"gzip": ".gz", "zstd": ".zst", "none": ""}[compression]
+    
+    def write(self, data):
+        self.buffer.append(data)
+        self.buffer_size += len(data)
+        if self.buffer_size >= self.block_size:
+            self.flush()
+    
+    def flush(self):
+        if self.buffer_size > 0:
+            self.blocks.put(b"".join(self.buffer))
+            self.buffer = []
+            self.buffer_size = 0
+    
+    #this method runs in the thread, it writes and compresses the blocks until it receives None from the queue
+    #the time spent on writing and compressing is added up, for the metrics
+    def run(self):
+        self.write_time = 0.0
+        logfile = output = None
+        try:
+            logfile = open(self.temp_path, mode="wb")
+            if compression == "gzip":
+                output = gzip.GzipFile(filename=self.logfile_name, mode="wb", compresslevel=compression_level, fileobj=logfile)
+            elif compression == "zstd":
+                output = zstandard.ZstdCompressor(level=compression_level).stream_writer(logfile)
+            else:
+                output = logfile
+        except Exception as e:
+            self.error = e
+        
+        #keep taking the blocks from the queue even if there's an error, so the caller will never wait forever
+        while True:
+            block = self.blocks.get()
+            if block is None:
+                break
+            if self.error is None:
+                try:
+                    write_time = time.time()
+                    output.write(block)
+                    self.write_time += time.time() - write_time
+                except Exception as e:
+                    self.error = e
+        
+        try:
+            if output is not None:
+                output.close()
+            if logfile is not None:
+                logfile.close()
+        except Exception as e:
+            if self.error is None:
+                self.error = e
+    
+    #finish writing the logfile. it returns True if the logfile has been written successfully
+    def close(self):
+        self.flush()
+        self.blocks.put(None)
+        self.thread.join()
+        
+        if self.error is None:
+            try:
+                os.replace(self.temp_path, self.path)
+                metric_compress_seconds.observe(self.write_time, compression=compression)
+                return True
+            except OSError as e:
+                self.error = e
+        
+        logger.error("Failed to write logfile %s. Error dump: %s", self.path, self.error)
+        self.remove_temp()
+        return False
+    
+    #stop writing the logfile and remove it, e.g. when the logs cannot be pulled completely from Cloudflare
+    def abort(self):
+        self.buffer = []
+        self.buffer_size = 0
+        self.blocks.put(None)
+        self.thread.join()
+        self.remove_temp()
+    
+    def remove_temp(self):
+        try:
+            if os.path.exists(self.temp_path):
+                os.remove(self.temp_path)
+        except OSError:
+            pass
+
+'''
+This method builds the schema of the Parquet files from the fields of the logs pulled from Cloudflare, so every logfile of a zone has the same columns.
+'''
+def archive_schema(zone_fields):
+    types = {"int": pyarrow.int64(), "float": pyarrow.float64(), "bool": pyarrow.bool_(), "timestamp": pyarrow.timestamp("ns", tz="UTC"), "list": pyarrow.list_(pyarrow.string())}
+    return pyarrow.schema([(field, types.get(archive_field_types.get(field), pyarrow.string())) for field in zone_fields.split(",") if field])
+
+'''
+This method returns the writer for the logfile of a log range, in the archive format chosen by the user.
+'''
+def open_archive(logfile_path, zone):
+    if archive_format == "parquet":
+        return ParquetArchiveWriter(logfile_path, zone.archive_schema)
+    return ArchiveWriter(logfile_path)
+
+'''
+This class writes the raw logs to local storage as a Parquet file instead, with a column for each field, so the logs can be read by column without going through every log.
+It works the same as ArchiveWriter, the blocks of raw logs are converted and written as row groups in the thread. The fields holding a JSON object are kept as JSON text,
+which needs the logs to be parsed once more, as the JSON reader of pyarrow cannot convert them.
+'''
+class ParquetArchiveWriter(ArchiveWriter):
+    
+    #each block is written as a row group. bigger row groups are compressed better and read faster
+    block_size = 8 * 1024 * 1024
+    
+    def __init__(self, logfile_path, schema):
+        self.schema = schema
+        self.object_fields = [field.name for field in schema if archive_field_types.get(field.name) == "object"]
+        self.parse_options = pyarrow.json.ParseOptions(explicit_schema=pyarrow.schema([field for field in schema if field.name not in self.object_fields]), unexpected_field_behavior="ignore")
+        super().__init__(logfile_path)
+    
+    def archive_path(self, logfile_path):
+        return str(Path(logfile_path).with_suffix(".parquet"))
+    
+    #convert a block of raw logs into a table with the columns of the schema
+    def convert(self, block):
+        table = pyarrow.json.read_json(pyarrow.BufferReader(block), parse_options=self.parse_options)
+        
+        #the logs are only parsed again if the fields holding a JSON object are found in them
+        logs = None
+        for field in self.object_fields:
+            index = self.schema.get_field_index(field)
+            if b'"' + field.encode("utf-8") + b'"' in block:
+                if logs is None:
+                    logs = [json.loads(line) for line in block.split(b"\n") if line.strip()]
+                values = pyarrow.array([json.dumps(log[field], separators=(",", ":"), ensure_ascii=False) if log.get(field) is not None else None for log in logs], type=pyarrow.string())
+            else:
+                values = pyarrow.nulls(table.num_rows, type=pyarrow.string())
+            table = table.add_column(index, self.schema.field(index), values)
+        return table
+    
+    #this method runs in the thread, the same as ArchiveWriter.run()
+    def run(self):
+        self.write_time = 0.0
+        output = None
+        
+        while True:
+            block = self.blocks.get()
+            if block is None:
+                break
+            if self.error is None:
+                try:
+                    write_time = time.time()
+                    if output is None:
+                        output = open_parquet(self.temp_path, self.schema)
+                    output.write_table(self.convert(block))
+                    self.write_time += time.time() - write_time
+                except Exception as e:
+                    self.error = e
+        
+        try:
+            #the logfile is written even if there are no logs, so the log range is known to have been pulled
+            if output is None and self.error is None:
+                output = open_parquet(self.temp_path, self.schema)
+            if output is not None:
+                output.close()
+        except Exception as e:
+            if self.error is None:
+                self.error = e
+
+'''
+A method to open a Parquet file to be written, compressed in the format and level chosen by the user.
+'''
+def open_parquet(parquet_path, schema):
+    return pyarrow.parquet.ParquetWriter(parquet_path, schema, compression=compression, compression_level=(compression_level if compression != "none" else None))
+
+'''
+A method to get the start time and end time of the logs from the name of a logfile, as they are written in the name, and the extension of the logfile.
+It returns None if it's not a logfile, e.g. the temporary file of a logfile still being written, or a file with the times in its name not valid.
+'''
+def parse_logfile_name(name):
+    prefix = logfile_name_prefix + "_"
+    extension = next((extension for extension in (".json.gz", ".json.zst", ".json", ".parquet") if name.endswith(extension)), None)
+    if extension is None or not name.startswith(prefix) or name.count("~") != 1:
+        return None
+    log_start_time, log_end_time = name[len(prefix):-len(extension)].split("~")
+    try:
+        parse_rfc3339(log_start_time)
+        parse_rfc3339(log_end_time)
+    except ValueError:
+        return None
+    return log_start_time, log_end_time, extension
+
+'''
+A method to convert the start time or end time written in the name of a logfile back into a datetime, as the times with fractions of a second cannot be compared as strings.
+'''
+def parse_rfc3339(value):
+    return datetime.fromisoformat(value.rstrip("Z"))
+
+'''
+This method converts a batch of logs read from the Parquet files back into raw logs, one JSON object per line, the same as the logs pulled from Cloudflare.
+The timestamps are written in RFC 3339 format again, and the fields kept as JSON text are parsed back into JSON objects.
+'''
+def parquet_to_json(batch):
+    columns = {}
+    for index, field in enumerate(batch.schema):
+        column = batch.column(index)
+        if pyarrow.types.is_timestamp(field.type):
+            column = pyarrow.compute.replace_substring(pyarrow.compute.strftime(column, format="%Y-%m-%dT%H:%M:%SZ"), pattern=".000000000Z", replacement="Z")
+        columns[field.name] = column.to_pylist()
+    object_fields = [name for name in columns if archive_field_types.get(name) == "object"]
+    
+    lines = []
+    for i in range(batch.num_rows):
+        log = {name: values[i] for name, values in columns.items() if values[i] is not None}
+        for name in object_fields:
+            if name in log:
+                log[name] = json.loads(log[name])
+        lines.append(json.dumps(log, separators=(",", ":"), ensure_ascii=False).encode("utf-8"))
+    lines.append(b"")
+    return b"\n".join(lines)
+
+'''
+This method runs in a separate thread if the raw logs are stored as Parquet files. Every compaction interval, the Parquet files in each hour folder are merged into one,
+so there are fewer small files to be opened when the logs are read. The logfiles still being written have a temporary name, so they are left for the next compaction.
+'''
+def compact_worker():
+    while True:
+        time.sleep(compact_interval)
+        for partition in sorted(Path(path).rglob("hour=*")):
+            try:
+                compact_partition(partition)
+            except Exception as e:
+                logger.error("Failed to merge the logfiles in %s. Error dump: %s", partition, e)
+
+'''
+This method merges the Parquet files in an hour folder. Each merged logfile is named after the earliest start time and the latest end time of the logfiles in it.
+Only the logfiles next to each other are merged, so a log range missing in between is not hidden in the name of the merged logfile, and can still be pulled again.
+The merged logfile is written to a temporary file first, and the logfiles in it are only removed after it has been renamed, so no logs will be lost if the program stops in the middle.
+'''
+def compact_partition(partition):
+    logfiles = []
+    for logfile_path in partition.glob(logfile_name_prefix + "_*~*.parquet"):
+        parsed = parse_logfile_name(logfile_path.name)
+        if parsed is not None:
+            logfiles.append((parsed[0], parsed[1], str(logfile_path)))
+    logfiles.sort(key=lambda logfile: parse_rfc3339(logfile[0]))
+    
+    #split the logfiles into runs without gaps, each of them merged into one logfile
+    runs = []
+    run_end = None
+    for logfile in logfiles:
+        if run_end is not None and parse_rfc3339(logfile[0]) <= run_end:
+            runs[-1].append(logfile)
+            run_end = max(run_end, parse_rfc3339(logfile[1]))
+        else:
+            runs.append([logfile])
+            run_end = parse_rfc3339(logfile[1])
+    #the time ranges of the folder are dropped first, so the folder will be listed again if the program fails to merge some of the logfiles
+    with archive_ranges_lock:
+        archive_ranges.pop(str(partition), None)
+    for run in runs:
+        if len(run) >= 2:
+            merge_logfiles(partition, run)
+    
+    #the logfiles of each run are now in one logfile, which covers the time range of the run
+    ranges = [(parse_rfc3339(run[0][0]), max(parse_rfc3339(logfile[1]) for logfile in run)) for run in runs]
+    with archive_ranges_lock:
+        archive_ranges[str(partition)] = ranges
+
+'''
+This method merges a run of Parquet logfiles without gaps into one, with the small row groups of the logfiles put together into bigger ones.
+'''
+def merge_logfiles(partition, logfiles):
+    merged_path = str(partition / (logfile_name_prefix + "_" + logfiles[0][0] + "~" + max((logfile[1] for logfile in logfiles), key=parse_rfc3339) + ".parquet"))
+    schema = pyarrow.unify_schemas([pyarrow.parquet.read_schema(logfile[2]) for logfile in logfiles])
+    dataset = pyarrow.dataset.dataset([logfile[2] for logfile in logfiles], schema=schema, format="parquet")
+    
+    #the small row groups of the logfiles are put together into bigger ones
+    output = open_parquet(merged_path + ".part", schema)
+    try:
+        batches = []
+        rows = 0
+        for batch in dataset.to_batches():
+            batches.append(batch)
+            rows += batch.num_rows
+            if rows >= 1000000:
+                output.write_table(pyarrow.Table.from_batches(batches, schema=schema))
+                batches = []
+                rows = 0
+        if len(batches) > 0:
+            output.write_table(pyarrow.Table.from_batches(batches, schema=schema))
+    finally:
+        output.close()
+    
+    os.replace(merged_path + ".part", merged_path)
+    for logfile in logfiles:
+        if logfile[2] != merged_path:
+            os.remove(logfile[2])
+    logger.info("Merged %s logfiles in %s into %s.", len(logfiles), partition, os.path.basename(merged_path))
+
+'''
+This method starts merging the Parquet files regularly, if the raw logs are stored as Parquet files.
+'''
+def initialize_compaction():
+    if archive_format == "parquet" and compact_interval > 0 and no_store is False and replay_mode is False:
+        threading.Thread(target=compact_worker, name="archive-compaction", daemon=True).start()
+
+'''
+This method exports the logs stored as Parquet files within the time range given by the user, as JSON with one log per line, or as CSV or Parquet depending on the name of the export file.
+Only the hour folders within the time range are read, and only the columns asked for, so a small part of a large archive can be exported quickly.
+'''
+def export_archive():
+    
+    export_time = time.time()
+    logfiles = []
+    for logfile_path in Path(path).rglob(logfile_name_prefix + "_*~*.parquet"):
+        #skip the hour folders outside the time range, without opening the logfiles in them
+        partition = dict(part.split("=", 1) for part in logfile_path.parent.parts[-2:] if "=" in part)
+        try:
+            hour_start = datetime.strptime(partition["date"] + " " + partition["hour"], "%Y-%m-%d %H")
+            if hour_start >= end_time_static or hour_start + timedelta(hours=1) <= start_time_static:
+                continue
+        except (KeyError, ValueError):
+            pass
+        logfiles.append(str(logfile_path))
+    
+    if len(logfiles) == 0:
+        logger.warning("No Parquet logfiles found under %s with the logs from %sZ to %sZ.", path, start_time_static.isoformat(), end_time_static.isoformat())
+        return
+    
+    try:
+        schema = pyarrow.unify_schemas([pyarrow.parquet.read_schema(logfile) for logfile in logfiles])
+        for field in export_columns + [condition[0] for condition in export_filters]:
+            if field not in schema.names:
+                logger.critical("%s field is not found in the logfiles.", field)
+                sys.exit(2)
+        
+        #only the logs within the time range, which match all the conditions given by the user, are read
+        condition = None
+        if "EdgeStartTimestamp" in schema.names:
+            timestamp_type = schema.field("EdgeStartTimestamp").type
+            condition = (pyarrow.dataset.field("EdgeStartTimestamp") >= pyarrow.scalar(start_time_static.replace(tzinfo=timezone.utc), type=timestamp_type)) & (pyarrow.dataset.field("EdgeStartTimestamp") < pyarrow.scalar(end_time_static.replace(tzinfo=timezone.utc), type=timestamp_type))
+        for field, value in export_filters:
+            match = pyarrow.dataset.field(field) == pyarrow.scalar(value).cast(schema.field(field).type)
+            condition = match if condition is None else condition & match
+        
+        scanner = pyarrow.dataset.dataset(logfiles, schema=schema, format="parquet").scanner(columns=(export_columns if len(export_columns) > 0 else None), filter=condition)
+        number_of_logs = 0
+        if export_path.endswith(".parquet"):
+            with open_parquet(export_path, scanner.projected_schema) as output:
+                for batch in scanner.to_batches():
+                    output.write_batch(batch)
+                    number_of_logs += batch.num_rows
+        elif export_path.endswith(".csv"):
+            #CSV has no lists, so the lists are written as comma-separated values
+            lists = [field.name for field in scanner.projected_schema if pyarrow.types.is_list(field.type)]
+            csv_schema = pyarrow.schema([(field.name, pyarrow.string()) if field.name in lists else field for field in scanner.projected_schema])
+            with pyarrow.csv.CSVWriter(export_path, csv_schema) as output:
+                for batch in scanner.to_batches():
+                    arrays = [pyarrow.compute.binary_join(column, ",") if name in lists else column for name, column in zip(batch.schema.names, batch.columns)]
+                    output.write_batch(pyarrow.RecordBatch.from_arrays(arrays, schema=csv_schema))
+                    number_of_logs += batch.num_rows
+        else:
+            with open(export_path, mode="wb") as output:
+                for batch in scanner.to_batches():
+                    output.write(parquet_to_json(batch))
+                    number_of_logs += batch.num_rows
+    except (OSError, pyarrow.ArrowException) as e:
+        logger.critical("Failed to export the logs to %s. Error dump: %s", export_path, e)
+        sys.exit(1)
+    
+    logger.info("Exported %s logs from %s logfiles to %s in %s seconds.", number_of_logs, len(logfiles), export_path, round(time.time() - export_time, 3))
+
+'''
+This class decides the maximum number of logs in each chunk to be pushed to Elasticsearch.
+If adaptive chunk sizing is not enabled, it always returns the maximum number of logs specified by the user.
+Otherwise, it follows the AIMD (additive increase, multiplicative decrease) approach:
+the size grows by a small step after every bulk request that finishes within the target latency,
+and is cut by half when Elasticsearch rejects the request (HTTP 429 or es_rejected_execution_exception), or by a quarter when the request is slower than the target latency.
+This way the chunk size settles at what the cluster can take without overloading it.
+'''
+class BulkSizer:
+    
+    def __init__(self):
+        self.lock = threading.Lock()
+        if adaptive_bulk is True:
+            #start from a quarter of the maximum size, and let it grow from there
+            self.docs = max(bulk_min_docs, bulk_max_docs // 4)
+            self.step = max(1, bulk_max_docs // 20)
+        else:
+            self.docs = bulk_max_docs
+    
+    #the maximum number of logs for the next chunk
+    def current(self):
+        return self.docs
+    
+    #to be called after every bulk request with the latency in seconds, and whether Elasticsearch rejected the request because it is overloaded
+    def record(self, latency, rejected):
+        if adaptive_bulk is False:
+            return
+        
+        with self.lock:
+            previous = self.docs
+            if rejected is True:
+                self.docs = max(bulk_min_docs, self.docs // 2)
+            elif latency > bulk_target_latency:
+                self.docs = max(bulk_min_docs, self.docs * 3 // 4)
+            else:
+                self.docs = min(bulk_max_docs, self.docs + self.step)
+        
+        if self.docs != previous:
+            logger.debug("Bulk chunk size adjusted from %s to %s logs. Latency: %s seconds%s", previous, self.docs, round(latency, 3), (", rejected by Elasticsearch." if rejected is True else "."))
+
+'''
+This class learns how many logs per second a zone has from its recent log ranges, to decide the size of the next log range when adaptive window sizing is enabled.
+The estimate follows a rise in traffic immediately, so the log ranges are split as soon as a spike is seen, and follows a drop slowly, so the log ranges are merged gradually.
+'''
+class WindowSizer:
+    
+    #how much weight is given to the latest log range when the traffic drops
+    decay = 0.2
+    
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.logs_per_second = None
+        self.bytes_per_second = None
+    
+    #to be called after a log range has been pulled successfully
+    def record(self, log_range):
+        duration = (log_range.log_end_time_utc - log_range.log_start_time_utc).total_seconds()
+        if adaptive_window is False or duration <= 0:
+            return
+        
+        logs_per_second = log_range.number_of_logs / duration
+        bytes_per_second = log_range.number_of_bytes / duration
+        with self.lock:
+            if self.logs_per_second is None or logs_per_second > self.logs_per_second:
+                self.logs_per_second = logs_per_second
+            else:
+                self.logs_per_second += (logs_per_second - self.logs_per_second) * self.decay
+            if self.bytes_per_second is None or bytes_per_second > self.bytes_per_second:
+                self.bytes_per_second = bytes_per_second
+            else:
+                self.bytes_per_second += (bytes_per_second - self.bytes_per_second) * self.decay
+    
+    #the size in seconds of the next log range, in whole seconds. the interval is used until the first log range has been pulled
+    def current(self):
+        if adaptive_window is False:
+            return interval
+        
+        with self.lock:
+            if self.logs_per_second is None:
+                size = interval
+            else:
+                size = window_max
+                if self.logs_per_second > 0:
+                    size = min(size, window_target_logs / self.logs_per_second)
+                if self.bytes_per_second > 0:
+                    size = min(size, window_target_bytes / self.bytes_per_second)
+        
+        return float(int(max(window_min, min(window_max, size))))
+
+'''
+A method to extract the string value of a field from a raw log without parsing the whole JSON object, which is much cheaper when we only need one field.
+It returns None if the field is not found or the value is not a string.
+'''
+def extract_field(line, field_key):
+    pos = line.find(field_key)
+    if pos < 0:
+        return None
+    
+    #skip the colon and any whitespace after the key, the value must begin with a double quote
+    pos += len(field_key)
+    while pos < len(line) and line[pos] in b" :":
+        pos += 1
+    if pos >= len(line) or line[pos] != 34:
+        return None
+    
+    end = line.find(b'"', pos + 1)
+    if end < 0:
+        return None
+    
+    return line[pos + 1:end]
+
+#the same as extract_field() for the RayID, to find the RayIDs of all the logs in one go. the rest of the line is skipped after the RayID, so there's one match at most for each log
+rayid_pattern = re.compile(rb'"RayID"[ :]*"([^"]*)"[^\n]*')
+
+'''
+This method returns the metadata line required by the Elasticsearch bulk tasks for a raw log, in bytes.
+If the document ID is taken from the log, pushing the same log again will overwrite (or with create, skip) the existing document instead of creating a duplicate.
+'''
+def bulk_action(line):
+    if doc_id_mode == "none":
+        return bulk_metadata
+    
+    doc_id = None
+    if doc_id_mode == "rayid":
+        doc_id = extract_field(line, b'"RayID"')
+    elif len(doc_id_fields) > 0:
+        try:
+            log = json.loads(line)
+            doc_id = hashlib.blake2b("\x1f".join(str(log.get(field, "")) for field in doc_id_fields).encode("utf-8"), digest_size=16).hexdigest().encode("ascii")
+        except (json.JSONDecodeError, AttributeError):
+            pass
+    
+    #if the ID cannot be taken from the log, hash the whole log so the ID is still the same every time the log is pushed
+    if doc_id is None:
+        doc_id = hashlib.blake2b(line, digest_size=16).hexdigest().encode("ascii")
+    
+    return bulk_action_prefix + doc_id + b'" }}\n'
+
+'''
+This method is to insert a specific line of metadata before each lines of logs, which is required by the Elasticsearch bulk tasks.
+The raw logs from Cloudflare are processed as bytes, so they don't need to be decoded to a string and encoded back to bytes before being pushed to Elasticsearch.
+The processed logs will be split into chunks, based on the maximum size and the maximum number of logs of each chunk, so they can be pushed to Elasticsearch concurrently.
+It will count the number of lines of logs, and return the chunks, each with its number of logs, and the total number of logs back to the caller
+'''
+def process_logs(response):
+    chunks = []
+    
+    if len(response) > 0 and response.endswith(b"\n") is False:
+        response += b"\n"
+    
+    #the metadata is different for each log if the document ID is taken from the log, so the chunks have to be built log by log
+    if doc_id_mode != "none":
+        lines = response.split(b"\n")
+        lines.pop()
+        if b"" in lines:
+            #skip empty lines. this is rare, so we only go through every line when there's any empty line
+            lines = [line for line in lines if line]
+        if len(lines) == 0:
+            return chunks, 0
+        
+        #the RayIDs of all the logs are found with one regular expression, which is only used if every log has a RayID, so the IDs cannot be out of line with the logs
+        doc_ids = None
+        if doc_id_mode == "rayid":
+            doc_ids = rayid_pattern.findall(response)
+            if len(doc_ids) != len(lines):
+                doc_ids = None
+        return process_logs_with_ids(lines, doc_ids), len(lines)
+    
+    #without the document ID, the empty lines in the middle are found in the chunks built below, which is a lot cheaper than looking for two newline characters in a row here
+    if response.startswith(b"\n"):
+        response = b"".join([line + b"\n" for line in response.split(b"\n") if line])
+    if len(response) == 0:
+        return chunks, 0
+    
+    #otherwise every chunk is a slice of the raw logs, ending at a newline character, with the metadata inserted by replacing each newline character with a newline character and the metadata
+    #both replace() and count() run over the bytes in C, so there's no Python loop over the logs and no bytes object for each log
+    newline_with_metadata = b"\n" + bulk_metadata
+    empty_line = newline_with_metadata + b"\n"
+    number_of_logs = 0
+    
+    #the average size of the logs is taken from the first megabyte at first, then from the chunks built so far
+    sample = response[:1024 * 1024]
+    average_size = len(sample) / max(1, sample.count(b"\n"))
+    
+    start = 0
+    while start < len(response):
+        #the average size is used to guess where the chunk ends, without exceeding the maximum size or the maximum number of logs
+        chunk_docs = max(1, min(bulk_sizer.current(), int(bulk_max_bytes // (average_size + len(bulk_metadata)))))
+        end = response.find(b"\n", max(start, min(len(response) - 1, start + int(chunk_docs * average_size) - 1))) + 1
+        chunk_count = response.count(b"\n", start, end)
+        
+        #the logs may be smaller or bigger than the average, so the logs over the limits are taken off the end of the chunk one by one, or the logs that still fit are added. there are only a few of them
+        while chunk_count > 1 and (chunk_count > chunk_docs or end - start + chunk_count * len(bulk_metadata) > bulk_max_bytes):
+            end = response.rfind(b"\n", start, end - 1) + 1
+            chunk_count -= 1
+        while chunk_count < chunk_docs and end < len(response):
+            next_end = response.find(b"\n", end) + 1
+            if next_end - start + (chunk_count + 1) * len(bulk_metadata) > bulk_max_bytes:
+                break
+            end = next_end
+            chunk_count += 1
+        average_size = (end - start) / chunk_count
+        
+        final_json = bulk_metadata + response[start:end - 1].replace(b"\n", newline_with_metadata) + b"\n"
+        
+        #an empty line shows up as the metadata with no log after it, then the chunks are built again without the empty lines
+        if empty_line in final_json or response.startswith(b"\n", start):
+            return process_logs(b"\n" + response)
+        
+        chunks.append((final_json, chunk_count))
+        number_of_logs += chunk_count
+        start = end
+
+    return chunks, number_of_logs
+
+'''
+This method is the same as process_logs(), for the logs that each need their own metadata, e.g. when the document ID is taken from the log.
+It takes the lines of logs, and the document ID of each log if they have been found already, and returns the chunks, each with its number of logs.
+'''
+def process_logs_with_ids(lines, doc_ids=None):
+    chunks = []
+    number_of_logs = len(lines)
+    
+    #the average size of the logs is used to decide how many logs can be fitted into a chunk without exceeding the maximum size
+    average_size = (sum(map(len, lines)) + number_of_logs) / number_of_logs + len(bulk_metadata)
+    
+    start = 0
+    while start < number_of_logs:
+        chunk_docs = max(1, min(bulk_sizer.current(), int(bulk_max_bytes // average_size)))
+        chunk_lines = lines[start:start + chunk_docs]
+        
+        #the chunk is built with one join() call, which calculates the total size first and copies each line only once into a buffer of exactly that size
+        #the list for join() is laid out as: metadata, log, newline, metadata, log, newline, ... and filled with slice assignments
+        #with the document IDs found already, the metadata is laid out in three parts as well: the start of it, the ID, and the end of it
+        if doc_ids is not None:
+            parts = [b"\n"] * (len(chunk_lines) * 5)
+            parts[0::5] = [bulk_action_prefix] * len(chunk_lines)
+            parts[1::5] = doc_ids[start:start + len(chunk_lines)]
+            parts[2::5] = [b'" }}\n'] * len(chunk_lines)
+            parts[3::5] = chunk_lines
+        else:
+            parts = [b"\n"] * (len(chunk_lines) * 3)
+            parts[0::3] = [bulk_action(line) for line in chunk_lines]
+            parts[1::3] = chunk_lines
+        final_json = b"".join(parts)
+        
+        #some logs may be much bigger than the average, so shrink the chunk if it turns out to be too big
+        if len(final_json) > bulk_max_bytes and len(chunk_lines) > 1:
+            average_size = average_size * len(final_json) / bulk_max_bytes * 1.1
+            continue
+        
+        chunks.append((final_json, len(chunk_lines)))
+        start += len(chunk_lines)
+
+    return chunks
+
+'''
+This class is the transform stage, which changes each log before it is pushed to Elasticsearch, so the work can be moved off the ingest pipeline.
+The steps are: remove the unwanted fields, normalize the timestamps, look up the location and ASN of the client IP, run the user's plugin, and finally rename the fields.
+The GeoIP and ASN lookups are cached, as the same client IP appears in many logs.
+'''
+class LogTransformer:
+    
+    def __init__(self, settings):
+        self.drop_fields = settings["drop_fields"]
+        self.rename_fields = settings["rename_fields"]
+        self.normalize_timestamps = settings["normalize_timestamps"]
+        self.geoip_reader = geoip2.database.Reader(settings["geoip_db"]) if settings["geoip_db"] else None
+        self.asn_reader = geoip2.database.Reader(settings["asn_db"]) if settings["asn_db"] else None
+        self.lookup = functools.lru_cache(maxsize=settings["geoip_cache_size"])(self.lookup_ip)
+        
+        self.plugin = None
+        if settings["plugin"]:
+            spec = importlib.util.spec_from_file_location("cf_elk_pusher_plugin", settings["plugin"])
+            module = importlib.util.module_from_spec(spec)
+            spec.loader.exec_module(module)
+            self.plugin = module.transform
+    
+    #convert a timestamp from Cloudflare to ISO 8601 format in UTC with milliseconds
+    #Cloudflare gives the timestamps as RFC 3339 strings, or as numbers in seconds or nanoseconds since epoch depending on the timestamp format
+    @staticmethod
+    def normalize_timestamp(value):
+        if isinstance(value, (int, float)):
+            #guess the unit from the size of the number
+            for unit in (1, 1000, 1000000, 1000000000):
+                if value < 1e11 * unit:
+                    value = datetime.utcfromtimestamp(value / unit)
+                    break
+            else:
+                return value
+        elif isinstance(value, str):
+            try:
+                parsed = datetime.fromisoformat(value.replace("Z", "+00:00"))
+            except ValueError:
+                return value
+            value = parsed.replace(tzinfo=None) - (parsed.utcoffset() or timedelta(0))
+        else:
+            return value
+        return value.strftime("%Y-%m-%dT%H:%M:%S.") + "%03dZ" % (value.microsecond // 1000)
+    
+    #look up the location and the ASN of an IP address. it returns None if nothing is found
+    def lookup_ip(self, ip):
+        geoip = {}
+        if self.geoip_reader is not None:
+            try:
+                if self.geoip_reader.metadata().database_type.endswith("City"):
+                    response = self.geoip_reader.city(ip)
+                    if response.city.name:
+                        geoip["city_name"] = response.city.name
+                    if response.subdivisions.most_specific.name:
+                        geoip["region_name"] = response.subdivisions.most_specific.name
+                    if response.location.latitude is not None:
+                        geoip["location"] = {"lat": response.location.latitude, "lon": response.location.longitude}
+                else:
+                    response = self.geoip_reader.country(ip)
+                if response.continent.name:
+                    geoip["continent_name"] = response.continent.name
+                if response.country.iso_code:
+                    geoip["country_iso_code"] = response.country.iso_code
+            except (geoip2.errors.AddressNotFoundError, ValueError):
+                pass
+        if self.asn_reader is not None:
+            try:
+                response = self.asn_reader.asn(ip)
+                geoip["asn"] = response.autonomous_system_number
+                geoip["organization_name"] = response.autonomous_system_organization
+            except (geoip2.errors.AddressNotFoundError, ValueError):
+                pass
+        return geoip if geoip else None
+    
+    #change a log, and return None if the log should be removed
+    def transform(self, log):
+        for field in self.drop_fields:
+            log.pop(field, None)
+        
+        if self.normalize_timestamps is True:
+            for field, value in log.items():
+                if field.endswith("Timestamp"):
+                    log[field] = self.normalize_timestamp(value)
+            if "EdgeStartTimestamp" in log:
+                log["@timestamp"] = log["EdgeStartTimestamp"]
+        
+        if (self.geoip_reader is not None or self.asn_reader is not None) and log.get("ClientIP"):
+            geoip = self.lookup(log["ClientIP"])
+            if geoip is not None:
+                log["geoip"] = geoip
+        
+        if self.plugin is not None:
+            log = self.plugin(log)
+            if log is None:
+                return None
+        
+        for old, new in self.rename_fields.items():
+            if old in log:
+                log[new] = log.pop(old)
+        
+        return log
+    
+    #change every log in a bulk request, keeping the metadata line of each log. the logs that cannot be parsed are left as they are
+    #it returns the changed bulk request and the number of logs in it
+    def transform_chunk(self, final_json):
+        lines = final_json.split(b"\n")
+        parts = []
+        number_of_logs = 0
+        for i in range(0, len(lines) - 1, 2):
+            try:
+                log = self.transform(json.loads(lines[i + 1]))
+            except (json.JSONDecodeError, AttributeError):
+                log = lines[i + 1]
+            if log is None:
+                continue
+            parts.append(lines[i])
+            parts.append(log if isinstance(log, bytes) else json.dumps(log, separators=(",", ":"), ensure_ascii=False).encode("utf-8"))
+            number_of_logs += 1
+        parts.append(b"")
+        return b"\n".join(parts), number_of_logs
+
+'''
+These methods run the transform stage in the transform workers, which are separate processes, so the transform stage can use all the CPU cores.
+The transform worker ignores Ctrl+C, so it can finish the logs that are still in progress when the program exits.
+'''
+def initialize_transform_worker(settings):
+    global log_transformer
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    log_transformer = LogTransformer(settings)
+
+def transform_chunk(final_json):
+    return log_transformer.transform_chunk(final_json)
+
+'''
+This method prepares the transform stage, if the user wants to change the logs before they are pushed to Elasticsearch.
+'''
+def initialize_transform():
+    
+    global transform_pool, log_transformer
+    
+    if transform_settings is None or store_only is True:
+        return
+    
+    try:
+        if transform_workers > 0:
+            transform_pool = ProcessPoolExecutor(max_workers=transform_workers, initializer=initialize_transform_worker, initargs=(transform_settings,))
+            #make sure the transform workers can start, so any error is shown to the user now
+            transform_pool.submit(transform_chunk, b"").result()
+        else:
+            log_transformer = LogTransformer(transform_settings)
+    except Exception as e:
+        logger.critical("Failed to prepare the transform stage. Error dump: %s", e)
+        sys.exit(2)
+
+'''
+This class is the rollup stage, which summarizes the logs of a log range per rollup window, grouped by the rollup fields, so the dashboards that only need
+the number of requests, the bytes and the origin response time don't have to go through every log. Each group keeps a few counters, and a histogram of the origin response time
+with logarithmic buckets, so its percentiles are estimated within a few percent with a small number of counters, however many logs there are.
+The rollups are pushed to the rollup index once all the logs of the log range have been handed to the push workers. The ID of each rollup is taken from the log range,
+the window and the group, so pulling the same log range again will overwrite its rollups. A window split across two log ranges has a rollup from each of them, which add up.
+'''
+class Rollup:
+    
+    #the number of histogram buckets for each doubling of the origin response time
+    buckets_per_doubling = 8
+    
+    def __init__(self, log_range):
+        self.log_range = log_range
+        self.groups = {}
+    
+    #get the seconds since epoch of a timestamp from Cloudflare, either a RFC 3339 string or a number in seconds or nanoseconds. the logs of a log range share a lot of timestamps
+    @staticmethod
+    @functools.lru_cache(maxsize=4096)
+    def parse_timestamp(value):
+        if isinstance(value, str):
+            return datetime.fromisoformat(value.replace("Z", "+00:00")).timestamp()
+        for unit in (1, 1000, 1000000, 1000000000):
+            if value < 1e11 * unit:
+                return value / unit
+        raise ValueError("timestamp out of range")
+    
+    #count the logs of a chunk, and return the chunk with only the raw logs to be pushed alongside the rollups, and the number of logs in it
+    def add(self, final_json):
+        lines = final_json.split(b"\n")
+        parts = []
+        for i in range(0, len(lines) - 1, 2):
+            if rollup_raw_rate > 0 and (rollup_raw_rate >= 1 or random.random() < rollup_raw_rate):
+                parts.append(lines[i])
+                parts.append(lines[i + 1])
+            try:
+                log = json.loads(lines[i + 1])
+                self.count(log)
+            except (json.JSONDecodeError, AttributeError, TypeError, ValueError, OverflowError):
+                #the logs that cannot be parsed are left out of the rollups
+                pass
+        number_of_logs = len(parts) // 2
+        parts.append(b"")
+        return b"\n".join(parts), number_of_logs
+    
+    def count(self, log):
+        timestamp = log.get("EdgeStartTimestamp")
+        timestamp = self.parse_timestamp(timestamp) if timestamp is not None else (self.log_range.log_start_time_utc - datetime(1970, 1, 1)).total_seconds()
+        key = (timestamp - timestamp % rollup_window,) + tuple(log.get(field) for field in rollup_fields)
+        
+        group = self.groups.get(key)
+        if group is None:
+            #number of requests, bytes, maximum origin response time, and the histogram of the origin response time
+            group = self.groups[key] = [0, 0, 0, {}]
+        group[0] += 1
+        group[1] += log.get("EdgeResponseBytes") or 0
+        origin_time = log.get("OriginResponseTime")
+        if origin_time is not None:
+            group[2] = max(group[2], origin_time)
+            bucket = int(math.log2(origin_time) * self.buckets_per_doubling) if origin_time >= 1 else -1
+            group[3][bucket] = group[3].get(bucket, 0) + 1
+    
+    #estimate a percentile from the histogram, as the middle of the bucket it falls in
+    def percentile(self, histogram, total, percent):
+        seen = 0
+        for bucket in sorted(histogram):
+            seen += histogram[bucket]
+            if seen >= total * percent / 100:
+                break
+        return 0 if bucket < 0 else round(2 ** ((bucket + 0.5) / self.buckets_per_doubling))
+    
+    #build the bulk chunks of the rollups. the ingest pipeline of the zone is not used for the rollups, as it's for the raw logs
+    def finish(self):
+        chunks = []
+        chunk = []
+        chunk_bytes = 0
+        for key, (requests_count, bytes_count, origin_max, histogram) in self.groups.items():
+            window_start = datetime.utcfromtimestamp(key[0])
+            doc = {"@timestamp": window_start.strftime("%Y-%m-%dT%H:%M:%S.") + "%03dZ" % (window_start.microsecond // 1000), "zone": self.log_range.zone.name, "window_seconds": rollup_window}
+            doc.update(zip(rollup_fields, key[1:]))
+            doc["requests"] = requests_count
+            doc["bytes"] = bytes_count
+            origin_total = sum(histogram.values())
+            if origin_total > 0:
+                doc["origin_response_time_p50"] = self.percentile(histogram, origin_total, 50)
+                doc["origin_response_time_p90"] = self.percentile(histogram, origin_total, 90)
+                doc["origin_response_time_p99"] = self.percentile(histogram, origin_total, 99)
+                doc["origin_response_time_max"] = origin_max
+            
+            doc_id = hashlib.blake2b(json.dumps([self.log_range.zone.name, self.log_range.log_start_time_rfc3389, self.log_range.log_end_time_rfc3389] + list(key), default=str).encode("utf-8"), digest_size=16).hexdigest().encode("ascii")
+            line = rollup_action_prefix + doc_id + b'", "pipeline": "_none" }}\n' + json.dumps(doc, separators=(",", ":"), ensure_ascii=False).encode("utf-8") + b"\n"
+            chunk.append(line)
+            chunk_bytes += len(line)
+            if len(chunk) >= bulk_max_docs or chunk_bytes >= bulk_max_bytes:
+                chunks.append((b"".join(chunk), len(chunk)))
+                chunk = []
+                chunk_bytes = 0
+        if len(chunk) > 0:
+            chunks.append((b"".join(chunk), len(chunk)))
+        
+        self.groups = {}
+        return chunks
+
+'''
+A method to check whether Elasticsearch rejected the bulk request, or some of the logs in it, because it is overloaded.
+Elasticsearch returns HTTP 429 for the whole request, or es_rejected_execution_exception for each of the rejected logs.
+'''
+def is_rejected(status_code, content):
+    return status_code == 429 or b"es_rejected_execution_exception" in content
+
+'''
+A method to calculate how long to wait before the next retry, using exponential backoff with jitter.
+The waiting time doubles on every attempt up to a maximum of 60 seconds, and a random part is added so the retries from different workers don't hit Elasticsearch or Cloudflare API at the same time.
+'''
+def backoff_delay(attempt):
+    delay = min(60.0, 1.0 * (2 ** attempt))
+    return random.uniform(delay / 2, delay)
+
+'''
+A method to read how long Cloudflare wants us to wait from the Retry-After header, either in seconds or as a date. It returns None if there's no such header.
+'''
+def retry_after(headers):
+    value = headers.get("Retry-After")
+    if value is None:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, (email.utils.parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds())
+    except (TypeError, ValueError):
+        return None
+
+'''
+This method writes the logs that Elasticsearch refuses to index permanently (e.g. mapping errors) to the dead-letter file, one JSON object per line.
+Retrying these logs will never succeed, so they are kept aside for the user to inspect instead.
+'''
+def write_dead_letters(log_range, dead_letters):
+    try:
+        with dead_letter_lock:
+            with open(dead_letter_path, mode="a", encoding="utf-8") as dead_letter_file:
+                for action, line, status, error in dead_letters:
+                    dead_letter_file.write(json.dumps({"time": str(datetime.now()), "zone": log_range.zone.name, "log_range": log_range.log_start_time_rfc3389 + "~" + log_range.log_end_time_rfc3389, "status": status, "error": error, "action": action.decode("utf-8", "replace"), "log": line.decode("utf-8", "replace")}) + "\n")
+    except OSError as e:
+        logger.error("%s: Failed to write %s logs to the dead-letter file %s. Error dump: %s", log_range.description, len(dead_letters), dead_letter_path, e)
+        return False
+    
+    return True
+
+'''
+A method to check whether a bulk request, or a log in it, which failed with the given status may succeed if it's pushed again.
+Only HTTP 429 (Elasticsearch is overloaded) and 5xx are worth retrying, other errors such as 400 or 413 will be the same every time.
+'''
+def is_retryable(status_code):
+    return status_code == 429 or status_code >= 500
+
+'''
+A method to turn all the logs of a bulk request into dead letters with the same status and error, to be written to the dead-letter file.
+Each log is preceded by its action line in the bulk request.
+'''
+def chunk_dead_letters(final_json, status, error):
+    lines = final_json.split(b"\n")
+    return [(lines[i], lines[i + 1], status, error) for i in range(0, len(lines) - 1, 2)]
+
+'''
+This method goes through the result of each log in the bulk response, and sorts out the logs that failed.
+Only the logs that failed with a retryable status (HTTP 429 or 5xx) are put into a new bulk request to be retried. The other failed logs can never succeed, so they are returned as dead letters.
+It returns the bulk request of the logs to be retried, the number of them, the dead letters, and the first error found for logging purposes.
+'''
+def split_bulk_failures(final_json, items):
+    lines = final_json.split(b"\n")
+    retry_json = []
+    number_of_retries = 0
+    dead_letters = []
+    first_error = None
+    
+    for i, item in enumerate(items):
+        #each item is keyed by the action, e.g. {"index": {...}} or {"create": {...}}
+        result = next(iter(item.values()))
+        status = result.get("status", 0)
+        if 200 <= status < 300:
+            continue
+        
+        #with create action, a conflict means the log has been indexed before, which is what we want
+        if status == 409 and "create" in item:
+            continue
+        
+        #the action line and the log line of the i-th item
+        action = lines[i * 2]
+        line = lines[i * 2 + 1]
+        error = result.get("error", {})
+        if first_error is None:
+            first_error = (status, error)
+        
+        if is_retryable(status):
+            retry_json.append(action + b"\n" + line + b"\n")
+            number_of_retries += 1
+        else:
+            dead_letters.append((action, line, status, error))
+    
+    return b"".join(retry_json), number_of_retries, dead_letters, first_error
+
+'''
+This method compresses the body of a bulk request with the format chosen by the user, and returns it with the headers to be sent along.
+Each chunk is compressed on its own right before it's pushed, so the logs to be retried can still be picked out of the uncompressed chunk.
+'''
+def encode_bulk(final_json):
+    
+    if bulk_compression == "none":
+        return final_json, None
+    
+    #gzip and deflate are the same compressed data with a different wrapper, which zlib picks with the window bits
+    compressor = zlib.compressobj(bulk_compression_level, zlib.DEFLATED, 31 if bulk_compression == "gzip" else 15)
+    return compressor.compress(final_json) + compressor.flush(), {"Content-Encoding": bulk_compression}
+
+'''
+This method records the bytes of a response from Cloudflare API received over the network, after the response has been read and decompressed.
+The response is expected to be compressed as asked with Accept-Encoding. If it's not, e.g. a proxy in between has removed the header, a warning is given once for each zone.
+'''
+def record_transfer(log_range, content_encoding, wire_bytes):
+    log_range.wire_bytes = wire_bytes
+    if content_encoding not in ("gzip", "deflate") and log_range.number_of_bytes > 0 and log_range.zone.uncompressed_warned is False:
+        log_range.zone.uncompressed_warned = True
+        logger.warning("%s: The response from Cloudflare is not compressed (Content-Encoding: %s), so %s bytes were received in full. Check whether a proxy in between removes the Accept-Encoding header.", log_range.description, content_encoding or "none", wire_bytes)
+    logger.debug("%s: Received %s bytes from Cloudflare, %s bytes after decompression.", log_range.description, wire_bytes, log_range.number_of_bytes)
+
+'''
+This method will take the processed logs and push them to Elasticsearch, using Bulk API.
+If only some of the logs failed, only those with a retryable status will be pushed again, so the logs that have been indexed will not be duplicated.
+It returns True if the logs have been pushed successfully, and the caller is responsible to record the result in succ.log or fail.log.
+The logs that can never be indexed are written to the dead-letter file, and they don't make the push fail.
+'''
+def push_logs(final_json, log_range, number_of_logs, on_failure=None):
+    
+    global retry_attempt
+    
+    #the logs will be handled as bytes, so the logs in the bulk request can be picked one by one when some of them need to be retried
+    if isinstance(final_json, str):
+        final_json = final_json.encode("utf-8")
+    encoded_json = None
+    
+    #5 retries will be given for the logpush process, in case something happens
+    for i in range(retry_attempt+1):
+        retry_msg = ("Retrying " + str(i+1) + " of " + str(retry_attempt) + "...") if i < (retry_attempt) else ""
+        if i > 0:
+            metric_retries.inc(stage="bulk", zone=log_range.zone.name)
+        
+        #once the drain deadline has passed, the logs are not pushed anymore, so the program can exit
+        if lifecycle.expired() is True:
+            logger.warning("%s: The program is exiting. %s logs are not pushed to Elasticsearch.", log_range.description, number_of_logs)
+            break
+        
+        #the body is compressed again only if some of the logs are left to be pushed again
+        if encoded_json is not final_json:
+            body, headers = encode_bulk(final_json)
+            encoded_json = final_json
+        metric_bulk_bytes.inc(len(final_json), zone=log_range.zone.name, stage="raw")
+        metric_bulk_bytes.inc(len(body), zone=log_range.zone.name, stage="wire")
+        
+        #make a POST request to the Elasticsearch endpoint to push all the logs that is previously processed.
+        node = es_nodes.acquire()
+        request_time = time.time()
+        try:
+            r = es_session.post(node["url"] + log_range.zone.bulk_path, data=body, headers=headers)
+        except Exception as e:
+            es_nodes.release(node, True)
+            logger.error("%s: Unexpected error occured while pushing logs to Elasticsearch. Error dump: \n%s. \n%s", log_range.description, e, retry_msg)
+            lifecycle.backoff(backoff_delay(i))
+            continue
+        
+        es_nodes.release(node, r.status_code >= 500)
+        success, final_json, number_of_logs = handle_bulk_response(log_range, final_json, number_of_logs, r.status_code, r.content, time.time() - request_time, retry_msg)
+        if success is True:
+            return True
+        lifecycle.backoff(backoff_delay(i))
+    
+    #the logs that still cannot be pushed are handed to on_failure, e.g. to be saved to the spool, which tells whether they are taken care of
+    if on_failure is not None:
+        return on_failure(final_json, number_of_logs)
+    return False
+
+'''
+This method checks the response of a bulk request from Elasticsearch, for both the threads and the asyncio engine.
+It returns whether all the logs have been taken care of, and the logs to be pushed on the next attempt with the number of them.
+If only some of the logs failed, the logs to be pushed again are only the ones with a retryable status. The logs that can never be indexed, one by one or the whole request, go to the dead-letter file.
+'''
+def handle_bulk_response(log_range, final_json, number_of_logs, status_code, content, latency, retry_msg):
+    
+    #let the chunk sizer know how long Elasticsearch took, and whether it rejected the request because it is overloaded
+    bulk_sizer.record(latency, is_rejected(status_code, content))
+    metric_bulk_seconds.observe(latency, zone=log_range.zone.name)
+    if status_code == 429:
+        metric_bulk_rejected_docs.inc(number_of_logs, zone=log_range.zone.name)
+    
+    #the whole request failed with an error which will be the same every time, e.g. 413 as the request is too large, or 400 as the ingest pipeline does not exist
+    #the logs are written to the dead-letter file instead, so they are not retried, or saved to the spool where they would hold up the logs after them
+    give_up = status_code != 200 and is_retryable(status_code) is False
+    if give_up is True:
+        retry_msg = ""
+    
+    #check whether the HTTP response code returned by Elasticsearch endpoint is 200, if yes means the logs have been pushed to Elasticsearch successfully.
+    try:
+        result_json = json.loads(content)
+    except ValueError:
+        #Elasticsearch should return a JSON object no matter the request is successful or not. But if not, something weird happened.
+        logger.error("%s: Unexpected error occured with error code %s. Error dump: %s. \n%s", log_range.description, status_code, content.decode("utf-8", "replace"), retry_msg)
+        if give_up is True:
+            return dead_letter_request(log_range, final_json, number_of_logs, status_code, {"reason": content.decode("utf-8", "replace")})
+        return False, final_json, number_of_logs
+    
+    #the raw response will be logged only if the user enables debugging. it's checked first, as decoding the response of every bulk request is not cheap
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("Output from Elasticsearch API:\n%s", content.decode("utf-8", "replace"))
+    if status_code == 200 and "errors" in result_json:
+        #NOTE: Elasticsearch will return status code 200 even if there's an error occured. We have to catch the error in JSON object
+        if result_json["errors"] == False:     
+            metric_bulk_docs.inc(number_of_logs, zone=log_range.zone.name)
+            logger.info("%s: Successfully pushed %s logs to Elasticsearch.", log_range.description, number_of_logs)
+            return True, final_json, number_of_logs
+        
+        #pick out the logs that failed, the others have been indexed and must not be pushed again
+        try:
+            retry_json, number_of_retries, dead_letters, first_error = split_bulk_failures(final_json, result_json["items"])
+        except (KeyError, IndexError, TypeError, AttributeError, StopIteration):
+            logger.error("%s: Unknown error occured while pushing logs to Elasticsearch. Error dump: %s. \n%s", log_range.description, content.decode("utf-8", "replace"), retry_msg)
+            return False, final_json, number_of_logs
+        
+        metric_bulk_docs.inc(number_of_logs - number_of_retries - len(dead_letters), zone=log_range.zone.name)
+        metric_bulk_rejected_docs.inc(number_of_retries + len(dead_letters), zone=log_range.zone.name)
+        
+        if first_error is not None:
+            err_code, error = first_error
+            caused_by = ""
+            if "caused_by" in error:
+                caused_by = " Caused by: " + str(error["caused_by"].get("type")) + " | " + str(error["caused_by"].get("reason")) + "."
+            logger.error("%s: Failed to push %s of %s logs. First error code %s. Root cause: %s | %s.%s", log_range.description, number_of_retries + len(dead_letters), number_of_logs, err_code, error.get("type"), error.get("reason"), caused_by)
+        
+        if len(dead_letters) > 0:
+            logger.error("%s: %s logs cannot be indexed and will not be retried. %s", log_range.description, len(dead_letters), ("They are saved to " + dead_letter_path + "." if write_dead_letters(log_range, dead_letters) else ""))
+        
+        if number_of_retries == 0:
+            logger.info("%s: Successfully pushed %s logs to Elasticsearch.", log_range.description, number_of_logs - len(dead_letters))
+            return True, final_json, number_of_logs
+        
+        #only the logs that can be retried will be pushed again
+        logger.error("%s: %s logs will be pushed again. %s", log_range.description, number_of_retries, retry_msg)
+        return False, retry_json, number_of_retries
+    elif status_code == 200:
+        logger.error("%s: Unexpected error occured with error code %s. Error dump: %s. \n%s", log_range.description, status_code, content.decode("utf-8", "replace"), retry_msg)
+        return False, final_json, number_of_logs
+    
+    #if the HTTP response code is not 200, means something happened to the whole request, and an error message will be returned to the user
+    try:
+        if "error" in result_json:
+            err_type = result_json["error"]["root_cause"][0]["type"]
+            err_msg = result_json["error"]["root_cause"][0]["reason"]
+            logger.error("%s: Failed to push logs with error code %s. Root cause: %s | %s. \n%s", log_range.description, status_code, err_type, err_msg, retry_msg)
+        else:
+            logger.error("%s: Unexpected error occured with error code %s. Error dump: %s. \n%s", log_range.description, status_code, content.decode("utf-8", "replace"), retry_msg)
+    except (KeyError, IndexError, TypeError):
+        logger.error("%s: Unexpected error occured with error code %s. Error dump: %s. \n%s", log_range.description, status_code, content.decode("utf-8", "replace"), retry_msg)
+    
+    if give_up is True:
+        error = result_json.get("error") if isinstance(result_json, dict) else None
+        return dead_letter_request(log_range, final_json, number_of_logs, status_code, error if isinstance(error, dict) else {"reason": content.decode("utf-8", "replace")})
+    return False, final_json, number_of_logs
+
+'''
+This method writes all the logs of a bulk request to the dead-letter file, once Elasticsearch has refused the whole request with a status which is not worth retrying.
+The logs are taken care of this way, the same as the logs refused one by one, so it returns the same as handle_bulk_response() does once the logs have been pushed.
+'''
+def dead_letter_request(log_range, final_json, number_of_logs, status_code, error):
+    metric_bulk_rejected_docs.inc(number_of_logs, zone=log_range.zone.name)
+    logger.error("%s: %s logs cannot be indexed and will not be retried. %s", log_range.description, number_of_logs, ("They are saved to " + dead_letter_path + "." if write_dead_letters(log_range, chunk_dead_letters(final_json, status_code, error)) else ""))
+    return True, final_json, number_of_logs
+        
+    
+'''
+This method is used in streaming mode. It reads the response from Cloudflare API line by line, instead of loading the whole log range into memory.
+Each line will be handed to the archive writer (if the user wants to store a copy of raw logs), and added to a bounded bulk chunk at the same time.
+A chunk will be handed to the push workers as soon as it reaches the maximum size in bytes or the maximum number of logs, so the memory usage stays flat no matter how many logs are in the log range.
+It returns whether the streaming is successful, and the number of logs streamed.
+'''
+def stream_logs(r, log_range, writer):
+    
+    chunk = []
+    chunk_bytes = chunk_docs = 0
+    number_of_logs = number_of_bytes = 0
+    max_docs = bulk_sizer.current()
+    
+    try:
+        #feed each lines of logs from the response as they arrive
+        for line in r.iter_lines(chunk_size=65536):
+            if not line:
+                #skip empty lines
+                continue
+            
+            #stop reading once the drain deadline has passed, the log range will be pulled again
+            if lifecycle.deadline is not None and lifecycle.expired() is True:
+                logger.warning("%s: The program is exiting. Streaming logs from Cloudflare is stopped.", log_range.description)
+                return False, number_of_logs
+            
+            number_of_logs += 1
+            number_of_bytes += len(line) + 1
+            if writer is not None:
+                writer.write(line + b"\n")
+            
+            #no need to build the bulk chunk if the logs will not push to Elasticsearch
+            if store_only is True:
+                continue
+            
+            #this metadata is required by Elasticsearch bulk tasks
+            metadata = bulk_action(line)
+            chunk.append(metadata)
+            chunk.append(line + b"\n")
+            chunk_bytes += len(metadata) + len(line) + 1
+            chunk_docs += 1
+            
+            #hand the chunk to the push workers once it is full, then start a new one
+            #this will wait if the push workers are busy, so we stop reading from Cloudflare until there's room again
+            if chunk_docs >= max_docs or chunk_bytes >= bulk_max_bytes:
+                queue_push(log_range, b"".join(chunk), chunk_docs)
+                chunk = []
+                chunk_bytes = chunk_docs = 0
+                max_docs = bulk_sizer.current()
+    except requests.exceptions.RequestException as e:
+        #the connection to Cloudflare may be interrupted in the middle of the stream
+        logger.error("%s: Unexpected error occured while streaming logs from Cloudflare. Error dump: %s", log_range.description, e)
+        return False, number_of_logs
+    finally:
+        r.close()
+    
+    #hand the remaining logs in the last chunk to the push workers
+    if chunk_docs > 0:
+        queue_push(log_range, b"".join(chunk), chunk_docs)
+    
+    log_range.number_of_bytes = number_of_bytes
+    return True, number_of_logs
+
+'''
+This method hands the processed logs of a log range to the push workers.
+If the queue is full, it will wait until a push worker is free, which applies backpressure to the fetch workers.
+'''
+def queue_push(log_range, final_json, number_of_logs):
+    #with the rollup stage, only the sample of the raw logs is pushed
+    if log_range.rollup is not None:
+        final_json, number_of_logs = log_range.rollup.add(final_json)
+        if number_of_logs == 0:
+            return
+    
+    #with the transform stage in the transform workers, the push worker will wait for the changed logs, so the fetch worker can carry on
+    if transform_pool is not None:
+        final_json = transform_pool.submit(transform_chunk, final_json)
+    elif log_transformer is not None:
+        final_json, number_of_logs = log_transformer.transform_chunk(final_json)
+    
+    log_range.add_chunk()
+    push_queue.put((log_range, final_json, number_of_logs))
+
+'''
+This method will run as a separate thread. It takes the processed logs from the queue and pushes them to Elasticsearch, until it receives None from the queue.
+'''
+def push_worker():
+    while True:
+        task = push_queue.get()
+        if task is None:
+            break
+        
+        log_range, final_json, number_of_logs = task
+        
+        try:
+            if isinstance(final_json, Future):
+                final_json, number_of_logs = final_json.result()
+            
+            #the transform stage may have removed all the logs in the chunk, then there's nothing to push
+            #while there are chunks in the spool, Elasticsearch is likely down, so the chunk is saved to the spool straight away to be pushed after them
+            if number_of_logs > 0 and spool is not None and spool.pending() is True:
+                success = spool.append(log_range, final_json, number_of_logs)
+            elif number_of_logs > 0:
+                logger.info("%s: Pushing %s logs to Elasticsearch...", log_range.description, number_of_logs)
+                success = push_logs(final_json, log_range, number_of_logs, on_failure=(functools.partial(spool.append, log_range) if spool is not None else None))
+            else:
+                success = True
+        except Exception as e:
+            logger.error("%s: Unexpected error occured while pushing logs to Elasticsearch. Error dump: %s", log_range.description, e)
+            success = False
+        
+        log_range.chunk_done(success)
+
+'''
+This method will run as a separate thread. It takes the log ranges from the queue and handles them one by one, until it receives None from the queue.
+'''
+def fetch_worker():
+    while True:
+        log_range = fetch_queue.get()
+        if log_range is None:
+            break
+        
+        try:
+            logs(log_range)
+        except Exception as e:
+            logger.error("%s: Unexpected error occured while pulling logs from Cloudflare. Error dump: %s", log_range.description, e)
+            log_range.finish_fetch("Logpull error")
+
+'''
+A method to wait for the archive writer to finish writing the logfile (if the user wants to store a copy of raw logs), and finish the log range accordingly.
+The asyncio engine hands the rollups to the push tasks itself before calling it, so it asks for the rollups to be skipped here.
+'''
+def finish_writing(log_range, writer, rollup_queued=False):
+    if writer is not None:
+        if writer.close():
+            logger.info("%s: Logs saved as %s.", log_range.description, writer.path)
+        else:
+            logger.error("%s: Failed to save logs to local storage.", log_range.description)
+            return log_range.finish_fetch("Write log error")
+    
+    if log_range.rollup is not None and rollup_queued is False:
+        queue_rollup(log_range)
+    
+    return log_range.finish_fetch()
+
+'''
+This method hands the rollups of a log range to the push workers, once all the logs of the log range have been counted.
+The rollups skip the transform stage, as they are not raw logs. With the asyncio engine, they have been handed to the push tasks already, unless it's replay mode.
+'''
+def queue_rollup(log_range):
+    for final_json, number_of_logs in log_range.rollup.finish():
+        log_range.add_chunk()
+        if async_engine is not None:
+            asyncio.run_coroutine_threadsafe(async_engine.push_queue.put((log_range, final_json, number_of_logs)), async_engine.loop).result()
         else:
-            path_with_date = path + ("/" + today_date + "/" + current_hour)
-        data_folder = initialize_folder(path_with_date)
+            push_queue.put((log_range, final_json, number_of_logs))
+
+'''
+This method checks the error returned by Cloudflare API, for both the threads and the asyncio engine, and returns the number of seconds to wait before the next attempt.
+If Cloudflare tells us to slow down with HTTP 429, the zone is paused for as long as Retry-After says, or with exponential backoff if it doesn't say.
+'''
+def handle_logpull_error(log_range, status_code, content, headers, attempt):
+    retry_msg = ("Retrying " + str(attempt+1) + " of " + str(retry_attempt) + "...") if attempt < (retry_attempt) else ""
+    text = content.decode("utf-8", "replace")
+    
+    if status_code == 429:
+        delay = retry_after(headers)
+        delay = delay if delay is not None else backoff_delay(attempt)
+        metric_fetch_throttled.inc(zone=log_range.zone.name)
+        cf_scheduler.pause(log_range.zone, delay)
+        logger.warning("%s: Rate limited by Cloudflare API. Requests of the zone are paused for %s seconds. %s", log_range.description, round(delay, 1), retry_msg)
+        
+        #the scheduler will hold the next attempt until the pause is over
+        return 0
+    
+    #if HTTP response code is not 200, means something happened
+    logger.debug("Output from Cloudflare API:\n%s", text) #the raw response will be logged only if the user enables debugging
+    try:
+        #load the JSON object to better access the content of it
+        response = json.loads(text)
+    except ValueError:
+        #something weird happened if the response is not a JSON object, thus print out the error dump
+        logger.error("%s: Unknown error occured with error code %s. Error dump: %s. %s", log_range.description, status_code, text, retry_msg)
+        return backoff_delay(attempt)
+    
+    #to check whether "success" key exists in JSON object, if yes, check whether the value is False, and print out the error message
+    if isinstance(response, dict) and response.get("success") is False:
+        try:
+            logger.error("%s: Failed to request logs from Cloudflare with error code %s: %s. %s", log_range.description, response["errors"][0]["code"], response["errors"][0]["message"], retry_msg)
+            return backoff_delay(attempt)
+        except (KeyError, IndexError, TypeError):
+            pass
+    
+    #something weird happened if it is not False. If the request has been successfully done, it should not return this kind of error, instead the raw logs should be returned with HTTP response code 200.
+    #other type of error may occur, which may not return a JSON object.
+    logger.error("%s: Unknown error occured with error code %s. Error dump: %s. %s", log_range.description, status_code, text, retry_msg)
+    return backoff_delay(attempt)
+
+'''
+This method prepares a log range before its logs are pulled, for both the threads and the asyncio engine.
+It counts the log range as in progress, and checks whether it has to be pulled at all.
+It returns the path to store the raw logs (None if the user doesn't want them stored), or False if the log range has been skipped.
+'''
+def prepare_log_range(log_range):
+    
+    #count the log range as in progress, so the program knows how many log ranges are left when it exits
+    lifecycle.begin()
+    
+    current_time = log_range.current_time
+    
+    #if the user instructs the program to do logpush for only one time, the logs will not be stored in folder that follows the naming convention: date and time
+    if one_time is True or no_organize is True:
+        pass
+    else:
+        #get the current date and hour, these will be used to initialize the folder to store the logs
+        today_date = str(current_time.date())
+        current_hour = str(current_time.hour) + "00"
+    
+    #check whether the log range has been pulled and pushed successfully before the program restarts. if yes, no further action required
+    if checkpoint is not None and log_range.scheduled is True and checkpoint.is_done(log_range):
+        
+        logger.warning("%s: Log range already pulled according to the checkpoint! Skipping.", log_range.description)
+        
+        log_range.finish_fetch(skipped=True)
+        return False
+    
+    #check whether the user wants to store a copy of raw logs on the local storage. if yes, begin the folder initialization process
+    if no_store is True:
+        return None
+    
+    #initialize the folder with the path specified below
+    #if there are multiple zones, the logs of each zone will be stored in its own folder, named after the zone
+    #if the user instructs the program to do logpush for only one time, it will be stored in another folder instead of the naming convention of the folder: date and time
+    #the Parquet files are stored in a folder for each hour of the logs instead, so the hours outside the time range can be skipped when the logs are read
+    zone_path = path + ("/" + log_range.zone.name if zones_config is not None else "")
+    if archive_format == "parquet":
+        path_with_date = zone_path + "/date=" + str(log_range.log_start_time_utc.date()) + "/hour=" + "%02d" % log_range.log_start_time_utc.hour
+    elif one_time is True or no_organize is True:
+        path_with_date = zone_path
+    else:
+        path_with_date = zone_path + ("/" + today_date + "/" + current_hour)
+    data_folder = initialize_folder(path_with_date)
 
-        #prepare the full path (incl. file name) to store the logs
-        logfile_path = prepare_path(log_start_time_rfc3389, log_end_time_rfc3389, data_folder)
+    #prepare the full path (incl. file name) to store the logs
+    logfile_path = prepare_path(log_range.log_start_time_rfc3389, log_range.log_end_time_rfc3389, data_folder, overwrite=log_range.backfill)
 
-        #check the returned value from prepare_path() method. if False, means logfile already exists and no further action required
-        if logfile_path is False:
+    #check the returned value from prepare_path() method. if False, means logfile already exists and no further action required
+    if logfile_path is False:
 
-            logger.warning(str(datetime.now()) + " --- Log range " + log_start_time_rfc3389 + " to " + log_end_time_rfc3389 + ": Logfile already exists! Skipping.")
+        logger.warning("%s: Logfile already exists! Skipping.", log_range.description)
 
-            return check_if_exited()
+        log_range.finish_fetch(skipped=True)
+        return False
     
-    #specify the URL for the Cloudflare API endpoint, with parameters such as Zone ID, the start time and end time of the logs to pull, timestamp format, sample rate and the fields to be included in the logs
-    url = "https://api.cloudflare.com/client/v4/zones/" + zone_id + "/logs/received?start=" + log_start_time_rfc3389 + "&end=" + log_end_time_rfc3389 + "&timestamps="+ timestamp_format +"&sample=" + sample_rate + "&fields=" + fields
+    return logfile_path
 
-    #specify headers for the content type and access token 
-    headers = {"Authorization": "Bearer " + access_token, "Content-Type": "application/json"}
+'''
+This method will handle the overall log processing tasks and it will be run by the fetch workers.
+Based on the interval setting configured by the user, this method will only handle logs for a specific time slot.
+The processed logs will be handed to the push workers, and the result will be recorded once all of them have been pushed.
+'''
+def logs(log_range):
+    
+    global path, no_store, logger, retry_attempt, store_only, no_organize, no_gzip
+    
+    #a variable to check whether the request to Cloudflare API is successful.
+    request_success = False
+    
+    logfile_path = prepare_log_range(log_range)
+    if logfile_path is False:
+        return
+    
+    #specify the URL for the Cloudflare API endpoint, with the start time and end time of the logs to pull
+    url = log_range.zone.logs_url + "?start=" + log_range.log_start_time_rfc3389 + "&end=" + log_range.log_end_time_rfc3389 + log_range.zone.logs_query
 
-    logger.info(str(datetime.now()) + " --- Log range " + log_start_time_rfc3389 + " to " + log_end_time_rfc3389 + ": Requesting logs from Cloudflare...")
+    logger.info("%s: Requesting logs from Cloudflare...", log_range.description)
     
     #5 retries will be given for the logpull process, in case something happens
+    #the first request has been allowed by the scheduler when the log range was handed to the fetch worker, the retries have to wait for their turn
     for i in range(retry_attempt+1):
-        #make a GET request to the Cloudflare API
-        r = requests.get(url, headers=headers)
-        r.encoding = 'utf-8'
+        if lifecycle.expired() is True:
+            break
+        if i > 0:
+            metric_retries.inc(stage="fetch", zone=log_range.zone.name)
+            cf_scheduler.acquire(log_range.zone)
+        
+        #make a GET request to the Cloudflare API. in streaming mode, the response body will not be downloaded until we read it
+        #the connection to Cloudflare API will be reused by the session, even for different zones
+        request_time = time.time()
+        try:
+            r = cf_session.get(url, headers=log_range.zone.headers, stream=stream_mode)
+            metric_fetch_seconds.observe(time.time() - request_time, zone=log_range.zone.name)
+        except requests.exceptions.RequestException as e:
+            logger.error("%s: Unexpected error occured while requesting logs from Cloudflare. Error dump: %s. %s", log_range.description, e, (("Retrying " + str(i+1) + " of " + str(retry_attempt) + "...") if i < (retry_attempt) else ""))
+            lifecycle.backoff(backoff_delay(i))
+            continue
         
         #check whether the HTTP response code is 200, if yes then logpull success and exit the loop
         if r.status_code == 200:
             request_success = True
             break
-        else:
-            #if HTTP response code is not 200, means something happened
-            logger.debug(str(datetime.now()) + " --- Output from Cloudflare API:\n" + r.text) #the raw response will be logged only if the user enables debugging
-            try:
-                #load the JSON object to better access the content of it
-                response = json.loads(r.text)
-            except:
-                #something weird happened if the response is not a JSON object, thus print out the error dump
-                logger.error(str(datetime.now()) + " --- Log range " + log_start_time_rfc3389 + " to " + log_end_time_rfc3389 + ": Unknown error occured with error code " + str(r.status_code) + ". Error dump: " + r.text + ". " + (("Retrying " + str(i+1) + " of " + str(retry_attempt) + "...") if i < (retry_attempt) else ""))
-                time.sleep(3)
-                continue
-
-            #to check whether "success" key exists in JSON object, if yes, check whether the value is False, and print out the error message
-            if "success" in response:
-                if response["success"] is False:
-                    logger.error(str(datetime.now()) + " --- Log range " + log_start_time_rfc3389 + " to " + log_end_time_rfc3389 + ": Failed to request logs from Cloudflare with error code " + str(response["errors"][0]["code"]) + ": " + response["errors"][0]["message"] + ". " + (("Retrying " + str(i+1) + " of " + str(retry_attempt) + "...") if i < (retry_attempt) else ""))
-                    time.sleep(3)
-                    continue
-                else:
-                    #something weird happened if it is not False. If the request has been successfully done, it should not return this kind of error, instead the raw logs should be returned with HTTP response code 200.
-                    logger.error(str(datetime.now()) + " --- Log range " + log_start_time_rfc3389 + " to " + log_end_time_rfc3389 + ": Unknown error occured with error code " + str(r.status_code) + ". Error dump: " + r.text + ". " + (("Retrying " + str(i+1) + " of " + str(retry_attempt) + "...") if i < (retry_attempt) else ""))
-                    time.sleep(3)
-                    continue
-            else:
-                #other type of error may occur, which may not return a JSON object.
-                logger.error(str(datetime.now()) + " --- Log range " + log_start_time_rfc3389 + " to " + log_end_time_rfc3389 + ": Unknown error occured with error code " + str(r.status_code) + ". Error dump: " + r.text + ". " + (("Retrying " + str(i+1) + " of " + str(retry_attempt) + "...") if i < (retry_attempt) else ""))
-                time.sleep(3)
-                continue
+        lifecycle.backoff(handle_logpull_error(log_range, r.status_code, r.content, r.headers, i))
             
     #check whether the logpull process from Cloudflare API has been successfully completed, if yes then proceed with next steps
+    #if the program is exiting, the log range is recorded as failed, so it will be pulled again after the program restarts
     if request_success is False:
-        fail_logger.error("Log range " + log_start_time_rfc3389 + " to " + log_end_time_rfc3389 + " (Logpull error)")
-        return check_if_exited()
+        return log_range.finish_fetch("Shutdown" if lifecycle.expired() is True else "Logpull error")
+
+    #in streaming mode, the logs will be saved and pushed to Elasticsearch chunk by chunk while they are being read from Cloudflare
+    if stream_mode is True:
+        logger.info("%s: Logs requested. Streaming logs%s", log_range.description, (" to local storage." if store_only is True else " to Elasticsearch."))
+        writer = open_archive(logfile_path, log_range.zone) if no_store is False else None
+        stream_success, number_of_logs = stream_logs(r, log_range, writer)
+        
+        if stream_success is False:
+            #remove the incomplete logfile, so the log range will not be treated as pulled previously
+            if writer is not None:
+                writer.abort()
+            return log_range.finish_fetch("Shutdown" if lifecycle.expired() is True else "Logpull error")
+        
+        logger.info("%s: %s logs streamed.", log_range.description, number_of_logs)
+        log_range.number_of_logs = number_of_logs
+        record_transfer(log_range, r.headers.get("Content-Encoding"), r.raw.tell())
+        
+        return finish_writing(log_range, writer)
+
+    #the response has been decompressed by the session while it was downloaded, and the raw response keeps count of the bytes received
+    log_range.number_of_bytes = len(r.content)
+    record_transfer(log_range, r.headers.get("Content-Encoding"), r.raw.tell())
 
     #check whether the user wants to store a copy of raw logs on the local storage. if not, skip the process and proceed with logpush process
+    #the logs are written and compressed in a separate thread, while they are being processed and pushed to Elasticsearch
+    writer = None
     if no_store is False:
-        logger.info(str(datetime.now()) + " --- Log range " + log_start_time_rfc3389 + " to " + log_end_time_rfc3389 + ": Logs requested. Saving logs...")
-        if write_logs(log_start_time_rfc3389,  log_end_time_rfc3389, logfile_path, r.text):
-            #successful of write logs
-            logger.info(str(datetime.now()) + " --- Log range " + log_start_time_rfc3389 + " to " + log_end_time_rfc3389 + ": Logs saved as " + str(logfile_path) + ". " + ("Logs will not compressed." if no_gzip is True else ""))
-        else:
-            #unsuccessful of write logs
-            logger.error(str(datetime.now()) + " --- Log range " + log_start_time_rfc3389 + " to " + log_end_time_rfc3389 + ": Failed to save logs to local storage.")
-            fail_logger.error("Log range " + log_start_time_rfc3389 + " to " + log_end_time_rfc3389 + " (Write log error)")
-            return check_if_exited()
-
-        if no_gzip is False:
-            if compress_logs(logfile_path):
-                #successful of compress logs
-                logger.info(str(datetime.now()) + " --- Log range " + log_start_time_rfc3389 + " to " + log_end_time_rfc3389 + ": Logs compressed in gzip format: " + str(logfile_path) + ".gz")
-            else:
-                #unsuccessful of compress logs
-                logger.error(str(datetime.now()) + " --- Log range " + log_start_time_rfc3389 + " to " + log_end_time_rfc3389 + ": An error occured while compressing " + str(logfile_path) + ".gz")
-                fail_logger.error("Log range " + log_start_time_rfc3389 + " to " + log_end_time_rfc3389 + " (Compress log error)")
-                return check_if_exited()
+        logger.info("%s: Logs requested. Saving logs...", log_range.description)
+        writer = open_archive(logfile_path, log_range.zone)
+        writer.write(r.content)
 
-        #if the user instructs the script not to push logs to Elasticsearch, this function will return check_if_exited() function.
+        #if the user instructs the script not to push logs to Elasticsearch, the log range is done here.
         if store_only is True:
-            succ_logger.info("Log range " + log_start_time_rfc3389 + " to " + log_end_time_rfc3389)
-            return check_if_exited()
+            log_range.number_of_logs = r.content.count(b"\n")
+            return finish_writing(log_range, writer)
     else:
-        logger.info(str(datetime.now()) + " --- Log range " + log_start_time_rfc3389 + " to " + log_end_time_rfc3389 + ": Logs requested. Raw logs will not be saved on local storage.")
+        logger.info("%s: Logs requested. Raw logs will not be saved on local storage.", log_range.description)
 
-    logger.info(str(datetime.now()) + " --- Log range " + log_start_time_rfc3389 + " to " + log_end_time_rfc3389 + ": Processing logs for Elasticsearch Bulk tasks.")
+    logger.info("%s: Processing logs for Elasticsearch Bulk tasks.", log_range.description)
 
     #invoke process_logs method to make the logs compatible with Elasticsearch bulk tasks. 
     #this method will return the final result with the number of logs processed
-    final_json, number_of_logs = process_logs(r.text)
+    process_time = time.time()
+    chunks, number_of_logs = process_logs(r.content)
+    metric_process_seconds.observe(time.time() - process_time, zone=log_range.zone.name)
+    log_range.number_of_logs = number_of_logs
     
     #check whether the number of logs processed is less than or equal to zero. if yes means that the logpush process is no longer required, thus skip the process
     if number_of_logs <= 0:
         
-        logger.info(str(datetime.now()) + " --- Log range " + log_start_time_rfc3389 + " to " + log_end_time_rfc3389 + ": 0 logs requested from this log range. No further action required.")
-        succ_logger.info("Log range " + log_start_time_rfc3389 + " to " + log_end_time_rfc3389)
+        logger.info("%s: 0 logs requested from this log range. No further action required.", log_range.description)
         
-        #invoke this method to check whether the user triggers program exit sequence, and ends the thread
-        return check_if_exited()
+        return finish_writing(log_range, writer)
 
-    logger.info(str(datetime.now()) + " --- Log range " + log_start_time_rfc3389 + " to " + log_end_time_rfc3389 + ": " + str(number_of_logs) + " logs processed.")
+    logger.info("%s: %s logs processed.", log_range.description, number_of_logs)
 
-    logger.info(str(datetime.now()) + " --- Log range " + log_start_time_rfc3389 + " to " + log_end_time_rfc3389 + ": Pushing " + str(number_of_logs) + " logs to Elasticsearch...")
+    #finally, hand the chunks to the push workers. the result will be recorded once all of them have been pushed
+    for final_json, chunk_docs in chunks:
+        queue_push(log_range, final_json, chunk_docs)
+    
+    return finish_writing(log_range, writer)
 
-    #finally, push logs to Elasticsearch
-    push_logs(final_json, log_start_time_rfc3389, log_end_time_rfc3389, number_of_logs)
+        
+'''
+This class is the asyncio engine, which can be used instead of the fetch and push worker threads with --engine asyncio.
+It runs an event loop in its own thread, with async HTTP clients for Cloudflare API and Elasticsearch. The log ranges are taken from the same queue as the fetch workers,
+so the scheduler and the checkpoint work the same way. Each log range is pulled by its own task, up to the number of fetch workers at the same time, and the chunks
+are pushed by as many tasks as the push workers through a bounded queue, so a lot of log ranges and bulk requests can be in flight without a thread for each of them.
+The work that needs the CPU or the disk, such as processing the logs, writing the logfiles and the spool, is handed to the thread pool of the event loop.
+'''
+class AsyncEngine:
+    
+    def __init__(self):
+        self.loop = None
+        self.tasks = set()
+        self.cancelled = False
+        self.ready = threading.Event()
+        self.done = threading.Event()
+        self.thread = threading.Thread(target=self.run_loop, name="asyncio-engine", daemon=True)
+    
+    #start the event loop, and wait until the queue to the push tasks is created, so the other parts of the program can access it
+    def start(self):
+        self.thread.start()
+        self.ready.wait()
+    
+    #wait until the event loop stops
+    def join(self, timeout=None):
+        return self.done.wait(timeout)
+    
+    def run_loop(self):
+        try:
+            asyncio.run(self.main())
+        finally:
+            self.ready.set()
+            self.done.set()
+    
+    #cancel all the log ranges and chunks in progress, once the drain deadline has passed
+    #they will be recorded as failed, so they will be pulled again by the backfill if the checkpoint is enabled
+    def cancel(self):
+        if self.loop is not None:
+            self.loop.call_soon_threadsafe(self.cancel_tasks)
+    
+    def cancel_tasks(self):
+        self.cancelled = True
+        self.main_task.cancel()
+        for task in list(self.tasks):
+            task.cancel()
+    
+    def spawn(self, coroutine):
+        task = self.loop.create_task(coroutine)
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+        return task
+    
+    #run a blocking function in the thread pool of the event loop
+    async def run_blocking(self, function, *args):
+        return await self.loop.run_in_executor(None, functools.partial(function, *args))
+    
+    #the decompressor for a response from Cloudflare, or None if it's not compressed. 47 lets zlib detect either the gzip or the zlib wrapper
+    @staticmethod
+    def decompressor(r):
+        if r.headers.get("Content-Encoding", "").lower() in ("gzip", "deflate"):
+            return zlib.decompressobj(47)
+        return None
+    
+    #read the whole response from Cloudflare and decompress it. it returns the response with the bytes received over the network
+    async def read_response(self, r):
+        data = await r.read()
+        decompressor = self.decompressor(r)
+        if decompressor is None:
+            return data, len(data)
+        return await self.run_blocking(lambda: decompressor.decompress(data) + decompressor.flush()), len(data)
+    
+    #the same as Lifecycle.backoff()
+    async def backoff(self, seconds):
+        until = time.time() + seconds
+        while lifecycle.expired() is False and time.time() < until:
+            await asyncio.sleep(max(0.0, min(until - time.time(), 0.5)))
+    
+    async def main(self):
+        
+        global push_queue
+        
+        self.loop = asyncio.get_running_loop()
+        self.main_task = asyncio.current_task()
+        self.push_queue = push_queue = asyncio.Queue(maxsize=queue_size)
+        
+        #the headers and the credentials are attached to the sessions, the same as the sessions of the worker threads
+        #the responses from Cloudflare are decompressed by the engine instead of the session, so the bytes received over the network can be counted
+        timeout = aiohttp.ClientTimeout(total=None, sock_connect=30)
+        self.cf_session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=(pool_size if pool_size is not None else fetch_workers)), headers={"Content-Type": "application/json", "Accept-Encoding": cf_accept_encoding}, timeout=timeout, auto_decompress=False)
+        self.es_session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=(pool_size if pool_size is not None else push_workers), ssl=False), headers={"Content-Type": "application/json"}, auth=aiohttp.BasicAuth(username, password), timeout=timeout)
+        self.ready.set()
+        
+        pushers = [self.spawn(self.push_worker()) for i in range(push_workers)]
+        try:
+            #the queue of the scheduler blocks, so the log ranges are taken from it in a separate thread. a log range is only taken once there's room for another one
+            slots = asyncio.Semaphore(fetch_workers)
+            with ThreadPoolExecutor(max_workers=1, thread_name_prefix="asyncio-feeder") as feeder:
+                while True:
+                    await slots.acquire()
+                    log_range = await self.loop.run_in_executor(feeder, fetch_queue.get)
+                    if log_range is None:
+                        break
+                    self.spawn(self.fetch(log_range)).add_done_callback(lambda task: slots.release())
+            
+            #wait for the log ranges being pulled, then tell the push tasks to stop once they finish the remaining chunks
+            await asyncio.gather(*[task for task in self.tasks if task not in pushers], return_exceptions=True)
+            for task in pushers:
+                await self.push_queue.put(None)
+            await asyncio.gather(*pushers, return_exceptions=True)
+        except asyncio.CancelledError:
+            await asyncio.gather(*self.tasks, return_exceptions=True)
+        finally:
+            #the chunks left in the queue after the push tasks are cancelled will not be pushed, they are saved to the spool if it's enabled
+            while not self.push_queue.empty():
+                task = self.push_queue.get_nowait()
+                if task is None:
+                    continue
+                log_range, final_json, number_of_logs = task
+                if spool is not None and number_of_logs > 0 and not isinstance(final_json, asyncio.Future):
+                    log_range.chunk_done(await self.run_blocking(spool.append, log_range, final_json, number_of_logs))
+                else:
+                    log_range.chunk_done(False)
+            
+            await self.cf_session.close()
+            await self.es_session.close()
+    
+    async def fetch(self, log_range):
+        try:
+            await self.logs(log_range)
+        except asyncio.CancelledError:
+            logger.warning("%s: Cancelled.", log_range.description)
+            log_range.finish_fetch("Cancelled")
+        except Exception as e:
+            logger.error("%s: Unexpected error occured while pulling logs from Cloudflare. Error dump: %s", log_range.description, e)
+            log_range.finish_fetch("Logpull error")
+    
+    #the same as queue_push(), the transform stage runs in the transform workers or in the thread pool, so it doesn't hold up the event loop
+    async def queue_push(self, log_range, final_json, number_of_logs):
+        if log_range.rollup is not None:
+            final_json, number_of_logs = await self.run_blocking(log_range.rollup.add, final_json)
+            if number_of_logs == 0:
+                return
+        
+        if transform_pool is not None:
+            final_json = asyncio.wrap_future(transform_pool.submit(transform_chunk, final_json))
+        elif log_transformer is not None:
+            final_json, number_of_logs = await self.run_blocking(log_transformer.transform_chunk, final_json)
+        
+        log_range.add_chunk()
+        try:
+            await self.push_queue.put((log_range, final_json, number_of_logs))
+        except asyncio.CancelledError:
+            log_range.chunk_done(False)
+            raise
+    
+    #the same as push_worker(), until it receives None from the queue
+    async def push_worker(self):
+        while True:
+            task = await self.push_queue.get()
+            if task is None:
+                break
+            
+            log_range, final_json, number_of_logs = task
+            
+            try:
+                if isinstance(final_json, asyncio.Future):
+                    final_json, number_of_logs = await final_json
+                
+                if number_of_logs > 0 and spool is not None and spool.pending() is True:
+                    success = await self.run_blocking(spool.append, log_range, final_json, number_of_logs)
+                elif number_of_logs > 0:
+                    logger.info("%s: Pushing %s logs to Elasticsearch...", log_range.description, number_of_logs)
+                    success = await self.push_logs(final_json, log_range, number_of_logs)
+                else:
+                    success = True
+            except asyncio.CancelledError:
+                log_range.chunk_done(False)
+                raise
+            except Exception as e:
+                logger.error("%s: Unexpected error occured while pushing logs to Elasticsearch. Error dump: %s", log_range.description, e)
+                success = False
+            
+            log_range.chunk_done(success)
+    
+    #the same as push_logs(), the logs that still cannot be pushed are saved to the spool if it's enabled
+    async def push_logs(self, final_json, log_range, number_of_logs):
+        if isinstance(final_json, str):
+            final_json = final_json.encode("utf-8")
+        encoded_json = None
+        
+        for i in range(retry_attempt+1):
+            retry_msg = ("Retrying " + str(i+1) + " of " + str(retry_attempt) + "...") if i < (retry_attempt) else ""
+            if i > 0:
+                metric_retries.inc(stage="bulk", zone=log_range.zone.name)
+            
+            if lifecycle.expired() is True:
+                logger.warning("%s: The program is exiting. %s logs are not pushed to Elasticsearch.", log_range.description, number_of_logs)
+                break
+            
+            #the body is compressed in the thread pool, as zlib lets go of the GIL while it's compressing
+            if encoded_json is not final_json:
+                body, headers = await self.run_blocking(encode_bulk, final_json) if bulk_compression != "none" else encode_bulk(final_json)
+                encoded_json = final_json
+            metric_bulk_bytes.inc(len(final_json), zone=log_range.zone.name, stage="raw")
+            metric_bulk_bytes.inc(len(body), zone=log_range.zone.name, stage="wire")
+            
+            node = es_nodes.acquire()
+            request_time = time.time()
+            try:
+                async with self.es_session.post(node["url"] + log_range.zone.bulk_path, data=body, headers=headers) as r:
+                    content = await r.read()
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                es_nodes.release(node, True)
+                logger.error("%s: Unexpected error occured while pushing logs to Elasticsearch. Error dump: \n%s. \n%s", log_range.description, e, retry_msg)
+                await self.backoff(backoff_delay(i))
+                continue
+            
+            es_nodes.release(node, r.status >= 500)
+            success, final_json, number_of_logs = handle_bulk_response(log_range, final_json, number_of_logs, r.status, content, time.time() - request_time, retry_msg)
+            if success is True:
+                return True
+            await self.backoff(backoff_delay(i))
+        
+        if spool is not None:
+            return await self.run_blocking(spool.append, log_range, final_json, number_of_logs)
+        return False
+    
+    #the same as the requests in logs(). it returns the response once the logs are ready to be read, or None if the logpull failed
+    async def request_logs(self, log_range, url):
+        for i in range(retry_attempt+1):
+            if lifecycle.expired() is True:
+                break
+            if i > 0:
+                metric_retries.inc(stage="fetch", zone=log_range.zone.name)
+                wait = cf_scheduler.try_acquire(log_range.zone)
+                while wait > 0:
+                    await asyncio.sleep(wait)
+                    wait = cf_scheduler.try_acquire(log_range.zone)
+            
+            request_time = time.time()
+            try:
+                r = await self.cf_session.get(url, headers=log_range.zone.headers)
+                metric_fetch_seconds.observe(time.time() - request_time, zone=log_range.zone.name)
+                if r.status == 200:
+                    return r
+                content = (await self.read_response(r))[0]
+            except (aiohttp.ClientError, asyncio.TimeoutError, zlib.error) as e:
+                logger.error("%s: Unexpected error occured while requesting logs from Cloudflare. Error dump: %s. %s", log_range.description, e, (("Retrying " + str(i+1) + " of " + str(retry_attempt) + "...") if i < (retry_attempt) else ""))
+                await self.backoff(backoff_delay(i))
+                continue
+            
+            r.release()
+            await self.backoff(handle_logpull_error(log_range, r.status, content, r.headers, i))
+        
+        return None
+    
+    #the same as stream_logs(). the logs are written to the logfile in blocks, so the thread pool is not called for every line
+    async def stream_logs(self, r, log_range, writer):
+        
+        chunk = []
+        chunk_bytes = chunk_docs = 0
+        number_of_logs = number_of_bytes = 0
+        max_docs = bulk_sizer.current()
+        block = []
+        block_bytes = 0
+        
+        #decompress the response and split it into lines as it arrives
+        async def read_lines():
+            rest = b""
+            decompressor = self.decompressor(r)
+            async for data in r.content.iter_chunked(65536):
+                log_range.wire_bytes += len(data)
+                if decompressor is not None:
+                    data = decompressor.decompress(data)
+                lines = (rest + data).split(b"\n")
+                rest = lines.pop()
+                yield lines
+            if decompressor is not None:
+                rest += decompressor.flush()
+            if rest:
+                yield rest.split(b"\n")
+        
+        try:
+            async for lines in read_lines():
+                for line in lines:
+                    if not line:
+                        continue
+                    
+                    if lifecycle.deadline is not None and lifecycle.expired() is True:
+                        logger.warning("%s: The program is exiting. Streaming logs from Cloudflare is stopped.", log_range.description)
+                        return False, number_of_logs
+                    
+                    number_of_logs += 1
+                    number_of_bytes += len(line) + 1
+                    if writer is not None:
+                        block.append(line + b"\n")
+                        block_bytes += len(line) + 1
+                    
+                    if store_only is True:
+                        continue
+                    
+                    metadata = bulk_action(line)
+                    chunk.append(metadata)
+                    chunk.append(line + b"\n")
+                    chunk_bytes += len(metadata) + len(line) + 1
+                    chunk_docs += 1
+                    
+                    if chunk_docs >= max_docs or chunk_bytes >= bulk_max_bytes:
+                        await self.queue_push(log_range, b"".join(chunk), chunk_docs)
+                        chunk = []
+                        chunk_bytes = chunk_docs = 0
+                        max_docs = bulk_sizer.current()
+                
+                if block_bytes >= ArchiveWriter.block_size:
+                    await self.run_blocking(writer.write, b"".join(block))
+                    block = []
+                    block_bytes = 0
+        except (aiohttp.ClientError, asyncio.TimeoutError, zlib.error) as e:
+            logger.error("%s: Unexpected error occured while streaming logs from Cloudflare. Error dump: %s", log_range.description, e)
+            return False, number_of_logs
+        finally:
+            r.release()
+        
+        if block_bytes > 0:
+            await self.run_blocking(writer.write, b"".join(block))
+        if chunk_docs > 0:
+            await self.queue_push(log_range, b"".join(chunk), chunk_docs)
+        
+        log_range.number_of_bytes = number_of_bytes
+        return True, number_of_logs
+    
+    #the same as queue_rollup(). the rollups are handed to the push tasks here, so the thread running finish_writing() will not wait for the event loop
+    async def queue_rollup(self, log_range):
+        for final_json, number_of_logs in log_range.rollup.finish():
+            log_range.add_chunk()
+            try:
+                await self.push_queue.put((log_range, final_json, number_of_logs))
+            except asyncio.CancelledError:
+                log_range.chunk_done(False)
+                raise
+    
+    #the same as finish_writing(). if the log range is cancelled in the meantime, it still waits for the logfile to be closed, as the log range is done by then
+    async def finish_writing(self, log_range, writer):
+        rollup_queued = log_range.rollup is not None
+        if rollup_queued is True:
+            await self.queue_rollup(log_range)
+        
+        future = self.loop.run_in_executor(None, functools.partial(finish_writing, log_range, writer, rollup_queued=rollup_queued))
+        try:
+            return await asyncio.shield(future)
+        except asyncio.CancelledError:
+            await future
+            raise
+    
+    #the same as logs()
+    async def logs(self, log_range):
+        
+        logfile_path = prepare_log_range(log_range)
+        if logfile_path is False:
+            return
+        
+        url = log_range.zone.logs_url + "?start=" + log_range.log_start_time_rfc3389 + "&end=" + log_range.log_end_time_rfc3389 + log_range.zone.logs_query
+        
+        logger.info("%s: Requesting logs from Cloudflare...", log_range.description)
+        r = await self.request_logs(log_range, url)
+        if r is None:
+            return log_range.finish_fetch("Shutdown" if lifecycle.expired() is True else "Logpull error")
+        
+        writer = None
+        try:
+            if stream_mode is True:
+                logger.info("%s: Logs requested. Streaming logs%s", log_range.description, (" to local storage." if store_only is True else " to Elasticsearch."))
+                writer = open_archive(logfile_path, log_range.zone) if no_store is False else None
+                stream_success, number_of_logs = await self.stream_logs(r, log_range, writer)
+                
+                if stream_success is False:
+                    if writer is not None:
+                        await self.run_blocking(writer.abort)
+                    return log_range.finish_fetch("Shutdown" if lifecycle.expired() is True else "Logpull error")
+                
+                logger.info("%s: %s logs streamed.", log_range.description, number_of_logs)
+                log_range.number_of_logs = number_of_logs
+                record_transfer(log_range, r.headers.get("Content-Encoding"), log_range.wire_bytes)
+                return await self.finish_writing(log_range, writer)
+            
+            try:
+                content, wire_bytes = await self.read_response(r)
+            except (aiohttp.ClientError, asyncio.TimeoutError, zlib.error) as e:
+                logger.error("%s: Unexpected error occured while requesting logs from Cloudflare. Error dump: %s", log_range.description, e)
+                return log_range.finish_fetch("Logpull error")
+            finally:
+                r.release()
+            log_range.number_of_bytes = len(content)
+            record_transfer(log_range, r.headers.get("Content-Encoding"), wire_bytes)
+            
+            if no_store is False:
+                logger.info("%s: Logs requested. Saving logs...", log_range.description)
+                writer = open_archive(logfile_path, log_range.zone)
+                await self.run_blocking(writer.write, content)
+                
+                if store_only is True:
+                    log_range.number_of_logs = content.count(b"\n")
+                    return await self.finish_writing(log_range, writer)
+            else:
+                logger.info("%s: Logs requested. Raw logs will not be saved on local storage.", log_range.description)
+            
+            logger.info("%s: Processing logs for Elasticsearch Bulk tasks.", log_range.description)
+            
+            process_time = time.time()
+            chunks, number_of_logs = await self.run_blocking(process_logs, content)
+            metric_process_seconds.observe(time.time() - process_time, zone=log_range.zone.name)
+            log_range.number_of_logs = number_of_logs
+            
+            if number_of_logs <= 0:
+                logger.info("%s: 0 logs requested from this log range. No further action required.", log_range.description)
+                return await self.finish_writing(log_range, writer)
+            
+            logger.info("%s: %s logs processed.", log_range.description, number_of_logs)
+            
+            for final_json, chunk_docs in chunks:
+                await self.queue_push(log_range, final_json, chunk_docs)
+            
+            return await self.finish_writing(log_range, writer)
+        except asyncio.CancelledError:
+            #remove the incomplete logfile, so the log range will not be treated as pulled previously
+            #abort() waits for the writer thread, so it's handed to the thread pool, and the other tasks can be cancelled in the meantime
+            if writer is not None:
+                await self.run_blocking(writer.abort)
+            raise
 
-    #invoke this method to check whether the user triggers program exit sequence
-    return check_if_exited()
 
-        
 ####################################################################################################       
         
         
-#This is where the real execution of the program begins. First it will initialize the parameters supplied by the user
-initialize_arg()
+'''
+This method creates the queues and starts the fetch workers and push workers.
+'''
+def start_workers():
+    
+    global fetch_queue, push_queue, async_engine
+    
+    fetch_queue = FairQueue(queue_size)
+    
+    #with the asyncio engine, the workers are the tasks of the event loop, and the queue to the push tasks is created by the engine
+    if engine == "asyncio":
+        async_engine = AsyncEngine()
+        async_engine.start()
+        return [], []
+    
+    push_queue = queue.Queue(maxsize=queue_size)
+    
+    #the workers are daemon threads, so the program can still exit if one of them is stuck after the drain deadline
+    fetch_threads = [threading.Thread(target=fetch_worker, name="fetch-worker-" + str(i), daemon=True) for i in range(fetch_workers)]
+    push_threads = [threading.Thread(target=push_worker, name="push-worker-" + str(i), daemon=True) for i in range(push_workers)]
+    for thread in fetch_threads + push_threads:
+        thread.start()
+    
+    return fetch_threads, push_threads
+
+'''
+This method tells the workers to stop once they finish the remaining log ranges, and waits for them.
+The fetch workers are stopped first, so all the logs they have pulled can still be pushed by the push workers.
+If the program is exiting, the workers are only waited for until the drain deadline, and the grace period after it.
+'''
+def stop_workers(fetch_threads, push_threads):
+    fetch_queue.close()
+    
+    #with the checkpoint, the log ranges not taken by the fetch workers yet are left to the next run, so the program can exit sooner
+    #they have not been recorded in the checkpoint, so they will be found as missed log ranges and pulled after the program restarts
+    if lifecycle.stopping() is True and checkpoint is not None:
+        log_ranges = fetch_queue.clear()
+        for log_range in log_ranges:
+            checkpoint.remove_pending(log_range)
+        if len(log_ranges) > 0:
+            logger.info("%s log ranges waiting to be pulled will be pulled after the program restarts.", len(log_ranges))
+    
+    #the tasks of the asyncio engine still running after the deadline are cancelled
+    if async_engine is not None and len(lifecycle.join([async_engine.thread])) > 0:
+        logger.warning("Cancelling the log ranges in progress...")
+        async_engine.cancel()
+        async_engine.join(Lifecycle.grace)
+    
+    lifecycle.join(fetch_threads)
+    
+    #after the deadline, the chunks in the queue are saved to the spool or failed quickly, unless a push worker is stuck, then the program will not wait for it
+    for thread in push_threads:
+        while True:
+            try:
+                push_queue.put(None, timeout=0.5)
+                break
+            except queue.Full:
+                if lifecycle.expired() is True and time.time() >= lifecycle.deadline + Lifecycle.grace:
+                    break
+    lifecycle.join(push_threads)
+    
+    if transform_pool is not None:
+        transform_pool.shutdown(wait=not lifecycle.expired())
+    
+    if spool is not None:
+        spool.close()
 
-#After the above execution, it will verify the Zone ID and Access Token given by the user whether they are valid
-verify_credential()
+'''
+This method prints the queue depth and the lag of the scheduler, so the user can tell whether the workers are keeping up.
+If there are multiple zones, the lag of each zone is printed.
+'''
+def log_status(lags, backfill_count):
+    if zones_config is None:
+        lag_msg = "Lagging " + str(int(lags[zones[0].name])) + " seconds behind schedule."
+    else:
+        lag_msg = "Lagging behind schedule: " + ", ".join(name + " " + str(int(lag)) + "s" for name, lag in lags.items()) + "."
+    backfill_msg = (str(backfill_count) + " missed log ranges waiting to be pulled again, ") if checkpoint is not None else ""
+    if adaptive_window is True:
+        if zones_config is None:
+            lag_msg += " Size of next log range: " + str(int(zones[0].window_sizer.current())) + " seconds."
+        else:
+            lag_msg += " Size of next log range: " + ", ".join(zone.name + " " + str(int(zone.window_sizer.current())) + "s" for zone in zones) + "."
+    spool_msg = (str(spool.size) + " bytes of logs in the spool, ") if spool is not None else ""
+    logger.info("Scheduler status: %s log ranges waiting to be pulled, %s%s chunks waiting to be pushed, %s%s log ranges in progress. %s", fetch_queue.qsize(), backfill_msg, push_queue.qsize(), spool_msg, lifecycle.in_flight, lag_msg)
+    
+    #the logs in the spool are never pushed if the replayer has stopped, which should not happen
+    if spool is not None and spool.thread.is_alive() is False:
+        logger.error("The spool replayer has stopped. The logs in the spool will not be pushed to Elasticsearch until the program restarts.")
 
-#if both Zone ID and Access Token are valid, the logpush tasks to Elastic will begin.
-logger.info(str(datetime.now()) + " --- Cloudflare log push tasks to Elastic started.")
+'''
+This method hands a log range to the fetch workers without waiting, and returns False if the queue of the zone is full.
+The log range is marked as in progress in the checkpoint first, so it will not be mistaken as a missed log range while it is being pulled.
+'''
+def hand_over(log_range):
+    if checkpoint is not None:
+        checkpoint.add_pending(log_range)
+    if fetch_queue.put(log_range) is False:
+        if checkpoint is not None:
+            checkpoint.remove_pending(log_range)
+        return False
+    return True
 
-#if the user instructs the program to do logpush for only one time, the program will not do the logpush jobs repeatedly
-if one_time is True:
-    threading.Thread(target=logs, args=(None, start_time_static, end_time_static)).start()
-else:
+'''
+This method schedules the log ranges to be pulled repeatedly, based on the interval setting configured by the user.
+Every log range that is due will be handed to the fetch workers, for each zone. Each zone keeps its own schedule, so if the fetch workers cannot keep up with a zone
+and its queue is full, only that zone will wait. The log ranges that are missed in the meantime will be handed to the fetch workers once there's room again. No log range will be skipped.
+With the checkpoint, the log ranges missed while the program was not running and the ones that failed are found when the program starts, and every backfill interval after that.
+They are handed to the fetch workers after the log ranges that are due, no faster than the catch-up rate.
+'''
+def schedule():
+    
     #first get the current system time, both local and UTC time.
     #the purpose of getting UTC time is to facilitate the calculation of the start and end time to pull the logs from Cloudflare API
     #the purpose of getting local time is to generate a directory structure to store logs, separated by the date and time
@@ -663,33 +4129,385 @@ else:
     #calculate how many seconds to go back from current time to pull the logs. 
     logs_from = 60.0 + ((interval // 60 * 60) + 60)
 
-    #calculate the start time to pull the logs from Cloudflare API
+    #calculate the start time to pull the logs from Cloudflare API, the same for all the zones
     log_start_time_utc = current_time_utc.replace(second=0, microsecond=0) - timedelta(seconds=logs_from)
     current_time = current_time.replace(second=0, microsecond=0) - timedelta(seconds=logs_from)
+    
+    #the difference between local time and UTC time, to find out the local time of the missed log ranges
+    utc_offset = current_time - log_start_time_utc
+    
+    #the next log range of each zone to be handed to the fetch workers, and how long it has been waiting since it was due
+    next_ranges = {zone.name: (log_start_time_utc, current_time) for zone in zones}
+    lags = {zone.name: 0.0 for zone in zones}
+    waiting = set()
+    
+    #the missed log ranges of each zone waiting to be pulled again
+    backfills = {zone.name: deque() for zone in zones}
 
     #this is useful when we need to repeat the execution of a code block after a certain interval, in an accurate way
     #below code will explain the usage of this in detail
     initial_time = time.time()
+    last_status_time = initial_time
+    last_backfill_time = None
 
-    #force the program to run indefinitely, unless the user stops it with Ctrl+C
-    while True:
-
-        #calculate the end time to pull the logs from Cloudflare API, based on the interval value given by the user
-        log_end_time_utc = log_start_time_utc + timedelta(seconds=interval)
+    #force the program to run indefinitely, unless the user stops it with Ctrl+C or SIGTERM
+    while lifecycle.stopping() is False:
+        
+        #look for the missed log ranges of each zone in the checkpoint, up to the next log range to be scheduled
+        if checkpoint is not None and (last_backfill_time is None or time.time() - last_backfill_time >= backfill_interval):
+            for zone in zones:
+                if len(backfills[zone.name]) > 0:
+                    continue
+                try:
+                    gaps = checkpoint.find_gaps(zone, datetime.utcnow() - timedelta(hours=backfill_max_age), next_ranges[zone.name][0])
+                except sqlite3.Error as e:
+                    logger.error("Failed to read the checkpoint. Error dump: %s", e)
+                    continue
+                if len(gaps) > 0:
+                    logger.info("Found %s log ranges%s missed or failed previously, from %sZ to %sZ. Pulling them again.", len(gaps), (" of zone " + zone.name if zones_config is not None else ""), gaps[0][0].isoformat(), gaps[-1][1].isoformat())
+                backfills[zone.name].extend(gaps)
+            last_backfill_time = time.time()
+        
+        blocked = None
+        for zone in zones:
+            log_start_time_utc, current_time = next_ranges[zone.name]
+            
+            #hand every log range of the zone that is due to the fetch workers
+            while True:
+                
+                #calculate the end time to pull the logs from Cloudflare API, based on the interval value given by the user
+                #with adaptive window sizing, the size is based on the recent traffic of the zone instead, and the log range will not go past the hour, so it stays in the folder of the hour
+                window = zone.window_sizer.current()
+                if adaptive_window is True:
+                    window = min(window, (current_time.replace(minute=0, second=0, microsecond=0) + timedelta(hours=1) - current_time).total_seconds())
+                log_end_time_utc = log_start_time_utc + timedelta(seconds=window)
+                
+                #a log range is due once its end time is as far back from the current time as a log range of the interval would be
+                if log_end_time_utc > datetime.utcnow() - timedelta(seconds=logs_from - interval):
+                    break
+                
+                #the lag is how long the log range has been waiting to be scheduled since it was due
+                lags[zone.name] = (datetime.utcnow() - timedelta(seconds=logs_from - interval) - log_end_time_utc).total_seconds()
+                metric_schedule_lag.set(lags[zone.name], zone=zone.name)
+                
+                #if the queue of the zone is full, move on to the other zones and try again later
+                log_range = LogRange(zone, current_time, log_start_time_utc, log_end_time_utc)
+                if hand_over(log_range) is False:
+                    if zone.name not in waiting:
+                        logger.warning("%s: All fetch workers are busy and the queue is full. Waiting for free workers...", log_range.description)
+                        waiting.add(zone.name)
+                    blocked = zone
+                    break
+                
+                log_start_time_utc = log_end_time_utc
+                current_time = current_time + timedelta(seconds=window)
+            
+            next_ranges[zone.name] = (log_start_time_utc, current_time)
+            if blocked is not zone:
+                waiting.discard(zone.name)
+            
+            #then hand the missed log ranges of the zone to the fetch workers, if there's room and the catch-up rate allows
+            while blocked is not zone and len(backfills[zone.name]) > 0 and catchup_limiter.try_acquire() == 0:
+                log_start_time_utc, log_end_time_utc = backfills[zone.name][0]
+                if hand_over(LogRange(zone, log_start_time_utc + utc_offset, log_start_time_utc, log_end_time_utc, backfill=True)) is False:
+                    blocked = zone
+                    break
+                backfills[zone.name].popleft()
+        
+        backfill_count = sum(len(backfill) for backfill in backfills.values())
+        
+        if time.time() - last_status_time >= status_interval:
+            log_status(lags, backfill_count)
+            last_status_time = time.time()
 
-        #create a new thread to handle the logs processing. the target method is logs() and 3 parameters are supplied to this method
-        threading.Thread(target=logs, args=(current_time, log_start_time_utc, log_end_time_utc)).start()
+        #if a zone is waiting for room in the queue, or there are missed log ranges to be pulled again, try again shortly, instead of waiting for the next interval
+        if blocked is not None:
+            fetch_queue.wait_for_room(blocked, min(1.0, interval - ((time.time() - initial_time) % interval)))
+        elif backfill_count > 0:
+            lifecycle.wait(min(1.0, interval - ((time.time() - initial_time) % interval)))
+        else:
+            lifecycle.wait(interval - ((time.time() - initial_time) % interval))
 
+'''
+This method handles one-time operation. The time range given by the user is split into log ranges of the shard size,
+and they are handed to the fetch workers of all the zones in turn, so they are pulled concurrently within the rate limit of each zone, and pushed as soon as they are pulled.
+The progress and the throughput are reported regularly, until all the log ranges have been done.
+'''
+def backfill():
+    
+    global backfill_progress
+    
+    #split the time range into log ranges. the last one may be shorter than the shard size
+    shards = []
+    log_start_time_utc = start_time_static
+    while log_start_time_utc < end_time_static:
+        log_end_time_utc = min(log_start_time_utc + timedelta(seconds=shard_size), end_time_static)
+        shards.append((log_start_time_utc, log_end_time_utc))
         log_start_time_utc = log_end_time_utc
-        current_time = current_time + timedelta(seconds=interval)
+    
+    backfill_progress = BackfillProgress(len(shards) * len(zones))
+    logger.info("Pulling logs from %sZ to %sZ in %s log ranges%s.", start_time_static.isoformat(), end_time_static.isoformat(), len(shards), (" for each of " + str(len(zones)) + " zones" if zones_config is not None else ""))
+    
+    last_status_time = time.time()
+    for log_start_time_utc, log_end_time_utc in shards:
+        for zone in zones:
+            #wait until there's room in the queue of the zone
+            log_range = LogRange(zone, None, log_start_time_utc, log_end_time_utc, scheduled=False)
+            while lifecycle.stopping() is False and fetch_queue.put(log_range) is False:
+                fetch_queue.wait_for_room(zone, 1.0)
+                if time.time() - last_status_time >= status_interval:
+                    logger.info("Backfill progress: %s", backfill_progress.report())
+                    last_status_time = time.time()
+        
+        #the log ranges not handed to the fetch workers yet will not be pulled if the program is exiting
+        if lifecycle.stopping() is True:
+            return
+    
+    #all the log ranges have been handed to the fetch workers, wait for them to finish
+    #the progress is checked every second, so the program can exit as soon as it's asked to
+    while backfill_progress.wait(max(0.0, min(1.0, status_interval - (time.time() - last_status_time)))) is False:
+        if lifecycle.stopping() is True:
+            return
+        if time.time() - last_status_time >= status_interval:
+            logger.info("Backfill progress: %s", backfill_progress.report())
+            last_status_time = time.time()
+    
+    logger.info("Backfill finished: %s", backfill_progress.report())
 
-        try:
-            time.sleep(interval - ((time.time() - initial_time) % interval))
-        except KeyboardInterrupt:
-            is_exit = True
-            print("")
-            logger.info(str(datetime.now()) + " --- Initiating program exit. Finishing up log push tasks...")
-            if num_of_running_thread <= 0:
-                logger.info(str(datetime.now()) + " --- Program exited gracefully.")
-            break
+'''
+This method finds the logfiles saved on local storage with the logs within the time range given by the user, for replay mode.
+The start time and end time of the logs are taken from the name of each logfile, so the logfiles are found whether they are organized into date and time folders or not.
+A logfile which is partly within the time range is replayed as a whole. It returns the start time, end time and path of each logfile, sorted by the start time.
+'''
+def find_logfiles(zone):
+    zone_path = Path(path + ("/" + zone.name if zones_config is not None else ""))
+    logfiles = []
+    for logfile_path in zone_path.rglob(logfile_name_prefix + "_*~*"):
+        #the temporary files of the logfiles that have not been written completely are left out
+        parsed = parse_logfile_name(logfile_path.name)
+        if parsed is None or logfile_path.is_file() is False:
+            continue
+        log_start_time_utc, log_end_time_utc = parse_rfc3339(parsed[0]), parse_rfc3339(parsed[1])
+        if log_start_time_utc < end_time_static and log_end_time_utc > start_time_static:
+            logfiles.append((log_start_time_utc, log_end_time_utc, str(logfile_path)))
+    return sorted(logfiles)
+
+'''
+These methods run in the replay workers, which are separate processes, so the logfiles can be decompressed and processed into chunks using all the CPU cores.
+The logfile is decompressed block by block, and the chunks of each block are handed to the main process through a small queue as soon as they are built.
+The replay worker waits while the queue is full, so only a few blocks of each logfile are held in memory at once, no matter how big the logfile is.
+The replay worker ignores Ctrl+C, the same as the transform worker, and so does the manager process that runs the queues.
+'''
+def initialize_replay_manager():
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+
+def initialize_replay_worker(settings):
+    global doc_id_mode, doc_id_fields, bulk_metadata, bulk_action_prefix, bulk_max_bytes, adaptive_bulk
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    doc_id_mode = settings["doc_id_mode"]
+    doc_id_fields = settings["doc_id_fields"]
+    bulk_metadata = settings["bulk_metadata"]
+    bulk_action_prefix = settings["bulk_action_prefix"]
+    bulk_max_bytes = settings["bulk_max_bytes"]
+    adaptive_bulk = False
+
+#each block is put on the queue as the chunks with the number of logs and bytes in it, followed by None once the logfile has been read to the end
+def read_logfile(logfile_path, max_docs, blocks):
+    
+    global bulk_max_docs, bulk_sizer
+    
+    #the chunks follow the number of logs given by the main process, which may be adjusted by adaptive chunk sizing
+    bulk_max_docs = max_docs
+    bulk_sizer = BulkSizer()
+    
+    for data in read_blocks(logfile_path):
+        chunks, number_of_logs = process_logs(data)
+        blocks.put((chunks, number_of_logs, len(data)))
+    blocks.put(None)
+
+#read the raw logs of a logfile in blocks, each of them ending with a complete line. the logs in a Parquet file are read a row group at a time, and turned back into raw logs
+def read_blocks(logfile_path):
+    if logfile_path.endswith(".parquet"):
+        if pyarrow is None:
+            raise OSError("pyarrow library is not installed, the logfile cannot be read")
+        for batch in pyarrow.parquet.ParquetFile(logfile_path).iter_batches():
+            yield parquet_to_json(batch)
+        return
+    
+    rest = b""
+    with open(logfile_path, mode="rb") as raw_file:
+        if logfile_path.endswith(".gz"):
+            logfile = gzip.GzipFile(fileobj=raw_file, mode="rb")
+        elif logfile_path.endswith(".zst"):
+            if zstandard is None:
+                raise OSError("zstandard library is not installed, the logfile cannot be decompressed")
+            logfile = zstandard.ZstdDecompressor().stream_reader(raw_file)
+        else:
+            logfile = raw_file
         
+        while True:
+            block = logfile.read(replay_block_size)
+            
+            #the last line of the block may be incomplete, so it's kept until the rest of it is read with the next block
+            data = rest + block
+            if len(block) > 0:
+                cut = data.rfind(b"\n") + 1
+                data, rest = data[:cut], data[cut:]
+            yield data
+            if len(block) == 0:
+                break
+
+'''
+This method replays the logs saved on local storage within the time range given by the user. Each logfile is handed to the replay workers, and the chunks built from it
+are handed to the push workers, the same as the logs pulled from Cloudflare, so each logfile is a log range which is recorded in succ.log or fail.log once it has been pushed.
+The logfiles are handed to the push workers one by one, in order. Only a few logfiles are read ahead, each of them up to a few blocks, so the memory used stays bounded.
+'''
+def replay():
+    
+    global backfill_progress
+    
+    logfiles = [(zone, logfile) for zone in zones for logfile in find_logfiles(zone)]
+    backfill_progress = BackfillProgress(len(logfiles))
+    if len(logfiles) == 0:
+        logger.warning("No logfiles found under %s with the logs from %sZ to %sZ.", path, start_time_static.isoformat(), end_time_static.isoformat())
+        return
+    logger.info("Replaying logs from %sZ to %sZ in %s logfiles%s.", start_time_static.isoformat(), end_time_static.isoformat(), len(logfiles), (" of " + str(len(zones)) + " zones" if zones_config is not None else ""))
+    
+    settings = {"doc_id_mode": doc_id_mode, "doc_id_fields": doc_id_fields, "bulk_metadata": bulk_metadata, "bulk_action_prefix": bulk_action_prefix, "bulk_max_bytes": bulk_max_bytes}
+    replay_pool = ProcessPoolExecutor(max_workers=replay_workers, initializer=initialize_replay_worker, initargs=(settings,))
+    manager = multiprocessing.managers.SyncManager()
+    manager.start(initialize_replay_manager)
+    
+    pending = deque()
+    next_index = 0
+    last_status_time = time.time()
+    try:
+        while (next_index < len(logfiles) or len(pending) > 0) and lifecycle.stopping() is False:
+            #keep one more logfile waiting for each replay worker, so they are not idle while the chunks are handed to the push workers
+            while next_index < len(logfiles) and len(pending) < replay_workers * 2:
+                zone, (log_start_time_utc, log_end_time_utc, logfile_path) = logfiles[next_index]
+                log_range = LogRange(zone, None, log_start_time_utc, log_end_time_utc, scheduled=False)
+                lifecycle.begin()
+                blocks = manager.Queue(maxsize=2)
+                pending.append((replay_pool.submit(read_logfile, logfile_path, bulk_sizer.current(), blocks), blocks, log_range, logfile_path))
+                next_index += 1
+            
+            if time.time() - last_status_time >= status_interval:
+                logger.info("Replay progress: %s", backfill_progress.report())
+                last_status_time = time.time()
+            
+            #the next block is waited for every second, so the program can exit as soon as it's asked to
+            future, blocks, log_range, logfile_path = pending[0]
+            try:
+                block = blocks.get(timeout=1.0)
+            except queue.Empty:
+                if future.done() is True and future.exception() is not None:
+                    pending.popleft()
+                    logger.error("%s: Failed to read the logfile %s. Error dump: %s", log_range.description, logfile_path, future.exception())
+                    log_range.finish_fetch("Read log error")
+                continue
+            
+            #the logfile has been read to the end
+            if block is None:
+                pending.popleft()
+                finish_writing(log_range, None)
+                continue
+            
+            chunks, number_of_logs, number_of_bytes = block
+            log_range.number_of_logs += number_of_logs
+            log_range.number_of_bytes += number_of_bytes
+            
+            #this will wait if the push workers are busy, so no more blocks are taken until there's room again
+            for final_json, chunk_logs in chunks:
+                if async_engine is not None:
+                    asyncio.run_coroutine_threadsafe(async_engine.queue_push(log_range, final_json, chunk_logs), async_engine.loop).result()
+                else:
+                    queue_push(log_range, final_json, chunk_logs)
+    finally:
+        #the logfiles not read to the end will not be pushed if the program is exiting. the replay workers still waiting to put a block stop once the manager is shut down
+        for future, blocks, log_range, logfile_path in pending:
+            future.cancel()
+            log_range.finish_fetch("Shutdown")
+        replay_pool.shutdown(wait=False)
+        manager.shutdown()
+    
+    if lifecycle.stopping() is True:
+        return
+    
+    #all the logfiles have been read, wait for the push workers to finish
+    while backfill_progress.wait(max(0.0, min(1.0, status_interval - (time.time() - last_status_time)))) is False:
+        if lifecycle.stopping() is True:
+            return
+        if time.time() - last_status_time >= status_interval:
+            logger.info("Replay progress: %s", backfill_progress.report())
+            last_status_time = time.time()
+    
+    logger.info("Replay finished: %s", backfill_progress.report())
+
+'''
+This is where the real execution of the program begins.
+'''
+def main():
+    
+    #First it will prepare the loggers, and initialize the parameters supplied by the user
+    initialize_logger()
+    initialize_arg()
+    initialize_log_output()
+    
+    #in export mode, the logs are only read from local storage, so nothing else needs to be prepared
+    if export_path is not None:
+        export_archive()
+        return
+
+    #Then create the HTTP sessions to be shared by all the workers, and prepare the zones to pull logs from
+    initialize_sessions()
+    initialize_zones()
+    initialize_checkpoint()
+    initialize_transform()
+    initialize_metrics()
+    initialize_compaction()
+
+    #After the above execution, it will verify the Zone ID and Access Token given by the user whether they are valid
+    verify_credential()
+    initialize_es_nodes()
+    initialize_spool()
+
+    #if both Zone ID and Access Token are valid, the logpush tasks to Elastic will begin.
+    logger.info("Cloudflare log push tasks to Elastic started.")
+    
+    #from now on, Ctrl+C and SIGTERM are handled by the program, so the log ranges in progress can be finished before it exits
+    lifecycle.install()
+    fetch_threads, push_threads = start_workers()
+
+    #if the user instructs the program to do logpush for only one time, the program will not do the logpush jobs repeatedly
+    #in replay mode, the logs are read from local storage instead. all of them return once the program is asked to exit
+    if replay_mode is True:
+        replay()
+    elif one_time is True:
+        backfill()
+    else:
+        schedule()
+    
+    if lifecycle.stopping() is True:
+        if no_console is False and lifecycle.signal_name == "SIGINT":
+            print("")
+        logger.info("Received %s. Initiating program exit. Finishing up log push tasks in %s seconds at most...", lifecycle.signal_name, drain_timeout)
+    
+    stop_workers(fetch_threads, push_threads)
+    
+    #write the final metrics, so the textfile is up to date after the program exits
+    if metrics_textfile is not None:
+        write_metrics_textfile()
+    
+    if lifecycle.stopping() is True:
+        if one_time is True or replay_mode is True:
+            logger.info("%s stopped: %s", ("Replay" if replay_mode is True else "Backfill"), backfill_progress.report())
+        if lifecycle.in_flight > 0:
+            logger.warning("%s log ranges were not finished before the program exited.%s", lifecycle.in_flight, (" They will be pulled again after the program restarts." if checkpoint is not None else ""))
+        else:
+            logger.info("Program exited gracefully.")
+
+if __name__ == "__main__":
+    main()
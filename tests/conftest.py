@@ -0,0 +1,4 @@
+import os, sys
+
+#the program is a single script at the root of the repository, so it's imported from there
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
@@ -0,0 +1,124 @@
+import pathlib
+
+import pytest
+
+import cf_elk_pusher
+
+
+@pytest.fixture
+def partition(monkeypatch, tmp_path):
+    monkeypatch.setattr(cf_elk_pusher, "archive_format", "parquet")
+    monkeypatch.setattr(cf_elk_pusher, "archive_ranges", {})
+    partition = tmp_path / "date=2026-10-10" / "hour=00"
+    partition.mkdir(parents=True)
+    return partition
+
+
+def at(minute, second=0):
+    return "2026-10-10T00:%02d:%02dZ" % (minute, second)
+
+
+def logfile_name(start, end):
+    return "cf_logs_" + start + "~" + end + ".parquet"
+
+
+#the logfiles are written with pyarrow for the tests that merge them, otherwise only their names matter
+def write_logfile(partition, start, end, rows=0):
+    if rows > 0:
+        pyarrow = pytest.importorskip("pyarrow")
+        import pyarrow.parquet
+        pyarrow.parquet.write_table(pyarrow.table({"RayID": [start + str(i) for i in range(rows)]}), str(partition / logfile_name(start, end)))
+    else:
+        (partition / logfile_name(start, end)).touch()
+
+
+def logfiles(partition):
+    return sorted(logfile_path.name for logfile_path in partition.iterdir())
+
+
+def is_archived(partition, start, end):
+    return cf_elk_pusher.prepare_path(start, end, partition) is False
+
+
+def test_runs_without_gaps_are_merged(partition):
+    pyarrow = pytest.importorskip("pyarrow")
+    import pyarrow.parquet
+    write_logfile(partition, at(0), at(1), rows=3)
+    write_logfile(partition, at(1), at(2), rows=2)
+    write_logfile(partition, at(2), at(3), rows=1)
+    
+    cf_elk_pusher.compact_partition(partition)
+    assert logfiles(partition) == [logfile_name(at(0), at(3))]
+    assert pyarrow.parquet.read_table(str(partition / logfile_name(at(0), at(3)))).num_rows == 6
+
+
+def test_runs_with_gaps_are_merged_separately(partition):
+    pyarrow = pytest.importorskip("pyarrow")
+    import pyarrow.parquet
+    write_logfile(partition, at(0), at(1), rows=1)
+    write_logfile(partition, at(1), at(2), rows=1)
+    write_logfile(partition, at(3), at(4), rows=1)
+    write_logfile(partition, at(5), at(6), rows=1)
+    write_logfile(partition, at(6), at(6, 30), rows=1)
+    write_logfile(partition, at(6, 30), at(7), rows=1)
+    
+    #the log ranges 00:02 to 00:03 and 00:04 to 00:05 are missing, so they are not hidden in the names of the merged logfiles
+    cf_elk_pusher.compact_partition(partition)
+    assert logfiles(partition) == [logfile_name(at(0), at(2)), logfile_name(at(3), at(4)), logfile_name(at(5), at(7))]
+    assert pyarrow.parquet.read_table(str(partition / logfile_name(at(5), at(7)))).num_rows == 3
+
+
+def test_merged_logfile_covers_its_log_ranges(partition):
+    write_logfile(partition, at(0), at(1), rows=1)
+    write_logfile(partition, at(1), at(2), rows=1)
+    write_logfile(partition, at(3), at(4), rows=1)
+    cf_elk_pusher.compact_partition(partition)
+    
+    assert is_archived(partition, at(0), at(1)) is True
+    assert is_archived(partition, at(0, 30), at(1, 30)) is True
+    assert is_archived(partition, at(1), at(2)) is True
+    assert is_archived(partition, at(3), at(4)) is True
+    
+    #the gap, and the log ranges partly in it, are not covered
+    assert is_archived(partition, at(2), at(3)) is False
+    assert is_archived(partition, at(1, 30), at(2, 30)) is False
+    
+    #the log range is pulled again anyway when the checkpoint asks for it
+    assert cf_elk_pusher.prepare_path(at(0), at(1), partition, overwrite=True) == partition / ("cf_logs_" + at(0) + "~" + at(1) + ".json")
+
+
+def test_merged_logfile_left_by_previous_run(partition):
+    write_logfile(partition, at(0), at(10))
+    
+    #a file with a time not valid in its name is left out
+    write_logfile(partition, at(10), at(20) + "x")
+    assert is_archived(partition, at(0), at(1)) is True
+    assert is_archived(partition, "2026-10-10T00:09:59.500000Z", at(10)) is True
+    assert is_archived(partition, at(10), at(11)) is False
+
+
+def test_folder_is_listed_once(partition, monkeypatch):
+    write_logfile(partition, at(0), at(10))
+    listed = []
+    glob = pathlib.Path.glob
+    def counting_glob(self, pattern):
+        listed.append(pattern)
+        return glob(self, pattern)
+    monkeypatch.setattr(pathlib.Path, "glob", counting_glob)
+    
+    for minute in range(10):
+        assert is_archived(partition, at(minute), at(minute + 1)) is True
+        assert is_archived(partition, at(minute + 10), at(minute + 11)) is False
+    assert len(listed) == 1
+
+
+def test_compaction_replaces_listed_time_ranges(partition):
+    write_logfile(partition, at(0), at(1), rows=1)
+    assert is_archived(partition, at(1), at(2)) is False
+    
+    #the logfile written after the folder has been listed is found by its name, and by its time range once it has been merged
+    write_logfile(partition, at(1), at(2), rows=1)
+    assert is_archived(partition, at(1), at(2)) is True
+    assert is_archived(partition, at(0, 30), at(1, 30)) is False
+    cf_elk_pusher.compact_partition(partition)
+    assert is_archived(partition, at(0, 30), at(1, 30)) is True
@@ -0,0 +1,103 @@
+import json
+
+import pytest
+
+import cf_elk_pusher
+from test_spool import log_range
+
+
+@pytest.fixture
+def settings(monkeypatch, tmp_path):
+    monkeypatch.setattr(cf_elk_pusher, "bulk_sizer", cf_elk_pusher.BulkSizer())
+    monkeypatch.setattr(cf_elk_pusher, "dead_letter_path", str(tmp_path / "dead_letter.json"))
+    return tmp_path
+
+
+def bulk_request(action, number_of_logs):
+    return b"".join(b'{ "' + action.encode("utf-8") + b'": { "_index": "cloudflare", "_id": "%d" }}\n{"RayID": "%d"}\n' % (i, i) for i in range(number_of_logs))
+
+
+def bulk_response(action, statuses):
+    items = []
+    for status in statuses:
+        result = {"_index": "cloudflare", "status": status}
+        if status >= 300:
+            result["error"] = {"type": "error_" + str(status), "reason": "failed with " + str(status)}
+        items.append({action: result})
+    return json.dumps({"took": 3, "errors": any(status >= 300 for status in statuses), "items": items}).encode("utf-8")
+
+
+def read_dead_letters(settings):
+    try:
+        with open(settings / "dead_letter.json", encoding="utf-8") as dead_letter_file:
+            return [json.loads(line) for line in dead_letter_file]
+    except FileNotFoundError:
+        return []
+
+
+#the logs of the bulk request with the given numbers, each with its action line
+def logs(action, numbers):
+    lines = bulk_request(action, max(numbers) + 1).split(b"\n")
+    return b"".join(lines[i * 2] + b"\n" + lines[i * 2 + 1] + b"\n" for i in numbers)
+
+
+def test_split_keeps_retryable_and_dead_letters_the_rest():
+    final_json = bulk_request("index", 6)
+    items = json.loads(bulk_response("index", [201, 429, 503, 400, 409, 200]))["items"]
+    
+    retry_json, number_of_retries, dead_letters, first_error = cf_elk_pusher.split_bulk_failures(final_json, items)
+    assert retry_json == logs("index", [1, 2])
+    assert number_of_retries == 2
+    
+    #a conflict with the index action means the log was not written, so it's not counted as indexed
+    assert [(status, json.loads(line)["RayID"]) for action, line, status, error in dead_letters] == [(400, "3"), (409, "4")]
+    assert first_error == (429, {"type": "error_429", "reason": "failed with 429"})
+
+
+def test_conflict_with_create_is_success():
+    final_json = bulk_request("create", 3)
+    items = json.loads(bulk_response("create", [201, 409, 201]))["items"]
+    assert cf_elk_pusher.split_bulk_failures(final_json, items) == (b"", 0, [], None)
+
+
+def test_partial_failure_retries_only_retryable_logs(settings):
+    final_json = bulk_request("index", 5)
+    success, retry_json, number_of_retries = cf_elk_pusher.handle_bulk_response(log_range(0), final_json, 5, 200, bulk_response("index", [201, 429, 500, 400, 201]), 0.1, "")
+    assert success is False
+    assert retry_json == logs("index", [1, 2])
+    assert number_of_retries == 2
+    
+    dead_letters = read_dead_letters(settings)
+    assert [(dead_letter["status"], json.loads(dead_letter["log"])["RayID"]) for dead_letter in dead_letters] == [(400, "3")]
+    assert dead_letters[0]["error"]["type"] == "error_400"
+
+
+def test_dead_letters_only_is_success(settings):
+    final_json = bulk_request("create", 4)
+    result = cf_elk_pusher.handle_bulk_response(log_range(0), final_json, 4, 200, bulk_response("create", [201, 409, 400, 201]), 0.1, "")
+    assert result[0] is True
+    assert [dead_letter["status"] for dead_letter in read_dead_letters(settings)] == [400]
+
+
+@pytest.mark.parametrize("items", [[{}], [{"index": "created"}], [{"index": {"status": 201}}, {"index": {"status": 429}}, {"index": {"status": 429}}, {"index": {"status": 429}}], "created", None])
+def test_malformed_items_retries_whole_request(settings, items):
+    final_json = bulk_request("index", 2)
+    content = json.dumps({"took": 3, "errors": True, "items": items}).encode("utf-8")
+    assert cf_elk_pusher.handle_bulk_response(log_range(0), final_json, 2, 200, content, 0.1, "") == (False, final_json, 2)
+    assert read_dead_letters(settings) == []
+
+
+@pytest.mark.parametrize("status_code", [429, 502, 503])
+def test_retryable_request_failure_keeps_all_logs(settings, status_code):
+    final_json = bulk_request("index", 3)
+    content = json.dumps({"error": {"root_cause": [{"type": "unavailable", "reason": "busy"}]}, "status": status_code}).encode("utf-8")
+    assert cf_elk_pusher.handle_bulk_response(log_range(0), final_json, 3, status_code, content, 0.1, "") == (False, final_json, 3)
+    assert read_dead_letters(settings) == []
+
+
+@pytest.mark.parametrize("status_code, content", [(413, b'{"error": {"root_cause": [{"type": "content_too_long", "reason": "too big"}], "type": "content_too_long"}, "status": 413}'), (400, b"<html>Bad Request</html>")])
+def test_request_failure_not_worth_retrying_is_dead_lettered(settings, status_code, content):
+    final_json = bulk_request("index", 3)
+    assert cf_elk_pusher.handle_bulk_response(log_range(0), final_json, 3, status_code, content, 0.1, "")[0] is True
+    dead_letters = read_dead_letters(settings)
+    assert [(dead_letter["status"], json.loads(dead_letter["log"])["RayID"]) for dead_letter in dead_letters] == [(status_code, "0"), (status_code, "1"), (status_code, "2")]
@@ -0,0 +1,105 @@
+from datetime import datetime, timedelta
+
+import pytest
+
+import cf_elk_pusher
+
+
+@pytest.fixture
+def checkpoint(monkeypatch, tmp_path):
+    monkeypatch.setattr(cf_elk_pusher, "interval", 60.0)
+    monkeypatch.setattr(cf_elk_pusher, "adaptive_window", False)
+    return cf_elk_pusher.Checkpoint(str(tmp_path / "checkpoint.db"))
+
+
+@pytest.fixture
+def zone():
+    return cf_elk_pusher.Zone("zone", "zone", "", 1, "", "", None)
+
+
+def at(minute, second=0):
+    return datetime(2026, 10, 10, 0, 0) + timedelta(minutes=minute, seconds=second)
+
+
+def log_range(zone, start, end):
+    return cf_elk_pusher.LogRange(zone, None, start, end, scheduled=False)
+
+
+def record(checkpoint, zone, start, end, status):
+    checkpoint.record(log_range(zone, at(start), at(end)), status)
+
+
+def test_no_rows_means_no_gaps(checkpoint, zone):
+    assert checkpoint.find_gaps(zone, at(0), at(10)) == []
+
+
+def test_gaps_between_done_rows_are_split_by_interval(checkpoint, zone):
+    record(checkpoint, zone, 0, 1, "done")
+    record(checkpoint, zone, 4, 5, "done")
+    assert checkpoint.find_gaps(zone, at(0), at(7)) == [(at(1), at(2)), (at(2), at(3)), (at(3), at(4)), (at(5), at(6)), (at(6), at(7))]
+
+
+def test_time_before_first_row_is_not_a_gap(checkpoint, zone):
+    record(checkpoint, zone, 3, 4, "done")
+    assert checkpoint.find_gaps(zone, at(0), at(5)) == [(at(4), at(5))]
+
+
+def test_overlapping_rows_leave_no_gap(checkpoint, zone):
+    #the window size changed between runs, so the log ranges saved overlap each other
+    record(checkpoint, zone, 0, 2, "done")
+    record(checkpoint, zone, 1, 4, "done")
+    record(checkpoint, zone, 3, 5, "done")
+    assert checkpoint.find_gaps(zone, at(0), at(5)) == []
+
+
+def test_failed_row_is_pulled_again_as_it_is(checkpoint, zone, monkeypatch):
+    record(checkpoint, zone, 0, 1, "done")
+    record(checkpoint, zone, 1, 4, "failed")
+    record(checkpoint, zone, 4, 5, "done")
+    
+    #the interval is now shorter than the failed log range, which is still pulled as one, so its result is saved to the same row
+    monkeypatch.setattr(cf_elk_pusher, "interval", 30.0)
+    assert checkpoint.find_gaps(zone, at(0), at(5)) == [(at(1), at(4))]
+
+
+def test_failed_row_overlapped_by_done_row(checkpoint, zone):
+    record(checkpoint, zone, 0, 2, "failed")
+    record(checkpoint, zone, 1, 3, "done")
+    assert checkpoint.find_gaps(zone, at(0), at(4)) == [(at(0), at(1)), (at(3), at(4))]
+
+
+def test_failed_row_done_later_is_not_a_gap(checkpoint, zone):
+    record(checkpoint, zone, 0, 1, "failed")
+    record(checkpoint, zone, 0, 1, "done")
+    assert checkpoint.find_gaps(zone, at(0), at(1)) == []
+
+
+def test_pending_log_ranges_are_not_gaps(checkpoint, zone):
+    record(checkpoint, zone, 0, 1, "done")
+    record(checkpoint, zone, 2, 3, "failed")
+    checkpoint.add_pending(log_range(zone, at(1), at(2)))
+    checkpoint.add_pending(log_range(zone, at(2), at(3)))
+    assert checkpoint.find_gaps(zone, at(0), at(4)) == [(at(3), at(4))]
+    
+    checkpoint.remove_pending(log_range(zone, at(1), at(2)))
+    assert checkpoint.find_gaps(zone, at(0), at(4)) == [(at(1), at(2)), (at(3), at(4))]
+
+
+def test_gaps_follow_adaptive_window(checkpoint, zone, monkeypatch):
+    monkeypatch.setattr(cf_elk_pusher, "adaptive_window", True)
+    monkeypatch.setattr(cf_elk_pusher, "window_target_logs", 1000)
+    monkeypatch.setattr(cf_elk_pusher, "window_target_bytes", 10 ** 9)
+    monkeypatch.setattr(cf_elk_pusher, "window_min", 10.0)
+    monkeypatch.setattr(cf_elk_pusher, "window_max", 900.0)
+    
+    #10 logs per second, so each log range is 100 seconds long
+    recent = log_range(zone, at(-1), at(0))
+    recent.number_of_logs, recent.number_of_bytes = 600, 60000
+    zone.window_sizer.record(recent)
+    assert zone.window_sizer.current() == 100.0
+    
+    record(checkpoint, zone, 50, 55, "done")
+    gaps = checkpoint.find_gaps(zone, at(50), at(62))
+    
+    #the log ranges do not go past the hour, the same as the scheduled ones
+    assert gaps == [(at(55), at(56, 40)), (at(56, 40), at(58, 20)), (at(58, 20), at(60)), (at(60), at(61, 40)), (at(61, 40), at(62))]
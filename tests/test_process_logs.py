@@ -0,0 +1,91 @@
+import hashlib, json, random
+
+import pytest
+
+import cf_elk_pusher
+
+
+@pytest.fixture
+def limits(monkeypatch):
+    def set_limits(max_docs=5000, max_bytes=10 * 1024 * 1024, doc_id_mode="none"):
+        monkeypatch.setattr(cf_elk_pusher, "adaptive_bulk", False)
+        monkeypatch.setattr(cf_elk_pusher, "bulk_max_docs", max_docs)
+        monkeypatch.setattr(cf_elk_pusher, "bulk_max_bytes", max_bytes)
+        monkeypatch.setattr(cf_elk_pusher, "bulk_sizer", cf_elk_pusher.BulkSizer())
+        monkeypatch.setattr(cf_elk_pusher, "doc_id_mode", doc_id_mode)
+    return set_limits
+
+
+#the logs vary a lot in size, so the size of the chunks cannot be guessed right from the average
+def generate_logs(number_of_lines, seed=1):
+    generator = random.Random(seed)
+    lines = []
+    for i in range(number_of_lines):
+        lines.append(json.dumps({"ClientRequestURI": "/" + "a" * generator.choice([1, 10, 100, 1000]), "EdgeResponseStatus": generator.choice([200, 404]), "RayID": "%016x" % generator.getrandbits(64)}, separators=(",", ":")))
+    return ("\n".join(lines) + "\n").encode("utf-8")
+
+
+#the implementation before the logs were handled as bytes, which built one bulk request for the whole log range
+def legacy_process_logs(response, metadata=None):
+    final_json = []
+    number_of_logs = 0
+    for line in response.decode("utf-8").split("\n"):
+        if line != "":
+            final_json.append(metadata(line.encode("utf-8")).decode("utf-8") if metadata is not None else '{ "index": { "_index": "cloudflare" }}\n')
+            final_json.append(line + "\n")
+            number_of_logs += 1
+    return "".join(final_json).encode("utf-8"), number_of_logs
+
+
+def rayid_metadata(line):
+    log = json.loads(line)
+    doc_id = log["RayID"].encode("utf-8") if "RayID" in log else hashlib.blake2b(line, digest_size=16).hexdigest().encode("ascii")
+    return b'{ "index": { "_index": "cloudflare", "_id": "' + doc_id + b'" }}\n'
+
+
+def check_chunks(response, max_docs, max_bytes, metadata=None):
+    chunks, number_of_logs = cf_elk_pusher.process_logs(response)
+    expected, expected_count = legacy_process_logs(response, metadata)
+    assert b"".join(final_json for final_json, count in chunks) == expected
+    assert number_of_logs == expected_count == sum(count for final_json, count in chunks)
+    
+    for final_json, count in chunks:
+        assert final_json.count(b"\n") == count * 2
+        assert 1 <= count <= max_docs
+        #a chunk may only go over the maximum size if it has a single log that is bigger than that
+        assert len(final_json) <= max_bytes or count == 1
+    return chunks
+
+
+@pytest.mark.parametrize("doc_id_mode, metadata", [("none", None), ("rayid", rayid_metadata)])
+def test_single_chunk_matches_legacy(limits, doc_id_mode, metadata):
+    limits(doc_id_mode=doc_id_mode)
+    assert len(check_chunks(generate_logs(500), 5000, 10 * 1024 * 1024, metadata)) == 1
+
+
+@pytest.mark.parametrize("doc_id_mode, metadata", [("none", None), ("rayid", rayid_metadata)])
+@pytest.mark.parametrize("max_docs", [1, 7, 100])
+def test_docs_limit(limits, doc_id_mode, metadata, max_docs):
+    limits(max_docs=max_docs, doc_id_mode=doc_id_mode)
+    chunks = check_chunks(generate_logs(500), max_docs, 10 * 1024 * 1024, metadata)
+    assert [count for final_json, count in chunks[:-1]] == [max_docs] * (len(chunks) - 1)
+
+
+@pytest.mark.parametrize("doc_id_mode, metadata", [("none", None), ("rayid", rayid_metadata)])
+@pytest.mark.parametrize("max_bytes", [500, 4096, 50000])
+def test_bytes_limit(limits, doc_id_mode, metadata, max_bytes):
+    limits(max_bytes=max_bytes, doc_id_mode=doc_id_mode)
+    check_chunks(generate_logs(500), 5000, max_bytes, metadata)
+
+
+@pytest.mark.parametrize("doc_id_mode, metadata", [("none", None), ("rayid", rayid_metadata)])
+@pytest.mark.parametrize("response", [b"", b"\n\n", b'{"RayID":"a"}', b'\n{"RayID":"a"}\n\n{"RayID":"b"}\n', b'{"RayID":"a"}\n\n\n{"RayID":"b"}\n{"RayID":"c"}\n\n'])
+def test_empty_lines_are_skipped(limits, doc_id_mode, metadata, response):
+    limits(max_docs=2, doc_id_mode=doc_id_mode)
+    check_chunks(response, 2, 10 * 1024 * 1024, metadata)
+
+
+def test_logs_without_rayid_are_hashed(limits):
+    limits(max_docs=3, doc_id_mode="rayid")
+    response = b'{"RayID":"a"}\n{"EdgeResponseStatus":200}\n{"RayID":"c","x":1}\n{"RayID": "d"}\n'
+    check_chunks(response, 3, 10 * 1024 * 1024, rayid_metadata)
@@ -0,0 +1,147 @@
+import json, os, threading
+from datetime import datetime
+
+import pytest
+
+import cf_elk_pusher
+
+
+@pytest.fixture
+def settings(monkeypatch, tmp_path):
+    monkeypatch.setattr(cf_elk_pusher, "spool_segment_size", 1024)
+    monkeypatch.setattr(cf_elk_pusher, "spool_max_size", 1024 * 1024)
+    monkeypatch.setattr(cf_elk_pusher, "spool_replay_rate", 0)
+    monkeypatch.setattr(cf_elk_pusher, "dead_letter_path", str(tmp_path / "dead_letter.json"))
+    return tmp_path
+
+
+@pytest.fixture
+def no_replayer(monkeypatch):
+    #the chunks are taken by the tests instead of the replayer thread
+    monkeypatch.setattr(cf_elk_pusher.Spool, "replay", lambda self: None)
+
+
+def log_range(minute):
+    zone = cf_elk_pusher.Zone("zone", "zone", "", 1, "", "", None)
+    return cf_elk_pusher.LogRange(zone, None, datetime(2026, 10, 10, 0, minute), datetime(2026, 10, 10, 0, minute + 1), scheduled=False)
+
+
+def chunk(number, size=300):
+    line = json.dumps({"RayID": "%016x" % number, "padding": "x" * size}).encode("utf-8")
+    return b'{ "index": { "_index": "cloudflare" }}\n' + line + b"\n"
+
+
+#take the next chunk and move past it, the same as the replayer does once the chunk has been pushed
+def take(spool):
+    header, final_json, length = spool.next_chunk()
+    with spool.condition:
+        spool.read_offset += length
+        spool.save_position()
+    return header, final_json
+
+
+def test_chunks_are_read_in_order_across_segments(settings, no_replayer):
+    spool = cf_elk_pusher.Spool(settings / "spool")
+    chunks = [chunk(i) for i in range(5)]
+    for i, final_json in enumerate(chunks):
+        assert spool.append(log_range(i), final_json, 1) is True
+    
+    #each chunk takes up about a third of a segment, so the spool has been rotated
+    assert len(spool.segments()) >= 2
+    first_segment = spool.segments()[0]
+    
+    for i, final_json in enumerate(chunks):
+        header, read_json = take(spool)
+        assert read_json == final_json
+        assert header["start"] == "2026-10-10T00:%02d:00Z" % i
+        assert header["logs"] == 1
+    
+    #the segments read to the end have been deleted, and only the one being written is left
+    assert first_segment not in spool.segments()
+    assert spool.segments() == [spool.write_sequence]
+    assert spool.size == spool.write_size
+
+
+def test_restart_from_saved_position(settings, no_replayer):
+    spool = cf_elk_pusher.Spool(settings / "spool")
+    chunks = [chunk(i, size=50) for i in range(3)]
+    for i, final_json in enumerate(chunks):
+        spool.append(log_range(i), final_json, 1)
+    take(spool)
+    spool.close()
+    
+    spool = cf_elk_pusher.Spool(settings / "spool")
+    assert take(spool)[1] == chunks[1]
+    assert take(spool)[1] == chunks[2]
+
+
+def test_close_removes_empty_spool(settings, no_replayer):
+    spool = cf_elk_pusher.Spool(settings / "spool")
+    spool.append(log_range(0), chunk(0), 1)
+    take(spool)
+    spool.close()
+    assert spool.segments() == []
+
+
+def test_truncated_tail_is_skipped(settings, no_replayer):
+    spool = cf_elk_pusher.Spool(settings / "spool")
+    chunks = [chunk(i, size=50) for i in range(2)]
+    for i, final_json in enumerate(chunks):
+        spool.append(log_range(i), final_json, 1)
+    spool.close()
+    
+    #the program stopped in the middle of writing the second chunk
+    segment_path = spool.segment_path(spool.write_sequence)
+    with open(segment_path, mode="r+b") as segment:
+        segment.truncate(os.path.getsize(segment_path) - 20)
+    
+    spool = cf_elk_pusher.Spool(settings / "spool")
+    assert take(spool)[1] == chunks[0]
+    
+    #the incomplete chunk is left out, and the chunks saved after the restart are read next
+    spool.append(log_range(5), chunk(5, size=50), 1)
+    assert take(spool)[1] == chunk(5, size=50)
+    assert not os.path.exists(segment_path)
+
+
+def test_full_spool_refuses_chunk(settings, no_replayer, monkeypatch):
+    monkeypatch.setattr(cf_elk_pusher, "spool_max_size", 1024)
+    spool = cf_elk_pusher.Spool(settings / "spool")
+    assert spool.append(log_range(0), chunk(0), 1) is True
+    assert spool.append(log_range(1), chunk(1), 1) is True
+    
+    #each chunk takes up about 470 bytes with its header, so the third one would take the spool over its maximum size
+    size = spool.size
+    assert spool.append(log_range(2), chunk(2), 1) is False
+    assert spool.size == size
+    
+    for i in range(2):
+        assert take(spool)[1] == chunk(i)
+
+
+def test_replayer_gives_up_after_max_attempts(settings, monkeypatch):
+    monkeypatch.setattr(cf_elk_pusher, "spool_max_attempts", 3)
+    monkeypatch.setattr(cf_elk_pusher, "spool_retry_delay", 0)
+    attempts = []
+    pushed = threading.Event()
+    
+    #the first chunk can never be pushed, the second one is pushed straight away
+    def push_logs(final_json, log_range, number_of_logs, on_failure=None):
+        attempts.append(final_json)
+        if final_json == chunk(0):
+            return on_failure(final_json, number_of_logs)
+        pushed.set()
+        return True
+    monkeypatch.setattr(cf_elk_pusher, "push_logs", push_logs)
+    
+    spool = cf_elk_pusher.Spool(settings / "spool")
+    spool.append(log_range(0), chunk(0), 1)
+    spool.append(log_range(1), chunk(1), 1)
+    assert pushed.wait(10) is True
+    
+    assert attempts == [chunk(0)] * 3 + [chunk(1)]
+    with open(settings / "dead_letter.json", encoding="utf-8") as dead_letter_file:
+        dead_letters = [json.loads(line) for line in dead_letter_file]
+    assert len(dead_letters) == 1
+    assert dead_letters[0]["log"] == chunk(0).split(b"\n")[1].decode("utf-8")
+    assert dead_letters[0]["error"]["type"] == "spool_max_attempts"